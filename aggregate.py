@@ -0,0 +1,80 @@
+import sqlite3
+
+import numpy as np
+
+# column statistics for /api/summary/columns, each worked out for every activity in the
+# range at once from the arrays of a single query. missing values are nan, and are
+# left out of every statistic rather than counted as zero
+
+# statistics available per period, in the order they're returned
+STATS = ("sum", "mean", "min", "max")
+
+# sqlite's sum() adds a column's values one after another in the order the rows are
+# read, from 3.43 on keeping a Kahan-Babuska-Neumaier error term alongside
+SQLITE_COMPENSATED_SUM = sqlite3.sqlite_version_info >= (3, 43, 0)
+
+
+def moving_average(values: np.ndarray, window: int) -> np.ndarray:
+    # trailing mean of the last `window` values at each position, from running sums so
+    # the cost doesn't depend on the window. nan where all of them are missing
+    present = ~np.isnan(values)
+    sums = np.concatenate(([0.0], np.cumsum(np.where(present, values, 0.0))))
+    counts = np.concatenate(([0], np.cumsum(present)))
+
+    end = np.arange(1, len(values)+1)
+    start = np.maximum(end - window, 0)
+    n = counts[end] - counts[start]
+    return np.divide(sums[end] - sums[start], n, out=np.full(len(values), np.nan), where=n > 0)
+
+
+def period_starts(periods: np.ndarray) -> np.ndarray:
+    # index of the first row of each period, rows of one period being next to each other
+    if len(periods) == 0:
+        return np.zeros(0, dtype=np.intp)
+    return np.flatnonzero(np.concatenate(([True], periods[1:] != periods[:-1])))
+
+
+def period_stats(starts: np.ndarray, values: np.ndarray, stats=STATS) -> dict:
+    # {stat: array with one value per period} for the periods beginning at `starts`
+    if len(starts) == 0:
+        return {stat: np.zeros(0) for stat in stats}
+
+    present = ~np.isnan(values)
+    count = np.add.reduceat(present, starts)
+    missing = count == 0
+
+    q = {}
+    if "sum" in stats or "mean" in stats:
+        total = np.add.reduceat(np.where(present, values, 0.0), starts)
+    if "sum" in stats:
+        q["sum"] = np.where(missing, np.nan, total)
+    if "mean" in stats:
+        q["mean"] = np.divide(total, count, out=np.full(len(starts), np.nan), where=~missing)
+    if "min" in stats:
+        q["min"] = np.where(missing, np.nan, np.minimum.reduceat(np.where(present, values, np.inf), starts))
+    if "max" in stats:
+        q["max"] = np.where(missing, np.nan, np.maximum.reduceat(np.where(present, values, -np.inf), starts))
+
+    return {stat: q[stat] for stat in stats}
+
+
+def sqlite_sums(starts: np.ndarray, values: np.ndarray) -> list:
+    # sum() of the values of each period beginning at `starts` as sqlite gives it for
+    # the same rows in the same order, to the last digit of every float
+    stops = np.append(starts[1:], len(values))
+    return [sqlite_sum(values[start:stop]) for start, stop in zip(starts.tolist(), stops.tolist())]
+
+
+def sqlite_sum(values: np.ndarray):
+    if values.dtype.kind in "iu":
+        # integers are summed exactly and stay integers
+        return int(values.sum())
+
+    # python floats add like sqlite's doubles, and unlike numpy's sum strictly in order
+    total = error = 0.0
+    for value in values.tolist():
+        t = total + value
+        if SQLITE_COMPENSATED_SUM:
+            error += (total - t) + value if abs(total) > abs(value) else (value - t) + total
+        total = t
+    return total + error
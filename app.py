@@ -1,11 +1,29 @@
 import sqlite3
 import sys
 from pathlib import Path
+from collections import deque
+from itertools import islice
+from operator import itemgetter
 import argparse
-
-import fitparse
-
-from field_types import *
+import hashlib
+import os
+import time
+
+import numpy as np
+
+# fitparse, field_types and the process pool are imported where files are decoded,
+# so running just the webapp (-r) never loads them. check with --profile-startup
+import best_efforts
+import cache
+import downsample
+import metrics
+import monitoring
+import record_blob
+import serve
+import snapshot
+import track
+import training_load
+import watcher
 
 from server import app
 
@@ -19,24 +37,60 @@ def main():
     
     parser.add_argument("-src", default="FitFiles", required=False, 
         help="directory of FitFiles to be used, expected to contain src/Activity and src/Monitor as subdirectories")
+    parser.add_argument("-db", default="fitdata.db", required=False,
+        help="sqlite db that fitfiles are added to and the webapp reads from")
     update_or_reset_group = parser.add_mutually_exclusive_group()
     update_or_reset_group.add_argument("-u", "--update", default=False, action="store_true", required=False, 
         help="update the db using unseen files from src")
     update_or_reset_group.add_argument("-t", "--reset", default=False, action="store_true", required=False, 
         help="reset the db to exactly match files at src")
     parser.add_argument("-r", "--run", default=False, action="store_true", required=False, help="run the local webapp")
+    parser.add_argument("--port", default=5000, type=int, required=False, help="port the webapp listens on")
+    parser.add_argument("--workers", default=0, type=int, required=False,
+        help="serve the webapp from this many processes instead of the single process development server, "
+             "with static files compressed and cached. with --watch the ingest status isn't visible to them")
+    parser.add_argument("-j", "--jobs", default=1, type=int, required=False,
+        help="number of processes used to decode fitfiles when updating/resetting the db, 0 uses every core")
+    parser.add_argument("--verify", default=False, action="store_true", required=False,
+        help="when updating, re-hash every file in src to catch files changed since they were ingested")
+    parser.add_argument("--wal", default=False, action="store_true", required=False,
+        help="switch the db to write-ahead logging with synchronous=NORMAL, much faster for large imports")
+    parser.add_argument("--backfill", default=False, action="store_true", required=False,
+        help="find the best efforts of activities added before they were tracked, using -j processes")
+    parser.add_argument("--record-layout", default=None, choices=("rows", "blob"), required=False,
+        help="store activities' records as a row per second (the default) or one compressed blob per activity, "
+             "converting those already in the db")
+    parser.add_argument("--codec", default="zlib", choices=tuple(record_blob.CODECS), required=False,
+        help="compression used by --record-layout blob, lzma is smaller but slower to read")
+    parser.add_argument("--snapshot", default=None, required=False,
+        help="after updating the db (and each watched ingest), export what the webapp reads to memory mapped "
+             "files in this directory and serve from them")
+    parser.add_argument("-w", "--watch", default=False, action="store_true", required=False,
+        help="while the webapp runs, ingest new files as they appear in src/Activity and src/Monitor")
+    parser.add_argument("--poll-interval", default=5.0, type=float, required=False,
+        help="seconds between checks of src for new files when watching")
+    parser.add_argument("--metrics", default=False, action="store_true", required=False,
+        help="time requests and sql statements (served at /api/_metrics), and print how long each phase of ingesting a file took")
+    parser.add_argument("--profile-startup", default=False, action="store_true", required=False,
+        help="start the webapp with the other arguments given, report import times and time to the first request, then exit")
 
     args = parser.parse_args()
 
     # set the default of updating db then running web server if none of -u, -t, -r are given
-    if not any([args.update, args.reset, args.run]):
+    if not any([args.update, args.reset, args.run, args.backfill, args.record_layout]):
         args.run = True
         args.update = True
 
+    if args.profile_startup:
+        if not args.run:
+            print("--profile-startup times the webapp starting, use it with -r (or no other arguments)")
+            return 1
+        return profile_startup([arg for arg in sys.argv[1:] if arg != "--profile-startup"], args.port)
+
     # ----- dealing with db and fitfiles -----
 
     # if directory malformed and we will need to use it
-    if (args.update or args.reset) and not all((
+    if (args.update or args.reset or args.watch) and not all((
         Path(args.src).is_dir(),
         Path(args.src+"/Activity").is_dir(),
         Path(args.src+"/Monitor").is_dir()
@@ -44,83 +98,287 @@ def main():
         print("fitfiles src directory specified (or the default ./FitFiles) is malformed or missing")
         return 1
 
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+
+    # files already there are left to the update below, the watcher takes everything
+    # arriving from here on
+    def ingest(files):
+        counts = update_db(args.src, 1, False, args.wal, args.db, only=files, timings=args.metrics)
+        if args.snapshot is not None:
+            export_snapshot(args.db, args.snapshot)
+        return counts
+
+    ingest_watcher = None
+    if args.watch and args.run:
+        ingest_watcher = watcher.IngestWatcher((Path(args.src, "Activity"), Path(args.src, "Monitor")),
+            ingest, args.poll_interval)
+        ingest_watcher.prime()
+
+    # a reset stores everything in the new layout anyway, there's nothing to convert
+    if args.record_layout is not None:
+        migrate_records(args.record_layout, args.codec, args.wal, args.db, convert=not args.reset)
+
     if args.update:
-        update_db(args.src)
+        update_db(args.src, jobs, args.verify, args.wal, args.db, timings=args.metrics)
     elif args.reset:
-        reset_db(args.src)
+        reset_db(args.src, jobs, args.wal, args.db, timings=args.metrics)
+
+    if args.backfill:
+        backfill_best_efforts(jobs, args.wal, args.db)
+
+    if args.snapshot is not None and Path(args.db).exists():
+        export_snapshot(args.db, args.snapshot)
 
     # ----- running webserver ---------
 
     if args.run:
-        app.run(debug=False)
+        app.config["DB_PATH"] = args.db
+        app.config["METRICS"] = args.metrics
+        app.config["SNAPSHOT_PATH"] = args.snapshot
+
+        if args.workers > 0:
+            # the watcher's threads stay in this process, started once the workers
+            # have been forked from it
+            serve.run(app, port=args.port, workers=args.workers,
+                started=ingest_watcher.start if ingest_watcher is not None else None)
+        else:
+            if ingest_watcher is not None:
+                app.config["INGEST_WATCHER"] = ingest_watcher
+                ingest_watcher.start()
+            app.run(debug=False, port=args.port)
+
+        if ingest_watcher is not None:
+            ingest_watcher.stop()
         
     return 0
 
 
+# top level modules shown by --profile-startup
+PROFILE_MODULES = 15
+
+
+def profile_startup(argv, port=5000):
+    # runs app.py again with `argv` under python -X importtime, waits for its first
+    # api response and reports that and the slowest imports, so everything from the
+    # interpreter starting up is counted
+    import subprocess
+    import tempfile
+    import urllib.error
+    import urllib.request
+
+    with tempfile.TemporaryFile("w+") as log:
+        t = time.perf_counter()
+        server = subprocess.Popen([sys.executable, "-X", "importtime", __file__, *argv], stdout=log, stderr=log)
+
+        status = None
+        try:
+            while status is None and server.poll() is None:
+                try:
+                    with urllib.request.urlopen(f"http://127.0.0.1:{port}/api/summary", timeout=1) as response:
+                        status = response.status
+                except urllib.error.HTTPError as e:
+                    status = e.code
+                except OSError:
+                    time.sleep(0.01)
+            first_request = time.perf_counter() - t
+        finally:
+            server.terminate()
+            server.wait()
+
+        log.seek(0)
+        # "import time: self [us] | cumulative | imported package", indented by depth
+        imports = []
+        for line in log:
+            if line.startswith("import time:") and not line.startswith("import time: self"):
+                self_us, cumulative_us, name = line[len("import time:"):].split("|")
+                imports.append((name.rstrip(), int(self_us), int(cumulative_us)))
+
+    if status is None:
+        print(f"app.py {' '.join(argv)} exited before serving a request")
+        return 1
+
+    # everything imported directly by app.py or by python starting up
+    top_level = [(name.strip(), self_us, cumulative_us) for name, self_us, cumulative_us in imports if not name.startswith("  ")]
+    print(f"{'module':<32} {'self ms':>10} {'cumulative ms':>14}")
+    for name, self_us, cumulative_us in sorted(top_level, key=itemgetter(2), reverse=True)[:PROFILE_MODULES]:
+        print(f"{name:<32} {self_us/1000:10.1f} {cumulative_us/1000:14.1f}")
+    print("-----------------------------------")
+    print(f"{len(imports)} modules imported in {sum(self_us for _, self_us, _ in imports)/1000:.1f} ms, "
+          f"fitparse {'imported' if any(name.strip() == 'fitparse' for name, _, _ in imports) else 'not imported'}")
+    print(f"first request answered ({status}) {first_request*1000:.0f} ms after starting")
+
+    return 0
+
+
+
+# files written per transaction during update/reset, each file still gets its own
+# savepoint so a bad file never leaves part of itself behind
+FILES_PER_COMMIT = 50
+
+# records handed to each executemany, bounds memory for arbitrarily long activities
+RECORDS_PER_CHUNK = 5000
+
+
+class IngestConnection(sqlite3.Connection):
+    # what had been written through the connection when the generation was last bumped,
+    # as (total_changes, schema_version), see commit
+    written = (0, None)
+
 
-def update_db(src):
+def connect_db(wal=False, db="fitdata.db"):
     # creates db if not already exists
-    con = sqlite3.connect("fitdata.db")
+    con = sqlite3.connect(db, factory=IngestConnection)
+    con.written = (0, con.execute("PRAGMA schema_version").fetchone()[0])
+
+    if wal:
+        # persistent for the db file, readers no longer block on the writer and
+        # commits only fsync at checkpoints
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+
+    return con
+
+
+def commit(con):
+    # commit, then let the server know the data it's been serving is stale. only when
+    # rows were written or tables created or dropped since the last bump, so an update
+    # or watcher tick finding nothing new keeps every etag and cached response. the bump
+    # comes after the commit so nothing cached under the new generation can predate it
+    con.commit()
+
+    written = (con.total_changes, con.execute("PRAGMA schema_version").fetchone()[0])
+    if written == con.written:
+        return
+    con.written = written
+
+    db = con.execute("PRAGMA database_list").fetchone()[2]
+    if db:
+        cache.bump_generation(db)
+
+
+def update_db(src, jobs=1, verify=False, wal=False, db="fitdata.db", only=None, timings=False):
+    # only: paths of the files to look at rather than everything in src, eg. the ones
+    # the watcher has seen arrive. timings: print how long each file took to ingest
+    con = connect_db(wal, db)
     cur = con.cursor()
 
     # create any tables if not present already
     setup_db(cur)
+    setup_indexes(cur)
+
+    # only files missing from the manifest (or changed since) need to be parsed
+    files = unseen_fitfiles(src, con, cur, verify, only=only)
 
     # parse all unseen fitfiles and add to db
     activity_count = 0
     lap_count = 0
     record_count = 0
+    earliest_start_time = None
 
-    # TODO: more elegant way than attempting insert and catching unique constraint violation?
-    for f in Path(src+"/Activity").iterdir():
+    for i, parsed in enumerate(parse_fitfiles(files.keys(), jobs), 1):
+        f = parsed["file"]
         try:
-            counts = add_fitfile(f, con, cur)
+            counts = insert_fitfile(parsed, con, cur)
+            if timings:
+                log_timings(parsed)
 
             activity_count+=counts["activity_count"]
             lap_count+=counts["lap_count"]
             record_count+=counts["record_count"]
+            activity_id = counts["activity_id"]
+
+            if activity_id is not None and (earliest_start_time is None or parsed["activity"][0] < earliest_start_time):
+                earliest_start_time = parsed["activity"][0]
 
         except sqlite3.IntegrityError as e:
+            # activity is in the db but the file isn't in the manifest, eg. a db from
+            # before the manifest existed, so link the file to the existing activity
             print(f"[FILE ERROR] Already seen file {f}, skipping it.")
             print(e)
 
-            continue
+            # streamed records are written before the session is read, so the rest of
+            # the file may still need decoding to find the activity's start time
+            for _ in parsed["records"]:
+                pass
+
+            existing = None
+            if parsed["activity"] is not None:
+                existing = cur.execute("SELECT activity_id FROM Activity WHERE start_time = ?",
+                    (parsed["activity"][0],)).fetchone()
+            activity_id = existing[0] if existing else None
+
+        record_manifest(cur, src, f, files[f], activity_id)
+        if i % FILES_PER_COMMIT == 0:
+            commit(con)
+
+    if earliest_start_time is not None:
+        update_daily_load(cur, earliest_start_time)
+    commit(con)
+
+    sample_count = insert_monitoring_files(src, unseen_fitfiles(src, con, cur, verify, "Monitor", only), con, cur)
 
     print("-----------------------------------")
     print(f"successfully added {activity_count} activities to db, containing {lap_count} laps and {record_count} individual records")
+    print(f"and {sample_count} monitoring samples")
     print("-----------------------------------")
     con.close()
 
+    return {"activity_count": activity_count, "sample_count": sample_count}
 
-def reset_db(src):
-    # creates db if not already exists
-    con = sqlite3.connect("fitdata.db")
+
+def reset_db(src, jobs=1, wal=False, db="fitdata.db", timings=False):
+    con = connect_db(wal, db)
     cur = con.cursor()
 
     # clear and recreate db
     cur.execute("DROP TABLE IF EXISTS Activity")
     cur.execute("DROP TABLE IF EXISTS Lap")
     cur.execute("DROP TABLE IF EXISTS ActivityRecord")
-    # cur.execute("DROP TABLE IF EXISTS Monitoring")
-    # cur.execute("DROP TABLE IF EXISTS Settings")
-
-    # recreate all the tables
+    cur.execute("DROP TABLE IF EXISTS IngestManifest")
+    cur.execute("DROP TABLE IF EXISTS ActivityTotals")
+    cur.execute("DROP TABLE IF EXISTS ActivityRecordLevel")
+    cur.execute("DROP TABLE IF EXISTS BestEffort")
+    cur.execute("DROP TABLE IF EXISTS ActivityTrack")
+    cur.execute("DROP TABLE IF EXISTS ActivityLoad")
+    cur.execute("DROP TABLE IF EXISTS DailyLoad")
+    cur.execute("DROP TABLE IF EXISTS ActivityBounds")
+    cur.execute("DROP TABLE IF EXISTS TrackSegment")
+    cur.execute("DROP TABLE IF EXISTS Monitoring")
+    cur.execute("DROP TABLE IF EXISTS ActivityRecordBlob")
+    # Settings is kept, a reset rebuilds the db the way it was set up
+
+    # recreate all the tables, indexes are built once everything is loaded as
+    # that's far cheaper than maintaining them through every insert
     setup_db(cur)
 
     # parse all the fitfiles and add them to db
     activity_count = 0
     lap_count = 0
     record_count = 0
-    for f in Path(src+"/Activity").iterdir():
-        counts = add_fitfile(f, con, cur)
+    files = {f: file_state(f) for f in Path(src+"/Activity").iterdir()}
+    for i, parsed in enumerate(parse_fitfiles(files.keys(), jobs), 1):
+        counts = insert_fitfile(parsed, con, cur)
+        if timings:
+            log_timings(parsed)
 
         activity_count+=counts["activity_count"]
         lap_count+=counts["lap_count"]
         record_count+=counts["record_count"]
 
+        record_manifest(cur, src, parsed["file"], files[parsed["file"]], counts["activity_id"])
+        if i % FILES_PER_COMMIT == 0:
+            commit(con)
+
+    setup_indexes(cur)
+    update_daily_load(cur)
+    commit(con)
+
+    files = {f: file_state(f) for f in Path(src+"/Monitor").iterdir()}
+    sample_count = insert_monitoring_files(src, files, con, cur)
 
     print("-----------------------------------")
     print(f"successfully added {activity_count} activities to db, containing {lap_count} laps and {record_count} individual records")
+    print(f"and {sample_count} monitoring samples")
     print("-----------------------------------")
     con.close()
 
@@ -207,209 +465,984 @@ def setup_db(cur):
         FOREIGN KEY(activity_id) REFERENCES Activity(activity_id)
     )
     """)
-    # cur.execute("CREATE TABLE IF NOT EXISTS Monitoring()")
-    # cur.execute("CREATE TABLE IF NOT EXISTS Settings")
+    # every file seen by update/reset, so known files can be skipped without parsing
+    # them. activity_id is null for files that held no valid activity
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS IngestManifest(
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime INTEGER NOT NULL,
+        content_hash TEXT NOT NULL,
+        activity_id INTEGER,
 
-def add_fitfile(f, con, cur):
-    activity_count = 0
-    lap_count = 0
-    record_count = 0
+        FOREIGN KEY(activity_id) REFERENCES Activity(activity_id)
+    )
+    """)
+    # per week/month/year totals served by /api/summary/totals, kept up to date as
+    # activities are added and removed. the first and last start times let the
+    # server tell which buckets lie entirely inside a requested date range, they're
+    # declared like Activity.start_time so range arguments compare the same way
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS ActivityTotals(
+        group_by TEXT NOT NULL,
+        summary_date TEXT NOT NULL,
+        num_activities INTEGER NOT NULL,
+        total_distance REAL NOT NULL,
+        total_time REAL NOT NULL,
+        first_start_time INTEGER NOT NULL,
+        last_start_time INTEGER NOT NULL,
+
+        PRIMARY KEY(group_by, summary_date)
+    ) WITHOUT ROWID
+    """)
+    # downsampled copies of each activity's records at the point counts in
+    # downsample.LEVELS, for charts that don't need every 1Hz sample
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS ActivityRecordLevel(
+        activity_id INTEGER NOT NULL,
+        max_points INTEGER NOT NULL,
+        timestamp INTEGER NOT NULL,
+        enhanced_speed REAL NOT NULL,
+        heart_rate INTEGER NOT NULL,
+        cadence INTEGER NOT NULL,
+        enhanced_altitude FLOAT,
+
+        PRIMARY KEY(activity_id, max_points, timestamp),
+        FOREIGN KEY(activity_id) REFERENCES Activity(activity_id)
+    ) WITHOUT ROWID
+    """)
+    # each activity's fastest segment over each of best_efforts.DISTANCES that it
+    # covers, start and end being the timestamps of the records either side of it
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS BestEffort(
+        activity_id INTEGER NOT NULL,
+        distance REAL NOT NULL,
+        elapsed_time REAL NOT NULL,
+        start_time INTEGER NOT NULL,
+        end_time INTEGER NOT NULL,
+
+        PRIMARY KEY(activity_id, distance),
+        FOREIGN KEY(activity_id) REFERENCES Activity(activity_id)
+    ) WITHOUT ROWID
+    """)
+    # each activity's gps track simplified to the tolerances (metres) in
+    # track.TOLERANCES, as encoded polylines. distance is the length of that line
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS ActivityTrack(
+        activity_id INTEGER NOT NULL,
+        tolerance REAL NOT NULL,
+        points INTEGER NOT NULL,
+        distance REAL NOT NULL,
+        polyline TEXT NOT NULL,
+
+        PRIMARY KEY(activity_id, tolerance),
+        FOREIGN KEY(activity_id) REFERENCES Activity(activity_id)
+    ) WITHOUT ROWID
+    """)
+    # per activity heart rate training load, TRIMP and seconds below zone 1 (zone_0) and
+    # in each of the zones in training_load.HR_ZONES
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS ActivityLoad(
+        activity_id INTEGER PRIMARY KEY,
+        trimp REAL NOT NULL,
+        zone_0 REAL NOT NULL,
+        zone_1 REAL NOT NULL,
+        zone_2 REAL NOT NULL,
+        zone_3 REAL NOT NULL,
+        zone_4 REAL NOT NULL,
+        zone_5 REAL NOT NULL,
+
+        FOREIGN KEY(activity_id) REFERENCES Activity(activity_id)
+    )
+    """)
+    # every day's total TRIMP and the fitness (ctl), fatigue (atl) and form (tsb) it
+    # leads to, from the first activity's day to the last's. each day depends on the
+    # one before so changes are recomputed from their day onwards
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS DailyLoad(
+        day TEXT PRIMARY KEY,
+        load REAL NOT NULL,
+        ctl REAL NOT NULL,
+        atl REAL NOT NULL,
+        tsb REAL NOT NULL
+    ) WITHOUT ROWID
+    """)
+    # spatial index of where activities went, r*trees of the bounding box of each
+    # whole track and of each track.SEGMENT_LENGTH piece of it. segment ids are
+    # activity_id * SEGMENT_IDS + the piece's number, segments being how many there are
+    cur.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS ActivityBounds USING rtree(
+        activity_id, min_lat, max_lat, min_long, max_long, +segments
+    )
+    """)
+    cur.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS TrackSegment USING rtree(
+        segment_id, min_lat, max_lat, min_long, max_long, +activity_id
+    )
+    """)
+    # all day samples from the Monitor files, one narrow row per sample keyed on the
+    # series (monitoring.SERIES) and unix epoch seconds. a file read again just
+    # replaces its samples
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS Monitoring(
+        series INTEGER NOT NULL,
+        timestamp INTEGER NOT NULL,
+        value INTEGER NOT NULL,
+
+        PRIMARY KEY(series, timestamp)
+    ) WITHOUT ROWID
+    """)
+    # an activity's records as one compressed blob (see record_blob.py), instead of
+    # rows of ActivityRecord when the db's record_layout is 'blob'
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS ActivityRecordBlob(
+        activity_id INTEGER PRIMARY KEY,
+        record_count INTEGER NOT NULL,
+        data BLOB NOT NULL,
+
+        FOREIGN KEY(activity_id) REFERENCES Activity(activity_id)
+    )
+    """)
+    # options that belong to the db rather than a run of app.py, eg. record_layout
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS Settings(
+        key TEXT PRIMARY KEY,
+        value
+    ) WITHOUT ROWID
+    """)
+
+    migrate_db(cur)
+
+def setup_indexes(cur):
+    # kept separate from setup_db so reset_db can build them after a bulk load.
+    # the ActivityRecord index covers every column the records route reads, so an
+    # activity's records come straight from the index in timestamp order without
+    # touching the table
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS ActivityRecord_activity_timestamp ON ActivityRecord(
+        activity_id, timestamp, enhanced_speed, heart_rate, cadence, enhanced_altitude
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS Lap_activity_start_time ON Lap(activity_id, start_time)")
+    cur.execute("CREATE INDEX IF NOT EXISTS IngestManifest_activity_id ON IngestManifest(activity_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS BestEffort_distance_elapsed_time ON BestEffort(distance, elapsed_time)")
+
+
+def drop_activity_id_indexes(cur):
+    # replaced by the wider indexes in setup_indexes, which have activity_id as their prefix
+    cur.execute("DROP INDEX IF EXISTS ActivityRecord_activity_id")
+    cur.execute("DROP INDEX IF EXISTS Lap_activity_id")
+
+
+# date modifier giving each group's summary_date (as used by the totals route), and
+# the modifiers from a start time to the first day of its bucket and the day after it
+TOTALS_PERIODS = {
+    "week": ("weekday 1", "-6 days", "+1 day"),
+    "month": ("start of month", "+0 days", "+1 month"),
+    "year": ("start of year", "+0 days", "+1 year"),
+}
+
+TOTALS_SELECT = """
+SELECT
+    ? group_by,
+    date(start_time, ?) summary_date,
+    count(*) num_activities,
+    sum(total_distance) total_distance,
+    sum(total_timer_time) total_time,
+    min(start_time) first_start_time,
+    max(start_time) last_start_time
+FROM Activity
+"""
+
+
+def update_totals(cur, start_time):
+    # recompute the buckets holding start_time from the activities in them, a short
+    # range scan of the start_time index. summing them again rather than adjusting the
+    # stored totals keeps the floats identical to grouping the whole table
+    for group_by, (modifier, first_day, end_day) in TOTALS_PERIODS.items():
+        cur.execute("DELETE FROM ActivityTotals WHERE group_by = ? AND summary_date = date(?, ?)",
+            (group_by, start_time, modifier))
+        cur.execute(f"""
+            INSERT INTO ActivityTotals {TOTALS_SELECT}
+            WHERE start_time >= date(?, ?, ?) AND start_time < date(?, ?, ?)
+            GROUP BY summary_date
+            """, (group_by, modifier, start_time, modifier, first_day, start_time, modifier, end_day))
+
+
+def rebuild_totals(cur):
+    # the range, the totals route's default one, has the rows summed in start_time index
+    # order like update_totals and the route's own query rather than in rowid order
+    cur.execute("DELETE FROM ActivityTotals")
+    for group_by, (modifier, _, _) in TOTALS_PERIODS.items():
+        cur.execute(f"""
+            INSERT INTO ActivityTotals {TOTALS_SELECT}
+            WHERE start_time BETWEEN '0001-01-01' AND '9999-01-01'
+            GROUP BY summary_date
+            """, (group_by, modifier))
+
+
+RECORD_LEVEL_INSERT = """INSERT INTO ActivityRecordLevel (
+    activity_id, max_points, timestamp, enhanced_speed, heart_rate, cadence, enhanced_altitude
+) VALUES (?,?,?,?,?,?,?)
+"""
+
+
+# the record columns kept in each level
+LEVEL_COLUMNS = ("timestamp", "enhanced_speed", "heart_rate", "cadence", "enhanced_altitude")
+
+
+def insert_record_levels(cur, activity_id, records):
+    # records: the activity's {column: array} in time order, as activity_records gives them
+    series = np.column_stack([records[name] for name in LEVEL_COLUMNS[1:]]).astype(np.float64, copy=False)
+    for max_points, kept in downsample.levels(series):
+        rows = record_blob.to_rows({name: records[name][kept] for name in LEVEL_COLUMNS}, LEVEL_COLUMNS)
+        cur.executemany(RECORD_LEVEL_INSERT, ((activity_id, max_points, *row) for row in rows))
+
+
+def rebuild_record_levels(cur):
+    cur.execute("DELETE FROM ActivityRecordLevel")
+
+    return (insert_record_levels,)
+
+
+BEST_EFFORT_INSERT = """INSERT INTO BestEffort (
+    activity_id, distance, elapsed_time, start_time, end_time
+) VALUES (?,?,?,datetime(?, 'unixepoch'),datetime(?, 'unixepoch'))
+"""
+
+
+def activity_records(cur, activity_id):
+    # {column: array} of an activity already in the db in time order, whichever layout
+    # its records are in, as record_blob.decode gives them
+    row = cur.execute("SELECT data FROM ActivityRecordBlob WHERE activity_id = ?", (activity_id,)).fetchone()
+    if row is not None:
+        return record_blob.decode(row[0])
+
+    return record_blob.from_rows(cur.execute(f"""
+        SELECT CAST(strftime('%s', timestamp) AS INTEGER), {",".join(list(record_blob.COLUMNS)[1:])}
+        FROM ActivityRecord
+        WHERE activity_id = ?
+        ORDER BY timestamp
+        """, (activity_id,)))
+
+
+def activity_best_efforts(activity_id, records):
+    # rows for BEST_EFFORT_INSERT from an activity's {column: array}
+    return [(activity_id, metres, elapsed, start, end)
+        for _, metres, elapsed, start, end in best_efforts.fastest_segments(records["timestamp"], records["distance"])]
+
+
+ACTIVITY_LOAD_INSERT = "INSERT INTO ActivityLoad VALUES (?,?,?,?,?,?,?,?)"
+DAILY_LOAD_INSERT = "INSERT INTO DailyLoad (day, load, ctl, atl, tsb) VALUES (?,?,?,?,?)"
+
+
+def insert_activity_load(cur, activity_id, records):
+    seconds, heart_rate = records["timestamp"], records["heart_rate"]
+    if len(seconds) == 0:
+        return
+
+    cur.execute(ACTIVITY_LOAD_INSERT, (activity_id,
+        training_load.trimp(seconds, heart_rate),
+        *training_load.zone_seconds(seconds, heart_rate).tolist()))
+
+
+def update_daily_load(cur, since=None):
+    # recompute DailyLoad from the day of `since` (a start time) onwards, or all of it.
+    # it carries on from the last day before that, so adding the newest activity only
+    # redoes the days since the previous one. callers adding many activities call this
+    # once with the earliest of their start times
+    previous = None
+    if since is None:
+        since = cur.execute("SELECT min(start_time) FROM Activity").fetchone()[0]
+        cur.execute("DELETE FROM DailyLoad")
+    else:
+        previous = cur.execute("""
+            SELECT date(day, '+1 day'), ctl, atl FROM DailyLoad
+            WHERE day < date(?)
+            ORDER BY day DESC LIMIT 1
+            """, (since,)).fetchone()
+
+    if since is None:
+        return
+
+    if previous is None:
+        first_day, ctl, atl = cur.execute("SELECT date(?)", (since,)).fetchone()[0], 0.0, 0.0
+    else:
+        first_day, ctl, atl = previous
+
+    cur.execute("DELETE FROM DailyLoad WHERE day >= ?", (first_day,))
+
+    loads = dict(cur.execute("""
+        SELECT date(start_time) AS day, sum(trimp)
+        FROM Activity JOIN ActivityLoad ON ActivityLoad.activity_id = Activity.activity_id
+        WHERE start_time >= ?
+        GROUP BY day
+        """, (first_day,)))
+
+    cur.executemany(DAILY_LOAD_INSERT, training_load.daily_series(first_day, loads, ctl, atl))
+
+
+def rebuild_training_load(cur):
+    # DailyLoad is redone from the ActivityLoad this fills in, see migrate_db
+    cur.execute("DELETE FROM ActivityLoad")
+
+    return (insert_activity_load,)
+
+
+TRACK_INSERT = "INSERT INTO ActivityTrack (activity_id, tolerance, points, distance, polyline) VALUES (?,?,?,?,?)"
+
+ACTIVITY_BOUNDS_INSERT = "INSERT INTO ActivityBounds VALUES (?,?,?,?,?,?)"
+TRACK_SEGMENT_INSERT = "INSERT INTO TrackSegment VALUES (?,?,?,?,?,?)"
+
+# segment ids set aside per activity, enough for a track of SEGMENT_IDS * 500m
+SEGMENT_IDS = 2**16
+
+
+def track_positions(records):
+    # (lat, long) in degrees of the records with a position, from an activity's
+    # {column: array} in time order
+    return track.positions(records["position_lat"], records["position_long"])
+
+
+def insert_track(cur, activity_id, records):
+    insert_track_levels(cur, activity_id, records)
+    insert_track_bounds(cur, activity_id, records)
+
+
+def insert_track_levels(cur, activity_id, records):
+    lat, long = track_positions(records)
+    cur.executemany(TRACK_INSERT, ((activity_id, *level) for level in track.levels(lat, long)))
+
+
+def insert_track_bounds(cur, activity_id, records):
+    lat, long = track_positions(records)
+    if len(lat) == 0:
+        return
+
+    segments = track.segment_bounds(lat, long)
+    cur.execute(ACTIVITY_BOUNDS_INSERT, (activity_id, *track.bounds(lat, long), len(segments)))
+    cur.executemany(TRACK_SEGMENT_INSERT,
+        ((activity_id*SEGMENT_IDS + i, *segment, activity_id) for i, segment in enumerate(segments.tolist())))
+
+
+def delete_track_bounds(cur, activity_id):
+    # r*trees can only look rows up by id, so each segment is deleted by its own id
+    row = cur.execute("SELECT segments FROM ActivityBounds WHERE activity_id = ?", (activity_id,)).fetchone()
+    if row is None:
+        return
+
+    cur.executemany("DELETE FROM TrackSegment WHERE segment_id = ?",
+        ((activity_id*SEGMENT_IDS + i,) for i in range(row[0])))
+    cur.execute("DELETE FROM ActivityBounds WHERE activity_id = ?", (activity_id,))
+
+
+def rebuild_tracks(cur):
+    cur.execute("DELETE FROM ActivityTrack")
+    cur.execute("DELETE FROM ActivityBounds")
+    cur.execute("DELETE FROM TrackSegment")
+
+    return (insert_track_levels, insert_track_bounds)
+
+
+def rebuild_track_bounds(cur):
+    cur.execute("DELETE FROM ActivityBounds")
+    cur.execute("DELETE FROM TrackSegment")
+
+    return (insert_track_bounds,)
+
+
+# activities handed to each backfill worker at a time
+BACKFILL_BATCH = 20
+
+
+def backfill_best_efforts(jobs=1, wal=False, db="fitdata.db"):
+    # best efforts are found at ingest, this fills them in for activities from before
+    # that. reading and searching each activity's records is spread over `jobs`
+    # processes while this one does all the writing
+    con = connect_db(wal, db)
+    cur = con.cursor()
+
+    setup_db(cur)
+    setup_indexes(cur)
+    commit(con)
+
+    missing = [row[0] for row in cur.execute("""
+        SELECT activity_id FROM Activity
+        WHERE activity_id NOT IN (SELECT activity_id FROM BestEffort)
+        """)]
+    batches = [missing[i:i+BACKFILL_BATCH] for i in range(0, len(missing), BACKFILL_BATCH)]
+
+    effort_count = 0
+    for rows in find_all_best_efforts(db, batches, jobs):
+        cur.executemany(BEST_EFFORT_INSERT, rows)
+        effort_count += len(rows)
+        commit(con)
+
+    print("-----------------------------------")
+    print(f"found {effort_count} best efforts in {len(missing)} activities")
+    print("-----------------------------------")
+    con.close()
+
+
+def find_all_best_efforts(db, batches, jobs=1):
+    # yields the best effort rows of each batch of activity ids, like parse_fitfiles
+    if jobs <= 1:
+        for batch in batches:
+            yield find_best_efforts(db, batch)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        for batch in batches:
+            pending.append(executor.submit(find_best_efforts, db, batch))
+            if len(pending) >= jobs*2:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def find_best_efforts(db, activity_ids):
+    # runs in a worker process, reading records through its own connection
+    con = sqlite3.connect(Path(db).resolve().as_uri() + "?mode=ro", uri=True)
+    cur = con.cursor()
+
+    rows = []
+    for activity_id in activity_ids:
+        rows += activity_best_efforts(activity_id, activity_records(cur, activity_id))
+
+    con.close()
+    return rows
+
+
+def migrate_records(layout, codec="zlib", wal=False, db="fitdata.db", convert=True):
+    # sets the layout (and codec) new activities' records are stored in and, with
+    # convert, moves every activity already in the db to it (re-encoding blobs when only
+    # the codec changes), then vacuums to give back the space freed. an interrupted
+    # migration leaves activities in both layouts, which are all read as normal, and
+    # carries on where it stopped when run again
+    con = connect_db(wal, db)
+    cur = con.cursor()
+
+    setup_db(cur)
+    setup_indexes(cur)
+    set_record_layout(cur, layout, codec)
+    commit(con)
+
+    if not convert:
+        con.close()
+        return
+
+    size = os.path.getsize(db)
+
+    if layout == "blob":
+        activity_ids = [row[0] for row in cur.execute("SELECT DISTINCT activity_id FROM ActivityRecord")]
+        blob_ids = [row[0] for row in cur.execute("SELECT activity_id FROM ActivityRecordBlob")]
+    else:
+        activity_ids = [row[0] for row in cur.execute("SELECT activity_id FROM ActivityRecordBlob")]
+        blob_ids = []
+
+    for i, activity_id in enumerate(activity_ids, 1):
+        if layout == "blob":
+            insert_record_blob(cur, activity_id, activity_records(cur, activity_id), codec)
+            cur.execute("DELETE FROM ActivityRecord WHERE activity_id = ?", (activity_id,))
+        else:
+            data = cur.execute("SELECT data FROM ActivityRecordBlob WHERE activity_id = ?", (activity_id,)).fetchone()[0]
+            insert_records(cur, activity_id, record_blob.to_rows(record_blob.decode(data)))
+            cur.execute("DELETE FROM ActivityRecordBlob WHERE activity_id = ?", (activity_id,))
+
+        if i % FILES_PER_COMMIT == 0:
+            commit(con)
+
+    recoded = 0
+    for activity_id in blob_ids:
+        data = cur.execute("SELECT data FROM ActivityRecordBlob WHERE activity_id = ?", (activity_id,)).fetchone()[0]
+        if record_blob.codec(data) != codec:
+            cur.execute("UPDATE ActivityRecordBlob SET data = ? WHERE activity_id = ?",
+                (record_blob.encode(record_blob.decode(data), codec), activity_id))
+            recoded += 1
+            if recoded % FILES_PER_COMMIT == 0:
+                commit(con)
+
+    commit(con)
+    cur.execute("VACUUM")
+    cur.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    print("-----------------------------------")
+    print(f"moved the records of {len(activity_ids)} activities to the {layout} layout, re-encoded {recoded} with {codec}")
+    print(f"db is now {os.path.getsize(db)/2**20:.1f} MiB, from {size/2**20:.1f} MiB")
+    print("-----------------------------------")
+    con.close()
+
+
+def export_snapshot(db, directory):
+    # memory mapped copy of the db for the server (see snapshot.py), skipped when the
+    # latest one in directory is already of the db's current generation
+    generation = cache.read_generation(db)
+    if snapshot.SnapshotWatcher().current(directory, generation) is not None:
+        return
+
+    t = time.perf_counter()
+    con = sqlite3.connect(Path(db).resolve().as_uri() + "?mode=ro", uri=True)
+    path = snapshot.export(con, directory, generation)
+    con.close()
+
+    size = sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+    print(f"exported snapshot of generation {generation} to {path}, {size/2**20:.1f} MiB in {time.perf_counter()-t:.1f}s")
+
+
+# changes to bring a db made by an older version up to date, applied in order.
+# PRAGMA user_version stores how many have been run, new indexes themselves come
+# from setup_indexes (and are built before any migration that reads records). a
+# migration rebuilding a table derived from records empties it and returns the steps,
+# step(cur, activity_id, records), filling it in for one activity. those of every
+# pending migration run after the rest in a single read of each activity's records,
+# a step shared by more than one (eg. track bounds, part of the tracks) only once
+MIGRATIONS = [
+    drop_activity_id_indexes,
+    rebuild_totals,
+    rebuild_record_levels,
+    rebuild_tracks,
+    rebuild_track_bounds,
+    rebuild_training_load,
+]
+
+
+def migrate_db(cur):
+    version = cur.execute("PRAGMA user_version").fetchone()[0]
+
+    # rebuilding what's derived from records reads each activity's through the
+    # ActivityRecord index, which a db older than it doesn't have yet (and the first
+    # migration drops the one it had). an empty db, eg. a reset, builds them once loaded
+    if version < len(MIGRATIONS) and cur.execute("SELECT 1 FROM Activity LIMIT 1").fetchone() is not None:
+        setup_indexes(cur)
+
+    steps = {}
+    for i, migration in enumerate(MIGRATIONS[version:], version+1):
+        steps.update(dict.fromkeys(migration(cur) or ()))
+        cur.execute(f"PRAGMA user_version = {i}")
+
+    if steps:
+        for (activity_id,) in cur.execute("SELECT activity_id FROM Activity").fetchall():
+            records = activity_records(cur, activity_id)
+            for step in steps:
+                step(cur, activity_id, records)
+
+    if insert_activity_load in steps:
+        update_daily_load(cur)
+
+
+ACTIVITY_INSERT = f"""INSERT INTO Activity (
+    activity_id,
+    start_time,
+    end_time ,
+    total_elapsed_time,
+    total_timer_time ,
+
+    start_position_lat , 
+    start_position_long ,
+    total_ascent ,
+    total_descent,
+
+    total_distance ,
+    total_strides ,
+    total_calories ,
+    enhanced_avg_speed,
+    avg_speed,
+    enhanced_max_speed,
+    max_speed ,
+    avg_heart_rate ,
+    max_heart_rate ,
+    avg_running_cadence ,
+    max_running_cadence ,
+    avg_fractional_cadence,
+    max_fractional_cadence,
+    total_training_effect ,
+    total_anaerobic_training_effect
+) VALUES ({"?,"*23}?) 
+"""
+
+LAP_INSERT = f"""INSERT INTO Lap (
+    lap_id,
+    activity_id,
+    start_time,
+    end_time ,
+    total_elapsed_time,
+    total_timer_time ,
+
+    start_position_lat , 
+    start_position_long ,
+    total_ascent ,
+    total_descent,
+
+    total_distance ,
+    total_strides ,
+    total_calories ,
+    enhanced_avg_speed,
+    avg_speed,
+    enhanced_max_speed,
+    max_speed ,
+    avg_heart_rate ,
+    max_heart_rate ,
+    avg_running_cadence ,
+    max_running_cadence ,
+    avg_fractional_cadence,
+    max_fractional_cadence
+) VALUES (NULL,{"?,"*21}?) 
+"""
+
+RECORD_INSERT = f"""INSERT INTO ActivityRecord(
+    record_id ,
+    activity_id,
+    timestamp ,
+    distance ,
+    enhanced_speed ,
+    speed ,
+    heart_rate ,
+    cadence,
+    fractional_cadence ,
+
+    enhanced_altitude ,
+    altitude ,
+    position_long ,
+    position_lat
+) VALUES (NULL,{"?,"*11}?) 
+"""
+
+
+def file_state(f):
+    # size and mtime are cheap to check on every update, the hash is only needed
+    # once those change (or when verifying)
+    stat = f.stat()
+    return (stat.st_size, stat.st_mtime_ns, hashlib.sha256(f.read_bytes()).hexdigest())
+
+
+def unseen_fitfiles(src, con, cur, verify=False, folder="Activity", only=None):
+    # returns {file: file_state} for the files in src/folder (or those of `only` in it)
+    # that still need parsing, using the manifest to skip everything already ingested
+    manifest = {path: (size, mtime, content_hash, activity_id) for path, size, mtime, content_hash, activity_id
+        in cur.execute("SELECT path, size, mtime, content_hash, activity_id FROM IngestManifest")}
+    known_hashes = {entry[2]: entry[3] for entry in manifest.values()}
+
+    files = Path(src, folder).iterdir()
+    if only is not None:
+        files = [f for f in only if f.parent == Path(src, folder) and f.exists()]
+
+    unseen = {}
+    for f in files:
+        entry = manifest.get(str(f.relative_to(src)))
+
+        if entry is not None and not verify:
+            stat = f.stat()
+            if (stat.st_size, stat.st_mtime_ns) == entry[:2]:
+                continue
+
+        state = file_state(f)
+
+        if entry is not None:
+            if state[2] == entry[2]:
+                # only the mtime changed (eg. copied back from a backup), contents already ingested
+                record_manifest(cur, src, f, state, entry[3])
+                continue
+
+            print(f"[FILE ERROR] fit file {f} has changed since it was added, replacing its activity.")
+            if entry[3] is not None:
+                delete_activity(cur, entry[3])
+
+        elif state[2] in known_hashes:
+            # renamed or duplicated copy of a file that's already been ingested
+            record_manifest(cur, src, f, state, known_hashes[state[2]])
+            continue
+
+        unseen[f] = state
+
+    commit(con)
+
+    return unseen
+
+
+def record_manifest(cur, src, f, state, activity_id):
+    cur.execute("INSERT OR REPLACE INTO IngestManifest (path, size, mtime, content_hash, activity_id) VALUES (?,?,?,?,?)",
+        (str(f.relative_to(src)), *state, activity_id))
+
+
+def delete_activity(cur, activity_id):
+    start_time = cur.execute("SELECT start_time FROM Activity WHERE activity_id = ?", (activity_id,)).fetchone()
+
+    cur.execute("DELETE FROM ActivityRecord WHERE activity_id = ?", (activity_id,))
+    cur.execute("DELETE FROM ActivityRecordBlob WHERE activity_id = ?", (activity_id,))
+    cur.execute("DELETE FROM Lap WHERE activity_id = ?", (activity_id,))
+    cur.execute("DELETE FROM ActivityRecordLevel WHERE activity_id = ?", (activity_id,))
+    cur.execute("DELETE FROM BestEffort WHERE activity_id = ?", (activity_id,))
+    cur.execute("DELETE FROM ActivityTrack WHERE activity_id = ?", (activity_id,))
+    delete_track_bounds(cur, activity_id)
+    cur.execute("DELETE FROM ActivityLoad WHERE activity_id = ?", (activity_id,))
+    cur.execute("DELETE FROM Activity WHERE activity_id = ?", (activity_id,))
+    cur.execute("DELETE FROM IngestManifest WHERE activity_id = ?", (activity_id,))
+
+    if start_time is not None:
+        update_totals(cur, start_time[0])
+        update_daily_load(cur, start_time[0])
+
+
+def parse_fitfiles(files, jobs=1):
+    # yields the parsed contents of each file in order. with more than one job the
+    # decoding runs in a process pool and only the plain row tuples come back to
+    # the caller, which stays the single writer to the db
+    if jobs <= 1:
+        for f in files:
+            yield parse_fitfile(f, stream=True)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        # keep a bounded number of files in flight so decoded rows don't pile up
+        # in memory faster than the writer can insert them
+        pending = deque()
+        for f in files:
+            pending.append(executor.submit(parse_fitfile, f))
+            if len(pending) >= jobs*2:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def parse_fitfile(f, stream=False):
+    # decodes a fitfile into row tuples ready for insertion. nothing here touches
+    # the db so it can run in a worker process, problems found are returned in
+    # "errors" to be reported by whoever inserts the rows.
+    # with stream=True "records" is a generator that decodes the file as it's consumed,
+    # and "activity", "laps" and "errors" are only complete once it's exhausted
+    parsed = {"file": f, "activity": None, "laps": [], "records": None, "errors": [],
+        "timings": dict.fromkeys(("parse", "validate", "insert", "derive"), 0.0)}
+
+    parsed["records"] = read_fitfile(f, parsed)
+    if not stream:
+        parsed["records"] = list(parsed["records"])
+
+    return parsed
+
+
+def read_fitfile(f, parsed):
+    # single pass over the file yielding record rows, while the session and laps are
+    # stored in `parsed`. messages are dropped as soon as they're read so memory
+    # doesn't grow with the length of the activity. time spent decoding messages and
+    # turning them into checked rows is added to parsed["timings"], not counting
+    # whatever the caller does with each row in between
+    import fitparse
+    from field_types import LapData, RecordData, SessionData, StreamingFitFile
+
+    session_error = None
+    timings = parsed["timings"]
 
     try:
-        fitfile = fitparse.FitFile(str(f.resolve()))
+        t = time.perf_counter()
+        fitfile = StreamingFitFile(str(f.resolve()))
+
+        for message in fitfile.get_messages(("record", "lap", "session")):
+            decoded = time.perf_counter()
+            timings["parse"] += decoded - t
+            row = None
+
+            if message.name == "record":
+                try:
+                    row = RecordData.row(message)
+                except ValueError as e:
+                    parsed["errors"].append(f"[RECORD ERROR] problem with a record in fit file {f}, skipping this record but continuing with file.\n{e}")
+
+            elif message.name == "lap":
+                try:
+                    parsed["laps"].append(LapData.row(message))
+                except ValueError as e:
+                    parsed["errors"].append(f"[LAP ERROR] problem with a lap in fit file {f}, skipping this lap but continuing with file.\n{e}")
+
+            # only the first session of a file is used
+            elif parsed["activity"] is None and session_error is None:
+                try:
+                    parsed["activity"] = SessionData.row(message)
+                except ValueError as e:
+                    session_error = e
+
+            t = time.perf_counter()
+            timings["validate"] += t - decoded
+            if row is not None:
+                yield row
+                t = time.perf_counter()
+
     except fitparse.FitParseError as e:
-        print(f"[FILE ERROR] failed to parse fit file {f}, skipping it.")
-        print(e)
+        parsed["activity"] = None
+        parsed["errors"] = [f"[FILE ERROR] failed to parse fit file {f}, skipping it.\n{e}"]
+
+        return
+
+    if parsed["activity"] is None:
+        parsed["errors"] = [f"[ACTIVITY ERROR] problem with activity in fit file {f}, skipping it.\n{session_error or 'no session found'}"]
+
+
+def next_activity_id(cur):
+    # the session message comes at the end of a fitfile, so to stream records into the
+    # db the activity's id has to be claimed before its row can be written. only the
+    # single writer inserts activities so the next AUTOINCREMENT value is safe to use
+    row = cur.execute("SELECT seq FROM sqlite_sequence WHERE name = 'Activity'").fetchone()
+    return (row[0] if row else 0) + 1
+
+
+def insert_records(cur, activity_id, records):
+    record_count = 0
+
+    records = iter(records)
+    while chunk := list(islice(records, RECORDS_PER_CHUNK)):
+        cur.executemany(RECORD_INSERT, ((activity_id, *record) for record in chunk))
+        record_count += len(chunk)
+
+    return record_count
+
+
+RECORD_BLOB_INSERT = "INSERT INTO ActivityRecordBlob (activity_id, record_count, data) VALUES (?,?,?)"
+
+
+def record_layout(cur):
+    # (layout, codec) new activities' records are stored with, see --record-layout
+    settings = dict(cur.execute("SELECT key, value FROM Settings WHERE key IN ('record_layout', 'record_codec')"))
+    return settings.get("record_layout", "rows"), settings.get("record_codec", "zlib")
 
-        return {"activity_count": activity_count, "lap_count": lap_count, "record_count": record_count}
+
+def set_record_layout(cur, layout, codec):
+    cur.executemany("INSERT OR REPLACE INTO Settings (key, value) VALUES (?,?)",
+        (("record_layout", layout), ("record_codec", codec)))
+
+
+def insert_record_blob(cur, activity_id, records, codec="zlib"):
+    # records: {column: array} as record_blob.from_rows or decode give them. like the
+    # UNIQUE timestamp of ActivityRecord, a file repeating a timestamp is rejected
+    timestamps = np.sort(records["timestamp"])
+    if np.any(timestamps[1:] == timestamps[:-1]):
+        raise sqlite3.IntegrityError("UNIQUE constraint failed: ActivityRecordBlob timestamp")
+
+    cur.execute(RECORD_BLOB_INSERT, (activity_id, len(timestamps), record_blob.encode(records, codec)))
+
+
+def insert_fitfile(parsed, con, cur):
+    # writes one parsed file inside a savepoint of the current transaction, so
+    # either all of the file lands in the db or none of it does. committing is left
+    # to the caller, which lets many files share one transaction
+    timings = parsed["timings"]
+    t = time.perf_counter()
+    # streamed records are decoded while they're inserted, that time goes to parsing
+    decoding = timings["parse"] + timings["validate"]
+
+    layout, codec = record_layout(cur)
+
+    if not con.in_transaction:
+        cur.execute("BEGIN")
+    cur.execute("SAVEPOINT fitfile")
 
     try:
-        session_data = SessionData(next(fitfile.get_messages("session")))
-    except ValueError as e:
-        print(f"[ACTIVITY ERROR] problem with activity in fit file {f}, skipping it.")
-        print(e)
-        
-        return {"activity_count": activity_count, "lap_count": lap_count, "record_count": record_count}
-
-    cur.execute(f"""INSERT INTO Activity (
-                activity_id,
-                start_time,
-                end_time ,
-                total_elapsed_time,
-                total_timer_time ,
-
-                start_position_lat , 
-                start_position_long ,
-                total_ascent ,
-                total_descent,
-
-                total_distance ,
-                total_strides ,
-                total_calories ,
-                enhanced_avg_speed,
-                avg_speed,
-                enhanced_max_speed,
-                max_speed ,
-                avg_heart_rate ,
-                max_heart_rate ,
-                avg_running_cadence ,
-                max_running_cadence ,
-                avg_fractional_cadence,
-                max_fractional_cadence,
-                total_training_effect ,
-                total_anaerobic_training_effect
-            ) VALUES (NULL,{"?,"*22}?) 
-            """, (
-                    session_data.start_time, 
-                    session_data.timestamp,
-                    session_data.total_elapsed_time,
-                    session_data.total_timer_time,
-                    session_data.start_position_lat,
-                    session_data.start_position_long,
-                    session_data.total_ascent,
-                    session_data.total_descent,
-                    session_data.total_distance,
-                    session_data.total_strides,
-                    session_data.total_calories,
-                    session_data.enhanced_avg_speed,
-                    session_data.avg_speed,
-                    session_data.enhanced_max_speed,
-                    session_data.max_speed,
-                    session_data.avg_heart_rate,
-                    session_data.max_heart_rate,
-                    session_data.avg_running_cadence,
-                    session_data.max_running_cadence,
-                    session_data.avg_fractional_cadence,
-                    session_data.max_fractional_cadence,
-                    session_data.total_training_effect,
-                    session_data.total_anaerobic_training_effect
-                )
-            )
-
-    # activity data was successfully parsed so can be committed to db
-    con.commit()
+        current_activity_id = next_activity_id(cur)
+        # the records are also kept as arrays while they're read, a few numbers per
+        # record, for the levels, best efforts, load and track derived from them.
+        # with the rows layout that's time spent deriving rather than inserting
+        keeping = 0.0
+        if layout == "blob":
+            records = record_blob.from_rows(parsed["records"])
+        else:
+            chunks = []
+            rows = iter(parsed["records"])
+            while chunk := list(islice(rows, RECORDS_PER_CHUNK)):
+                insert_records(cur, current_activity_id, chunk)
+                kept = time.perf_counter()
+                chunks.append(record_blob.chunk_columns(chunk))
+                keeping += time.perf_counter() - kept
+            records = record_blob.concatenate(chunks)
+        record_count = len(records["timestamp"])
 
-    activity_count+=1
-    current_activity_id = cur.lastrowid
+        if parsed["activity"] is None:
+            cur.execute("ROLLBACK TO fitfile")
+            cur.execute("RELEASE fitfile")
 
-    laps = []
-    for message in fitfile.get_messages("lap"):
-        try:
-            lap = LapData(message)
-            laps.append(lap)
-            lap_count+=1
-        except ValueError as e:
-            print(f"[LAP ERROR] problem with a lap in fit file {f}, skipping this lap but continuing with file.")
-            print(e)
+            return {"activity_count": 0, "lap_count": 0, "record_count": 0, "activity_id": None}
 
-            continue
+        cur.execute(ACTIVITY_INSERT, (current_activity_id, *parsed["activity"]))
+        cur.executemany(LAP_INSERT, ((current_activity_id, *lap) for lap in parsed["laps"]))
+        update_totals(cur, parsed["activity"][0])
+        if layout == "blob":
+            insert_record_blob(cur, current_activity_id, records, codec)
 
-    cur.executemany(f"""INSERT INTO Lap (
-        lap_id,
-        activity_id,
-        start_time,
-        end_time ,
-        total_elapsed_time,
-        total_timer_time ,
-
-        start_position_lat , 
-        start_position_long ,
-        total_ascent ,
-        total_descent,
-
-        total_distance ,
-        total_strides ,
-        total_calories ,
-        enhanced_avg_speed,
-        avg_speed,
-        enhanced_max_speed,
-        max_speed ,
-        avg_heart_rate ,
-        max_heart_rate ,
-        avg_running_cadence ,
-        max_running_cadence ,
-        avg_fractional_cadence,
-        max_fractional_cadence
-    ) VALUES (NULL,{"?,"*21}?) 
-    """, [(
-            current_activity_id,
-            lap.start_time, 
-            lap.timestamp,
-            lap.total_elapsed_time,
-            lap.total_timer_time,
-            lap.start_position_lat,
-            lap.start_position_long,
-            lap.total_ascent,
-            lap.total_descent,
-            lap.total_distance,
-            lap.total_strides,
-            lap.total_calories,
-            lap.enhanced_avg_speed,
-            lap.avg_speed,
-            lap.enhanced_max_speed,
-            lap.max_speed,
-            lap.avg_heart_rate,
-            lap.max_heart_rate,
-            lap.avg_running_cadence,
-            lap.max_running_cadence,
-            lap.avg_fractional_cadence,
-            lap.max_fractional_cadence
-        ) for lap in laps]
-    )
+        derive = time.perf_counter()
+        timings["insert"] += derive - t - (timings["parse"] + timings["validate"] - decoding) - keeping
 
-    con.commit()
+        insert_record_levels(cur, current_activity_id, records)
+        cur.executemany(BEST_EFFORT_INSERT, activity_best_efforts(current_activity_id, records))
+        insert_activity_load(cur, current_activity_id, records)
+        insert_track(cur, current_activity_id, records)
 
-    records = []
-    for message in fitfile.get_messages("record"):
-        try:
-            record = RecordData(message)
-            records.append(record)
-            record_count+=1
-        except ValueError as e:
-            print(f"[RECORD ERROR] problem with a record in fit file {f}, skipping this record but continuing with file.")
-            print(e)
+    except sqlite3.Error:
+        cur.execute("ROLLBACK TO fitfile")
+        cur.execute("RELEASE fitfile")
+        raise
 
-            continue
+    finally:
+        for error in parsed["errors"]:
+            print(error)
 
-    cur.executemany(f"""INSERT INTO ActivityRecord(
-                record_id ,
-                activity_id,
-                timestamp ,
-                distance ,
-                enhanced_speed ,
-                speed ,
-                heart_rate ,
-                cadence,
-                fractional_cadence ,
-
-                enhanced_altitude ,
-                altitude ,
-                position_long ,
-                position_lat
-            ) VALUES (NULL,{"?,"*11}?) 
-            """, [(
-                current_activity_id,
-                record.timestamp,
-                record.distance,
-                record.enhanced_speed,
-                record.speed,
-                record.heart_rate,
-                record.cadence,
-                record.fractional_cadence,
-                record.enhanced_altitude,
-                record.altitude,
-                record.position_long,
-                record.position_lat
-                ) for record in records]
-            )
+    cur.execute("RELEASE fitfile")
+    timings["derive"] += time.perf_counter() - derive + keeping
 
-    con.commit()
+    return {"activity_count": 1, "lap_count": len(parsed["laps"]), "record_count": record_count,
+            "activity_id": current_activity_id}
+
+
+MONITORING_INSERT = "INSERT OR REPLACE INTO Monitoring (series, timestamp, value) VALUES (?,?,?)"
+
+
+def insert_monitoring_files(src, files, con, cur):
+    # adds the samples of each of {file: file_state} from src/Monitor, committing
+    # every FILES_PER_COMMIT files. returns the number of samples written
+    sample_count = 0
+
+    for i, f in enumerate(files, 1):
+        parsed = monitoring.parse_monitoring_file(f)
+        for error in parsed["errors"]:
+            print(error)
+
+        cur.executemany(MONITORING_INSERT, parsed["samples"])
+        sample_count += len(parsed["samples"])
+
+        record_manifest(cur, src, f, files[f], None)
+        if i % FILES_PER_COMMIT == 0:
+            commit(con)
+
+    commit(con)
+
+    return sample_count
+
+
+def log_timings(parsed):
+    # prints the time each phase of ingesting a file took, and adds them to the metrics
+    # served at /api/_metrics when ingesting in the webapp's process
+    for phase, seconds in parsed["timings"].items():
+        metrics.registry.observe("fitdata_ingest_phase_seconds", (("phase", phase),), seconds)
+
+    print(f"[TIMINGS] {parsed['file']}: " + ", ".join(f"{phase} {seconds*1000:.1f} ms"
+        for phase, seconds in parsed["timings"].items()))
+
+
+def add_fitfile(f, con, cur, timings=False):
+    parsed = parse_fitfile(f, stream=True)
+    counts = insert_fitfile(parsed, con, cur)
+    if timings:
+        log_timings(parsed)
+    if counts["activity_id"] is not None:
+        update_daily_load(cur, parsed["activity"][0])
+    commit(con)
 
-    return {"activity_count": activity_count, "lap_count": lap_count, "record_count": record_count}
+    return counts
 
 
 
 
 
 if __name__ == '__main__':
-    sys.exit(main())
\ No newline at end of file
+    sys.exit(main())
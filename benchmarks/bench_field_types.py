@@ -0,0 +1,79 @@
+import argparse
+import datetime
+import sys
+import tempfile
+import timeit
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import fitparse
+
+from field_types import RecordData, StreamingFitFile
+from synthetic_fit import activity_fit
+
+# construction cost and retained bytes per record for the field types, comparing the
+# old __dict__ based RecordData (reproduced below) with the slotted one and with
+# building insert rows straight from messages
+
+
+class DictRecordData:
+    # RecordData as it was before the declarative field spec
+    def __init__(self, message):
+        self.timestamp = message.get_value("timestamp")
+        self.distance = message.get_value("distance")
+        self.enhanced_speed = message.get_value("enhanced_speed")
+        self.speed = message.get_value("speed")
+        self.heart_rate = message.get_value("heart_rate")
+        self.cadence = message.get_value("cadence")
+        self.fractional_cadence = message.get_value("fractional_cadence")
+
+        self.enhanced_altitude = message.get_value("enhanced_altitude")
+        self.altitude = message.get_value("altitude")
+        self.position_long = message.get_value("position_long")
+        self.position_lat = message.get_value("position_lat")
+
+        if any(v is None for v in [self.timestamp, self.distance, self.enhanced_speed,
+                                   self.speed, self.heart_rate, self.cadence, self.fractional_cadence]):
+            raise ValueError(f"message is missing required fields: {[i for i in vars(self).keys() if vars(self)[i] is None]}")
+
+        self._message = message
+
+
+def retained_bytes(f, build):
+    # memory still held once every record of the file has been built, messages are
+    # streamed so anything kept alive is down to the objects themselves
+    tracemalloc.start()
+    built = [build(message) for message in StreamingFitFile(str(f)).get_messages("record")]
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return retained / len(built)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="field type construction cost and size")
+    parser.add_argument("--seconds", default=7200, type=int, help="records in the synthetic activity")
+    parser.add_argument("--repeat", default=5, type=int)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        f = Path(tmp)/"activity.fit"
+        f.write_bytes(activity_fit(datetime.datetime(2020, 6, 1, 6), args.seconds))
+
+        messages = list(fitparse.FitFile(str(f)).get_messages("record"))
+
+        variants = (
+            ("dict RecordData (before)", DictRecordData),
+            ("slotted RecordData", RecordData),
+            ("RecordData.row", RecordData.row),
+        )
+
+        for name, build in variants:
+            seconds = min(timeit.repeat(lambda: [build(message) for message in messages], number=1, repeat=args.repeat))
+            print(f"{name:<26} {seconds/len(messages)*1e6:8.2f} us/record {retained_bytes(f, build):10.0f} bytes/record")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import app
+from synthetic_fit import write_archive
+
+# measures the db write side of ingest in records/sec on a synthetic archive. files
+# are decoded up front so only inserting is timed, comparing the old commit-per-table
+# inserts against insert_fitfile with batched commits, WAL and deferred indexes.
+# insert_fitfile also derives levels, best efforts, training load and tracks from each
+# file, which the old inserts never did, so that time is reported on its own and the
+# records/sec without it is what compares like with like
+
+
+def legacy_insert(parsed_files, con, cur):
+    # how add_fitfile wrote a file before bulk inserts: three commits per file and
+    # lists of every row built up before each executemany. returns the seconds spent
+    # deriving, none here
+    for parsed in parsed_files:
+        if parsed["activity"] is None:
+            continue
+
+        cur.execute(app.ACTIVITY_INSERT, (None, *parsed["activity"]))
+        con.commit()
+        activity_id = cur.lastrowid
+
+        cur.executemany(app.LAP_INSERT, [(activity_id, *lap) for lap in parsed["laps"]])
+        con.commit()
+
+        cur.executemany(app.RECORD_INSERT, [(activity_id, *record) for record in parsed["records"]])
+        con.commit()
+
+    return 0.0
+
+
+def bulk_insert(parsed_files, con, cur):
+    # the files' timings add up across runs, so only what this run adds is counted
+    derived = sum(parsed["timings"]["derive"] for parsed in parsed_files)
+
+    for i, parsed in enumerate(parsed_files, 1):
+        app.insert_fitfile(parsed, con, cur)
+        if i % app.FILES_PER_COMMIT == 0:
+            con.commit()
+
+    app.setup_indexes(cur)
+    con.commit()
+
+    return sum(parsed["timings"]["derive"] for parsed in parsed_files) - derived
+
+
+def run(name, parsed_files, insert, wal=False):
+    if os.path.exists("fitdata.db"):
+        os.remove("fitdata.db")
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists("fitdata.db"+suffix):
+            os.remove("fitdata.db"+suffix)
+
+    con = app.connect_db(wal)
+    cur = con.cursor()
+    app.setup_db(cur)
+
+    record_count = sum(len(parsed["records"]) for parsed in parsed_files)
+
+    t = time.perf_counter()
+    derived = insert(parsed_files, con, cur)
+    elapsed = time.perf_counter() - t
+
+    con.close()
+    print(f"{name:<32} {elapsed:8.2f}s {record_count/elapsed:12,.0f} records/sec   "
+          f"deriving {derived:6.2f}s, without it {record_count/(elapsed - derived):12,.0f} records/sec")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ingest insert throughput on a synthetic archive")
+    parser.add_argument("--activities", default=200, type=int)
+    parser.add_argument("--seconds", default=3600, type=int, help="records (1Hz samples) per activity")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        src = write_archive(Path(tmp)/"FitFiles", args.activities, args.seconds)
+        os.chdir(tmp)
+
+        parsed_files = [app.parse_fitfile(f) for f in sorted((src/"Activity").iterdir())]
+
+        run("commit per table (before)", parsed_files, legacy_insert)
+        run("single transaction", parsed_files, bulk_insert)
+        run("single transaction + WAL", parsed_files, bulk_insert, wal=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
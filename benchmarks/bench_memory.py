@@ -0,0 +1,76 @@
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import fitparse
+
+import app
+from field_types import RecordData
+from synthetic_fit import activity_fit
+
+# peak python memory while ingesting one long 1Hz activity (24h by default), comparing
+# the old approach of decoding every record into a list before inserting against the
+# streaming path used by add_fitfile
+
+
+def materialized(f, con, cur):
+    # how add_fitfile used to read records: fitparse caches every message and each
+    # RecordData kept its message alive until the whole list was inserted
+    fitfile = fitparse.FitFile(str(f))
+    records = [RecordData(message) for message in fitfile.get_messages("record")]
+
+    cur.executemany(app.RECORD_INSERT, [(1, *record.as_row()) for record in records])
+    con.rollback()
+
+    return len(records)
+
+
+def streamed(f, con, cur):
+    counts = app.add_fitfile(f, con, cur)
+
+    return counts["record_count"]
+
+
+def run(name, ingest, f):
+    if os.path.exists("fitdata.db"):
+        os.remove("fitdata.db")
+
+    con = app.connect_db()
+    cur = con.cursor()
+    app.setup_db(cur)
+
+    tracemalloc.start()
+    t = time.perf_counter()
+    record_count = ingest(f, con, cur)
+    elapsed = time.perf_counter() - t
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    con.close()
+    print(f"{name:<14} {record_count:>8} records {elapsed:8.2f}s  peak {peak/2**20:8.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="peak memory ingesting one long activity")
+    parser.add_argument("--hours", default=24, type=float)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        f = Path(tmp)/"long.fit"
+        f.write_bytes(activity_fit(datetime.datetime(2020, 6, 1, 6), int(args.hours*3600), laps=int(args.hours)))
+        print(f"{f.stat().st_size/2**20:.1f} MiB synthetic fitfile, {args.hours}h at 1Hz")
+
+        run("materialized", materialized, f)
+        run("streamed", streamed, f)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,101 @@
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import app
+from server import app as flask_app
+from synthetic_fit import write_archive
+
+# requests/sec for the api routes through flask's test client against a db built
+# from a synthetic archive, with connection reuse off (a connect per request, as
+# before the pool) and on, with metrics recorded (--metrics), then with the response
+# cache, with conditional requests revalidating an etag and reading a memory mapped
+# snapshot (--snapshot) instead of the db. lastly a dashboard load,
+# every chart column fetched one /api/summary request at a time against all of them
+# from one /api/summary/columns request
+
+
+# the columns static/index.js charts
+DASHBOARD_COLUMNS = ("total_distance", "total_timer_time", "enhanced_avg_speed", "avg_heart_rate",
+    "enhanced_max_speed", "max_heart_rate", "total_ascent", "total_descent", "avg_running_cadence",
+    "total_training_effect", "total_anaerobic_training_effect")
+
+
+def measure(client, url, requests, conditional=False):
+    headers = {}
+    if conditional:
+        headers["If-None-Match"] = client.get(url).headers["ETag"]
+
+    t = time.perf_counter()
+    for _ in range(requests):
+        response = client.get(url, headers=headers)
+        assert response.status_code == (304 if conditional else 200), response.status_code
+    return requests / (time.perf_counter() - t)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="api requests/sec with the flask test client")
+    parser.add_argument("--activities", default=100, type=int)
+    parser.add_argument("--seconds", default=1800, type=int, help="records (1Hz samples) per activity")
+    parser.add_argument("--requests", default=500, type=int, help="requests per route and configuration")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        src = write_archive(Path(tmp)/"FitFiles", args.activities, args.seconds)
+        db = str(Path(tmp)/"fitdata.db")
+        with contextlib.redirect_stdout(io.StringIO()):
+            app.reset_db(str(src), jobs=os.cpu_count(), db=db)
+            app.export_snapshot(db, str(Path(tmp)/"snapshot"))
+
+        flask_app.config["DB_PATH"] = db
+        client = flask_app.test_client()
+        start_time = client.get("/api/summary").get_json()[-1][0]
+
+        routes = (
+            "/api/summary",
+            "/api/summary/totals?group_by=week",
+            f"/api/activity/{start_time}/records",
+            f"/api/activity/{start_time}/records?format=columnar",
+        )
+
+        configurations = (
+            ("connect per request", 0, 0, False, False, None),
+            ("pooled", 8, 0, False, False, None),
+            ("pooled, metrics", 8, 0, False, True, None),
+            ("snapshot", 8, 0, False, False, str(Path(tmp)/"snapshot")),
+            ("response cache", 8, 64 * 1024 * 1024, False, False, None),
+            ("if-none-match", 8, 64 * 1024 * 1024, True, False, None),
+        )
+
+        for name, pool_size, cache_bytes, conditional, metrics, snapshot in configurations:
+            flask_app.config["DB_POOL_SIZE"] = pool_size
+            flask_app.config["RESPONSE_CACHE_BYTES"] = cache_bytes
+            flask_app.config["METRICS"] = metrics
+            flask_app.config["SNAPSHOT_PATH"] = snapshot
+            for url in routes:
+                print(f"{name:<20} {url:<64} {measure(client, url, args.requests, conditional):10.1f} req/s")
+
+        flask_app.config["DB_POOL_SIZE"] = 8
+        flask_app.config["RESPONSE_CACHE_BYTES"] = 0
+        flask_app.config["METRICS"] = False
+        flask_app.config["SNAPSHOT_PATH"] = None
+        for name, urls in (
+                ("per column", [f"/api/summary?{column}" for column in DASHBOARD_COLUMNS]),
+                ("batched", [f"/api/summary/columns?columns={','.join(DASHBOARD_COLUMNS)}"])):
+            t = time.perf_counter()
+            for _ in range(args.requests // 10):
+                for url in urls:
+                    assert client.get(url).status_code == 200
+            elapsed = (time.perf_counter() - t) / (args.requests // 10)
+            print(f"dashboard load, {name:<10} {len(urls):3} requests {elapsed*1000:10.2f} ms")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
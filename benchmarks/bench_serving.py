@@ -0,0 +1,125 @@
+import argparse
+import contextlib
+import http.client
+import io
+import json
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import numpy as np
+
+import app
+from synthetic_fit import write_archive
+
+# requests/sec and p50/p99 latency of `app.py -r` over http, as the single process
+# development server and pre-forked with --workers, for api routes and the static
+# files the summary page loads. each configuration runs app.py in its own process,
+# loaded by --clients client processes each making one request after another for
+# --duration seconds, then is stopped with SIGTERM and timed shutting down. bytes is
+# what went over the wire for a browser accepting gzip
+
+APP = Path(__file__).resolve().parent.parent/"app.py"
+
+
+def request(port, url):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        connection.request("GET", url, headers={"Accept-Encoding": "gzip, deflate"})
+        response = connection.getresponse()
+        return response.status, len(response.read())
+    finally:
+        connection.close()
+
+
+def client(port, url, duration):
+    # latencies of the requests made until duration has passed, and the bytes of the last
+    times = []
+    size = 0
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        t = time.perf_counter()
+        status, size = request(port, url)
+        times.append(time.perf_counter() - t)
+        assert status == 200, (url, status)
+    return times, size
+
+
+def start_server(db, port, workers):
+    argv = [sys.executable, str(APP), "-r", "-db", db, "--port", str(port)]
+    if workers:
+        argv += ["--workers", str(workers)]
+    server = subprocess.Popen(argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    while True:
+        if server.poll() is not None:
+            raise RuntimeError(f"{' '.join(argv)} exited with {server.returncode}")
+        try:
+            if request(port, "/api/summary")[0] == 200:
+                return server
+        except OSError:
+            time.sleep(0.1)
+
+
+def app_start_time(port):
+    # the latest activity's start time, quoted for a url
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        connection.request("GET", "/api/summary")
+        return json.loads(connection.getresponse().read())[-1][0].replace(" ", "%20")
+    finally:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="http requests/sec of the development server against --workers")
+    parser.add_argument("--activities", default=100, type=int)
+    parser.add_argument("--seconds", default=1800, type=int, help="records (1Hz samples) per activity")
+    parser.add_argument("--workers", default=[1, 2, 4], type=int, nargs="+", help="worker counts compared")
+    parser.add_argument("--clients", default=8, type=int, help="client processes making requests at once")
+    parser.add_argument("--duration", default=3.0, type=float, help="seconds each route is loaded for")
+    parser.add_argument("--port", default=5077, type=int)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        src = write_archive(Path(tmp)/"FitFiles", args.activities, args.seconds)
+        db = str(Path(tmp)/"fitdata.db")
+        with contextlib.redirect_stdout(io.StringIO()):
+            app.reset_db(str(src), jobs=os.cpu_count(), db=db)
+
+        for workers in [0, *args.workers]:
+            name = f"{workers} workers" if workers else "dev server"
+            server = start_server(db, args.port, workers)
+            try:
+                start_time = app_start_time(args.port)
+                routes = (
+                    "/",
+                    "/index.js",
+                    "/api/summary",
+                    "/api/summary/totals?group_by=week",
+                    f"/api/activity/{start_time}/records",
+                    f"/api/activity/{start_time}/records?format=columnar",
+                )
+                with multiprocessing.Pool(args.clients) as pool:
+                    for url in routes:
+                        results = pool.starmap(client, [(args.port, url, args.duration)] * args.clients)
+                        times = [t for result, _ in results for t in result]
+                        print(f"{name:<12} {url:<64} {len(times) / args.duration:10.1f} req/s  "
+                              f"p50 {np.percentile(times, 50)*1000:7.2f} ms  p99 {np.percentile(times, 99)*1000:7.2f} ms  "
+                              f"{results[0][1]:9} bytes")
+            finally:
+                t = time.perf_counter()
+                server.send_signal(signal.SIGTERM if workers else signal.SIGINT)
+                server.wait()
+                print(f"{name:<12} stopped in {(time.perf_counter() - t)*1000:.0f} ms")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
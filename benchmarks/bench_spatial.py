@@ -0,0 +1,158 @@
+import argparse
+import datetime
+import math
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import numpy as np
+
+import app
+import track
+from server import app as flask_app
+
+# "activities near here" and "same route" lookups on a synthetic archive (10k activities
+# by default) spread over a few hundred routes around a city, through the r*tree spatial
+# index and, for comparison, by measuring against every stored track. activities are
+# written straight to the db rather than through fitfiles, decoding that many files
+# would take far longer than anything measured here
+
+CENTRE = (51.5, -0.1)
+
+
+def base_route(rng, points):
+    # a wandering loop-ish run starting somewhere within ~5km of the centre, at ~3m/s
+    lat = CENTRE[0] + rng.uniform(-0.045, 0.045)
+    long = CENTRE[1] + rng.uniform(-0.07, 0.07)
+    heading = rng.uniform(0, 2*math.pi)
+
+    lats, longs = [], []
+    for _ in range(points):
+        heading += rng.uniform(-0.05, 0.05)
+        lat += 3 * math.cos(heading) / 111195
+        long += 3 * math.sin(heading) / (111195 * math.cos(math.radians(lat)))
+        lats.append(lat)
+        longs.append(long)
+
+    return np.array(lats), np.array(longs)
+
+
+def activity_track(rng, route):
+    # a run of a route with a couple of metres of gps noise, sometimes the other way round
+    lat, long = route
+    noise = np.random.default_rng(rng.randrange(2**32)).normal(0, 2 / 111195, (2, len(lat)))
+    lat, long = lat + noise[0], long + noise[1]
+    if rng.random() < 0.3:
+        lat, long = lat[::-1], long[::-1]
+    return lat, long
+
+
+def build_db(db, activities, routes, points, seed=0):
+    rng = random.Random(seed)
+    base_routes = [base_route(rng, points) for _ in range(routes)]
+
+    con = app.connect_db(db=db)
+    cur = con.cursor()
+    app.setup_db(cur)
+    app.setup_indexes(cur)
+
+    first_day = datetime.datetime(2000, 1, 1, 7)
+    t = time.perf_counter()
+    for activity_id in range(1, activities+1):
+        lat, long = activity_track(rng, base_routes[rng.randrange(routes)])
+        start = first_day + datetime.timedelta(hours=activity_id)
+        cur.execute(app.ACTIVITY_INSERT, (activity_id, start, start + datetime.timedelta(seconds=points),
+            points, points, None, None, 0, 0, points*3.0, 0, 0, 3.0, 3.0, 3.0, 3.0, 140, 160, 85, 90, 0.0, 0.0, 3.0, 1.0))
+
+        app.insert_track(cur, activity_id, {
+            "position_lat": np.round(lat / track.SEMICIRCLES_TO_DEGREES),
+            "position_long": np.round(long / track.SEMICIRCLES_TO_DEGREES),
+        })
+    con.commit()
+    build = time.perf_counter() - t
+
+    con.close()
+    return base_routes, build
+
+
+def near_scan(cur, lat, lon, radius):
+    # the same answer as /api/activities/near, measuring the point against every track
+    q = []
+    for start_time, total_distance, polyline in cur.execute("""
+            SELECT start_time, total_distance, polyline FROM ActivityTrack
+            JOIN Activity USING (activity_id) WHERE tolerance = ? ORDER BY start_time
+            """, (track.TOLERANCES[0],)):
+        closest = float(track.distance_to_line(np.array([lat]), np.array([lon]), *track.decode_polyline(polyline))[0])
+        if closest <= radius:
+            q.append([start_time, total_distance, closest])
+    return q
+
+
+def similar_scan(cur, start_time, threshold):
+    # the same answer as /api/activity/<datetime>/similar, comparing against every track
+    activity_id, polyline = cur.execute("""
+        SELECT activity_id, polyline FROM ActivityTrack JOIN Activity USING (activity_id)
+        WHERE start_time = ? AND tolerance = ?""", (start_time, track.TOLERANCES[1])).fetchone()
+    route = track.decode_polyline(polyline)
+
+    q = []
+    for other_start_time, total_distance, polyline in cur.execute("""
+            SELECT start_time, total_distance, polyline FROM ActivityTrack JOIN Activity USING (activity_id)
+            WHERE tolerance = ? AND activity_id != ?""", (track.TOLERANCES[1], activity_id)):
+        difference = track.route_difference(route, track.decode_polyline(polyline))
+        if difference <= threshold:
+            q.append([other_start_time, total_distance, difference])
+    return sorted(q, key=lambda row: row[2])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="spatial index lookups against a synthetic archive")
+    parser.add_argument("--activities", default=10000, type=int)
+    parser.add_argument("--routes", default=300, type=int, help="distinct routes the activities are spread over")
+    parser.add_argument("--points", default=1800, type=int, help="gps points (1Hz) per activity")
+    parser.add_argument("--queries", default=20, type=int)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = str(Path(tmp)/"fitdata.db")
+        base_routes, build = build_db(db, args.activities, args.routes, args.points)
+        print(f"tracks, levels and spatial index for {args.activities} activities: {build:.1f}s "
+              f"({build/args.activities*1000:.2f} ms/activity)")
+
+        flask_app.config["DB_PATH"] = db
+        flask_app.config["RESPONSE_CACHE_BYTES"] = 0
+        client = flask_app.test_client()
+        cur = sqlite3.connect(db).cursor()
+
+        rng = random.Random(1)
+        points = []
+        for _ in range(args.queries):
+            lat, long = base_routes[rng.randrange(args.routes)]
+            i = rng.randrange(len(lat))
+            points.append((lat[i], long[i]))
+
+        for name, lookup in (
+                ("near, r*tree", lambda lat, lon: client.get(f"/api/activities/near?lat={lat}&lon={lon}&radius=100").get_json()),
+                ("near, every track", lambda lat, lon: near_scan(cur, lat, lon, 100))):
+            t = time.perf_counter()
+            found = sum(len(lookup(lat, lon)) for lat, lon in points)
+            elapsed = (time.perf_counter() - t) / len(points)
+            print(f"{name:<24} {elapsed*1000:10.2f} ms/query {found/len(points):8.1f} activities found")
+
+        start_times = [row[0] for row in cur.execute("SELECT start_time FROM Activity ORDER BY random() LIMIT ?", (args.queries,))]
+        for name, lookup in (
+                ("similar, r*tree", lambda start_time: client.get(f"/api/activity/{start_time}/similar?threshold=50").get_json()),
+                ("similar, every track", lambda start_time: similar_scan(cur, start_time, 50))):
+            t = time.perf_counter()
+            found = sum(len(lookup(start_time)) for start_time in start_times)
+            elapsed = (time.perf_counter() - t) / len(start_times)
+            print(f"{name:<24} {elapsed*1000:10.2f} ms/query {found/len(start_times):8.1f} activities found")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
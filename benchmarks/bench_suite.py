@@ -0,0 +1,221 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import numpy as np
+
+from synthetic_fit import activity_fit, write_archive
+
+# end to end numbers for a synthetic archive, to compare across commits: ingest
+# throughput of a reset (-t) and of an update (-u) adding new files, db size, peak
+# memory, and p50/p99 latency of every api route checked by check_query_plans.py. the
+# ingest and serving phases each run in a fresh process so their peak rss is their own.
+# results are printed and saved as json, and --compare prints the change from an
+# earlier run's json
+#
+#   python benchmarks/bench_suite.py --output before.json
+#   python benchmarks/bench_suite.py --output after.json --compare before.json
+
+FIRST_DAY = datetime.datetime(2015, 1, 1, 7)
+
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    # MiB, ru_maxrss is in KiB on linux but bytes on macos
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+
+def db_bytes(db):
+    return sum(os.path.getsize(db + suffix) for suffix in ("", "-wal") if os.path.exists(db + suffix))
+
+
+# records in the db, whichever layout they're stored in
+RECORD_COUNT = "(SELECT count(*) FROM ActivityRecord) + (SELECT coalesce(sum(record_count), 0) FROM ActivityRecordBlob)"
+
+
+def ingest_phase(args, work):
+    import app
+
+    src, db = str(work/"FitFiles"), str(work/"fitdata.db")
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        app.migrate_records(args.record_layout, args.codec, args.wal, db, convert=False)
+        t = time.perf_counter()
+        app.reset_db(src, args.jobs, args.wal, db)
+        reset = time.perf_counter() - t
+
+    con = sqlite3.connect(db)
+    activities, records = con.execute(f"SELECT (SELECT count(*) FROM Activity), {RECORD_COUNT}").fetchone()
+    files = con.execute("SELECT count(*) FROM IngestManifest").fetchone()[0]
+    size = db_bytes(db)
+
+    # files turning up after the reset, as a watch sync adds them
+    first_new = FIRST_DAY + datetime.timedelta(days=args.activities + args.malformed)
+    for i in range(args.new):
+        start = first_new + datetime.timedelta(days=i)
+        Path(src, "Activity", f"{start:%Y-%m-%d-%H-%M-%S}.fit").write_bytes(activity_fit(start, args.seconds, 3, seed=10**6+i))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        t = time.perf_counter()
+        app.update_db(src, args.jobs, False, args.wal, db)
+        update = time.perf_counter() - t
+
+    new_records = con.execute(f"SELECT {RECORD_COUNT}").fetchone()[0] - records
+    con.close()
+
+    return {
+        "reset_seconds": reset,
+        "reset_files": files,
+        "reset_activities": activities,
+        "reset_records_per_second": records / reset,
+        "reset_files_per_second": files / reset,
+        "update_seconds": update,
+        "update_ms_per_file": update / max(args.new, 1) * 1000,
+        "update_records_per_second": new_records / update,
+        "db_bytes": size,
+        "db_bytes_per_record": size / max(records, 1),
+        "peak_rss_mib": peak_rss(),
+        "worker_peak_rss_mib": peak_rss(resource.RUSAGE_CHILDREN),
+    }
+
+
+def serve_phase(args, work):
+    from check_query_plans import routes
+    from server import app as flask_app
+
+    flask_app.config["DB_PATH"] = str(work/"fitdata.db")
+    # every request does the work, the cache would only measure a dict lookup
+    flask_app.config["RESPONSE_CACHE_BYTES"] = 0
+    client = flask_app.test_client()
+    start_time = client.get("/api/summary").get_json()[0][0]
+
+    q = {}
+    for url in routes(start_time):
+        response = client.get(url)
+        assert response.status_code == 200, (url, response.status_code)
+
+        times = []
+        for _ in range(args.requests):
+            t = time.perf_counter()
+            client.get(url)
+            times.append(time.perf_counter() - t)
+
+        # start times vary with the archive, the route shape is what's compared
+        key = url.replace(start_time, "<start_time>")
+        q[key] = {
+            "p50_ms": float(np.percentile(times, 50)) * 1000,
+            "p99_ms": float(np.percentile(times, 99)) * 1000,
+            "bytes": len(response.get_data()),
+        }
+
+    return {"routes": q, "peak_rss_mib": peak_rss()}
+
+
+PHASES = {"ingest": ingest_phase, "serve": serve_phase}
+
+
+def run_phase(name, work):
+    # runs this script again for one phase, which prints its results as json
+    out = subprocess.run([sys.executable, __file__, *sys.argv[1:], "--phase", name, "--work", str(work)],
+        check=True, stdout=subprocess.PIPE, text=True).stdout
+    return json.loads(out.splitlines()[-1])
+
+
+def flatten(results, prefix=""):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f"{prefix}{key}", value
+
+
+def compare(previous, results):
+    old = dict(flatten({k: previous.get(k, {}) for k in ("archive", "ingest", "serve")}))
+    print(f"-- change from {previous.get('commit')} ({previous.get('date')})")
+    for key, value in flatten({k: results[k] for k in ("archive", "ingest", "serve")}):
+        if key in old and old[key]:
+            print(f"{key:<100} {old[key]:14.3f} {value:14.3f} {(value/old[key] - 1)*100:+8.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="end to end ingest and api benchmarks, saved as json")
+    parser.add_argument("--activities", default=200, type=int)
+    parser.add_argument("--seconds", default=1800, type=int, help="records (1Hz samples) per activity, varied +-50%%")
+    parser.add_argument("--malformed", default=12, type=int, help="broken activity files mixed in")
+    parser.add_argument("--monitor-days", default=14, type=int)
+    parser.add_argument("--new", default=10, type=int, help="activity files added by an update after the reset")
+    parser.add_argument("-j", "--jobs", default=os.cpu_count(), type=int)
+    parser.add_argument("--wal", default=False, action="store_true")
+    parser.add_argument("--record-layout", default="rows", choices=("rows", "blob"))
+    parser.add_argument("--codec", default="zlib", choices=("zlib", "lzma"))
+    parser.add_argument("--requests", default=100, type=int, help="timed requests per route")
+    parser.add_argument("--output", default="bench_results.json", help="json file the results are written to")
+    parser.add_argument("--compare", default=None, help="json from an earlier run to compare against")
+    parser.add_argument("--phase", default=None, choices=PHASES, help=argparse.SUPPRESS)
+    parser.add_argument("--work", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.phase is not None:
+        print(json.dumps(PHASES[args.phase](args, Path(args.work))))
+        return 0
+
+    with tempfile.TemporaryDirectory() as tmp:
+        work = Path(tmp)
+        t = time.perf_counter()
+        src = write_archive(work/"FitFiles", args.activities, args.seconds, first_day=FIRST_DAY,
+            monitor_days=args.monitor_days, malformed=args.malformed, vary=True)
+        archive = {
+            "seconds_to_write": time.perf_counter() - t,
+            "files": sum(1 for _ in src.glob("*/*")),
+            "bytes": sum(f.stat().st_size for f in src.glob("*/*")),
+        }
+
+        ingest = run_phase("ingest", work)
+        serve = run_phase("serve", work)
+
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent,
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.strip() or None
+    results = {
+        "commit": commit,
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "cpus": os.cpu_count(),
+        "args": {k: v for k, v in vars(args).items() if k not in ("output", "compare", "phase", "work")},
+        "archive": archive,
+        "ingest": ingest,
+        "serve": serve,
+    }
+
+    print(f"archive   {archive['files']} files, {archive['bytes']/2**20:.1f} MiB")
+    print(f"reset     {ingest['reset_seconds']:.2f}s, {ingest['reset_records_per_second']:,.0f} records/s, "
+          f"{ingest['reset_files_per_second']:.1f} files/s, peak rss {ingest['peak_rss_mib']:.0f} MiB "
+          f"(workers {ingest['worker_peak_rss_mib']:.0f} MiB)")
+    print(f"update    {ingest['update_ms_per_file']:.1f} ms/file, {ingest['update_records_per_second']:,.0f} records/s")
+    print(f"db        {ingest['db_bytes']/2**20:.1f} MiB, {ingest['db_bytes_per_record']:.0f} bytes/record")
+    print(f"serving   peak rss {serve['peak_rss_mib']:.0f} MiB")
+    for url, timing in serve["routes"].items():
+        print(f"  {url:<100} p50 {timing['p50_ms']:8.2f} ms  p99 {timing['p99_ms']:8.2f} ms")
+
+    Path(args.output).write_text(json.dumps(results, indent=2))
+    print(f"results written to {args.output}")
+
+    if args.compare:
+        compare(json.loads(Path(args.compare).read_text()), results)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+import argparse
+import contextlib
+import datetime
+import io
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import app
+import watcher
+from server import app as flask_app
+from synthetic_fit import activity_fit, monitoring_fit, write_archive
+
+# background ingest as `app.py -w` runs it: activity files are dropped into a watched
+# archive one at a time while requests keep coming, measuring how long each takes to
+# show up in /api/summary and how long requests take meanwhile
+
+
+def main():
+    parser = argparse.ArgumentParser(description="time from a fitfile arriving to it being served")
+    parser.add_argument("--activities", default=50, type=int, help="activities already in the db")
+    parser.add_argument("--new", default=10, type=int, help="activity files added while watching")
+    parser.add_argument("--seconds", default=1800, type=int, help="records (1Hz samples) per activity")
+    parser.add_argument("--poll-interval", default=0.5, type=float)
+    parser.add_argument("--wal", default=False, action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+        src = write_archive(Path(tmp)/"FitFiles", args.activities, args.seconds)
+        db = str(Path(tmp)/"fitdata.db")
+        app.reset_db(str(src), jobs=os.cpu_count(), wal=args.wal, db=db)
+
+        ingest_watcher = watcher.IngestWatcher((src/"Activity", src/"Monitor"),
+            lambda files: app.update_db(str(src), 1, False, args.wal, db, only=files), args.poll_interval)
+        ingest_watcher.prime()
+        ingest_watcher.start()
+
+        flask_app.config["DB_PATH"] = db
+        flask_app.config["INGEST_WATCHER"] = ingest_watcher
+        client = flask_app.test_client()
+
+        visible_after, request_times = [], []
+        first_day = datetime.datetime(2015, 1, 1, 7) + datetime.timedelta(days=args.activities)
+        for i in range(args.new):
+            start = first_day + datetime.timedelta(days=i)
+            (src/"Activity"/f"{start:%Y-%m-%d-%H-%M-%S}.fit").write_bytes(activity_fit(start, args.seconds, seed=args.activities+i))
+            added = time.perf_counter()
+
+            while True:
+                t = time.perf_counter()
+                activities = client.get("/api/summary").get_json()
+                request_times.append(time.perf_counter() - t)
+                if len(activities) == args.activities + i + 1:
+                    break
+                time.sleep(0.01)
+            visible_after.append(time.perf_counter() - added)
+
+        # a day of monitoring samples goes through the same queue
+        (src/"Monitor"/"new.fit").write_bytes(monitoring_fit(first_day))
+        while ingest_watcher.status()["files_ingested"] < args.new + 1:
+            time.sleep(0.01)
+
+        ingest_watcher.stop()
+        status = client.get("/api/ingest").get_json()
+
+    print(f"poll interval {args.poll_interval}s, {args.activities} activities in the db, {args.new} added while watching")
+    print(f"file written to activity served: median {statistics.median(visible_after):.2f}s, max {max(visible_after):.2f}s")
+    print(f"/api/summary during ingest: {len(request_times)} requests, median {statistics.median(request_times)*1000:.2f} ms, "
+          f"max {max(request_times)*1000:.2f} ms")
+    print(f"ingest status: {status}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
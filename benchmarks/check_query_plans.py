@@ -0,0 +1,114 @@
+import contextlib
+import io
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import app
+from server import app as flask_app, get_db
+from synthetic_fit import write_archive
+
+# requests every api route against a small synthetic db, captures the sql each one
+# runs and checks EXPLAIN QUERY PLAN for it, so a query change that falls back to
+# scanning the per-record or per-lap tables fails here. exits non-zero on a regression
+
+# tables that must only ever be searched through an index
+INDEXED_ONLY = ("ActivityRecord", "ActivityRecordBlob", "Lap", "ActivityTotals", "ActivityRecordLevel", "BestEffort", "Monitoring", "ActivityTrack", "ActivityLoad", "DailyLoad")
+
+# tables whose rows must come from a covering index, never the table itself
+COVERED = ("ActivityRecord",)
+
+
+def routes(start_time):
+    return (
+        "/api/summary",
+        "/api/summary?avg_speed&avg_heart_rate&start=2015-01-01&end=2015-02-01",
+        "/api/summary/totals?group_by=all",
+        "/api/summary/totals?group_by=week",
+        "/api/summary/totals?group_by=month&start=2015-01-01&end=2016-01-01",
+        "/api/summary/totals?group_by=year",
+        "/api/summary/personalrecords",
+        "/api/monitoring?heart_rate&steps&stress_level&start=2015-01-01&end=2015-01-02&interval=900",
+        "/api/summary/personalrecords?limit=3&start=2015-01-02&end=2016-01-01",
+        f"/api/activity/{start_time}/totals",
+        f"/api/activity/{start_time}/records",
+        f"/api/activity/{start_time}/records?max_points=100",
+        f"/api/activity/{start_time}/records?max_points=2000",
+        f"/api/activity/{start_time}/records?max_points=2000&format=columnar",
+        f"/api/activity/{start_time}/records?lap=2",
+        f"/api/activity/{start_time}/records?lap=2&max_points=100&format=columnar",
+        f"/api/activity/{start_time}/laps",
+        f"/api/activity/{start_time}/track",
+        f"/api/activity/{start_time}/track?tolerance=1",
+        f"/api/activity/{start_time}/similar",
+        f"/api/activity/{start_time}/load",
+        "/api/summary/trainingload?start=2015-01-02&end=2015-02-01",
+        "/api/activities/near?lat=51.5&lon=-0.1&radius=200",
+        "/api/summary?avg_speed&end_time&format=columnar",
+        "/api/summary?start_time&avg_speed&format=columnar",
+        "/api/summary/columns?columns=total_distance,avg_heart_rate&moving_average=7",
+        "/api/summary/columns?columns=total_distance&group_by=month&start=2015-01-01&end=2016-01-01&format=columnar",
+    )
+
+
+def plan_problems(plan):
+    problems = []
+    for row in plan:
+        detail = row[-1]
+        step, table = (detail.split() + [""])[:2]
+        if step == "SCAN" and table in INDEXED_ONLY:
+            problems.append(f"full scan of {table}: {detail}")
+        if step == "SEARCH" and table in COVERED and "COVERING INDEX" not in detail:
+            problems.append(f"{table} read from the table rather than a covering index: {detail}")
+    return problems
+
+
+def main():
+    statements = []
+
+    @flask_app.before_request
+    def trace_statements():
+        get_db().set_trace_callback(statements.append)
+
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        src = write_archive(Path(tmp)/"FitFiles", 3, 300, monitor_days=2)
+        db = str(Path(tmp)/"fitdata.db")
+        with contextlib.redirect_stdout(io.StringIO()):
+            app.reset_db(str(src), db=db)
+
+        flask_app.config["DB_PATH"] = db
+        # every request has to reach sqlite for its statements to be traced
+        flask_app.config["RESPONSE_CACHE_BYTES"] = 0
+        client = flask_app.test_client()
+        start_time = client.get("/api/summary").get_json()[0][0]
+
+        for url in routes(start_time):
+            statements.clear()
+            response = client.get(url)
+            if response.status_code != 200:
+                print(f"FAIL {url}: status {response.status_code}")
+                failures += 1
+                continue
+
+            con = app.connect_db(db=db)
+            for sql in statements:
+                if not sql.lstrip().upper().startswith("SELECT"):
+                    continue
+
+                plan = con.execute("EXPLAIN QUERY PLAN " + sql).fetchall()
+                problems = plan_problems(plan)
+                for problem in problems:
+                    print(f"FAIL {url}: {problem}")
+                failures += len(problems)
+                if not problems:
+                    print(f"ok   {url}: {'; '.join(row[-1] for row in plan)}")
+            con.close()
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
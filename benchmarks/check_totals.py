@@ -0,0 +1,123 @@
+import contextlib
+import datetime
+import io
+import random
+import sqlite3
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import app
+from server import app as flask_app
+from synthetic_fit import write_archive
+
+# /api/summary/totals answers from the ActivityTotals rollups kept by ingest, which
+# have to give exactly what grouping Activity did before them, floats included. this
+# compares the route with that query over random ranges on a synthetic db as ingested,
+# after `app.py -u` backfills the rollups of a db made before them and after deleting
+# activities, each read from the db and from a snapshot (`--snapshot`) of it. exits
+# non-zero on any difference
+
+# the route's query before the rollups
+GROUPED = """
+    select
+        date(start_time, ?) summary_date,
+        count(*) as num_activities,
+        sum(total_distance) as total_distance,
+        sum(total_timer_time) as total_time
+    from Activity
+    where start_time between ? and ?
+    group by summary_date;
+"""
+
+# user_version of a db from before the migration backfilling ActivityTotals
+TOTALS_MIGRATION = app.MIGRATIONS.index(app.rebuild_totals)
+
+
+def ranges(rng, count):
+    # the route's default range, then random ones around the synthetic activities' days
+    yield "0001-01-01", "9999-01-01"
+    for _ in range(count):
+        days = sorted(rng.sample(range(-30, 500), 2))
+        yield tuple(str(datetime.date(2015, 1, 1) + datetime.timedelta(days=day)) for day in days)
+
+
+def compare(db, rng, count, snapshot=None):
+    failures = 0
+    flask_app.config["SNAPSHOT_PATH"] = snapshot
+    if snapshot is not None:
+        with contextlib.redirect_stdout(io.StringIO()):
+            app.export_snapshot(db, snapshot)
+
+    client = flask_app.test_client()
+    con = sqlite3.connect(db)
+    for start, end in ranges(rng, count):
+        for group_by, (modifier, _, _) in app.TOTALS_PERIODS.items():
+            expected = [list(row) for row in con.execute(GROUPED, (modifier, start, end))]
+            got = client.get(f"/api/summary/totals?group_by={group_by}&start={start}&end={end}").get_json()
+            if got != expected:
+                print(f"FAIL {group_by} {start}..{end}: {got} != {expected}")
+                failures += 1
+        expected = [list(con.execute("SELECT count(*), sum(total_distance), sum(total_timer_time) "
+            "FROM Activity WHERE start_time BETWEEN ? AND ?", (start, end)).fetchone())]
+        got = client.get(f"/api/summary/totals?group_by=all&start={start}&end={end}").get_json()
+        if got != expected:
+            print(f"FAIL all {start}..{end}: {got} != {expected}")
+            failures += 1
+    con.close()
+    return failures
+
+
+def check(name, db, rng, snapshot):
+    # the route read from the db, then from a snapshot of it
+    failures = 0
+    for source, path in (("db", None), ("snapshot", snapshot)):
+        failed = compare(db, rng, 50, path)
+        print(f"{name:<10} {source:<10}", "ok" if not failed else "FAIL")
+        failures += failed
+    return failures
+
+
+def main():
+    rng = random.Random(0)
+    flask_app.config["RESPONSE_CACHE_BYTES"] = 0
+
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        # files are ingested in directory order, so rowids don't follow start_time
+        src = write_archive(Path(tmp)/"FitFiles", 400, 120, vary=True)
+        db = str(Path(tmp)/"fitdata.db")
+        flask_app.config["DB_PATH"] = db
+        with contextlib.redirect_stdout(io.StringIO()):
+            app.reset_db(str(src), db=db)
+
+        snapshot = str(Path(tmp)/"snapshot")
+        failures += check("ingested", db, rng, snapshot)
+
+        # as a db from before ActivityTotals, upgraded
+        con = app.connect_db(db=db)
+        con.execute("DROP TABLE ActivityTotals")
+        con.execute(f"PRAGMA user_version = {TOTALS_MIGRATION}")
+        app.commit(con)
+        con.close()
+        with contextlib.redirect_stdout(io.StringIO()):
+            app.update_db(str(src), db=db)
+
+        failures += check("upgraded", db, rng, snapshot)
+
+        con = app.connect_db(db=db)
+        ids = [row[0] for row in con.execute("SELECT activity_id FROM Activity")]
+        for activity_id in rng.sample(ids, 40):
+            app.delete_activity(con.cursor(), activity_id)
+        app.commit(con)
+        con.close()
+
+        failures += check("deleted", db, rng, snapshot)
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
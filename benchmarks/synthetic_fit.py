@@ -0,0 +1,380 @@
+import argparse
+import datetime
+import math
+import random
+import struct
+import sys
+from pathlib import Path
+
+# writes small but valid FIT activity files (file header, definition + data messages
+# for records, laps and a session, crc) that fitparse and add_fitfile accept, and
+# daily monitoring files like the ones a watch keeps in Monitor, so ingest and the
+# server can be measured without a real watch archive. malformed files of the kinds
+# ingest has to survive can be mixed in. run directly to write an archive:
+#
+#   python benchmarks/synthetic_fit.py FitFiles --activities 1000 --malformed 20
+
+FIT_EPOCH = datetime.datetime(1989, 12, 31)
+
+CRC_TABLE = (0x0000, 0xCC01, 0xD801, 0x1400, 0xF001, 0x3C00, 0x2800, 0xE401,
+             0xA001, 0x6C00, 0x7800, 0xB401, 0x5000, 0x9C01, 0x8801, 0x4400)
+
+# base type name: (FIT base type id, struct format, invalid value)
+BASE_TYPES = {
+    "enum": (0x00, "B", 0xFF),
+    "uint8": (0x02, "B", 0xFF),
+    "uint16": (0x84, "H", 0xFFFF),
+    "sint16": (0x83, "h", 0x7FFF),
+    "sint32": (0x85, "i", 0x7FFFFFFF),
+    "uint32": (0x86, "I", 0xFFFFFFFF),
+}
+
+# global message numbers from the FIT profile
+RECORD_MESG = 20
+LAP_MESG = 19
+SESSION_MESG = 18
+MONITORING_MESG = 55
+MONITORING_INFO_MESG = 103
+STRESS_LEVEL_MESG = 227
+
+# (field name, field number, base type, scale, offset) for each message written
+RECORD_FIELDS = (
+    ("timestamp", 253, "uint32", 1, 0),
+    ("position_lat", 0, "sint32", 1, 0),
+    ("position_long", 1, "sint32", 1, 0),
+    ("altitude", 2, "uint16", 5, 500),
+    ("heart_rate", 3, "uint8", 1, 0),
+    ("cadence", 4, "uint8", 1, 0),
+    ("distance", 5, "uint32", 100, 0),
+    ("speed", 6, "uint16", 1000, 0),
+    ("fractional_cadence", 53, "uint8", 128, 0),
+    ("enhanced_speed", 73, "uint32", 1000, 0),
+    ("enhanced_altitude", 78, "uint32", 5, 500),
+)
+
+LAP_FIELDS = (
+    ("timestamp", 253, "uint32", 1, 0),
+    ("start_time", 2, "uint32", 1, 0),
+    ("start_position_lat", 3, "sint32", 1, 0),
+    ("start_position_long", 4, "sint32", 1, 0),
+    ("total_elapsed_time", 7, "uint32", 1000, 0),
+    ("total_timer_time", 8, "uint32", 1000, 0),
+    ("total_distance", 9, "uint32", 100, 0),
+    ("total_cycles", 10, "uint32", 1, 0),
+    ("total_calories", 11, "uint16", 1, 0),
+    ("avg_speed", 13, "uint16", 1000, 0),
+    ("max_speed", 14, "uint16", 1000, 0),
+    ("avg_heart_rate", 15, "uint8", 1, 0),
+    ("max_heart_rate", 16, "uint8", 1, 0),
+    ("avg_cadence", 17, "uint8", 1, 0),
+    ("max_cadence", 18, "uint8", 1, 0),
+    ("total_ascent", 21, "uint16", 1, 0),
+    ("total_descent", 22, "uint16", 1, 0),
+    ("sport", 25, "enum", 1, 0),
+    ("avg_fractional_cadence", 80, "uint8", 128, 0),
+    ("max_fractional_cadence", 81, "uint8", 128, 0),
+    ("enhanced_avg_speed", 110, "uint32", 1000, 0),
+    ("enhanced_max_speed", 111, "uint32", 1000, 0),
+)
+
+SESSION_FIELDS = (
+    ("timestamp", 253, "uint32", 1, 0),
+    ("start_time", 2, "uint32", 1, 0),
+    ("start_position_lat", 3, "sint32", 1, 0),
+    ("start_position_long", 4, "sint32", 1, 0),
+    ("sport", 5, "enum", 1, 0),
+    ("total_elapsed_time", 7, "uint32", 1000, 0),
+    ("total_timer_time", 8, "uint32", 1000, 0),
+    ("total_distance", 9, "uint32", 100, 0),
+    ("total_cycles", 10, "uint32", 1, 0),
+    ("total_calories", 11, "uint16", 1, 0),
+    ("avg_speed", 14, "uint16", 1000, 0),
+    ("max_speed", 15, "uint16", 1000, 0),
+    ("avg_heart_rate", 16, "uint8", 1, 0),
+    ("max_heart_rate", 17, "uint8", 1, 0),
+    ("avg_cadence", 18, "uint8", 1, 0),
+    ("max_cadence", 19, "uint8", 1, 0),
+    ("total_ascent", 22, "uint16", 1, 0),
+    ("total_descent", 23, "uint16", 1, 0),
+    ("total_training_effect", 24, "uint8", 10, 0),
+    ("avg_fractional_cadence", 92, "uint8", 128, 0),
+    ("max_fractional_cadence", 93, "uint8", 128, 0),
+    ("enhanced_avg_speed", 124, "uint32", 1000, 0),
+    ("enhanced_max_speed", 125, "uint32", 1000, 0),
+    ("total_anaerobic_training_effect", 137, "uint8", 10, 0),
+)
+
+MONITORING_INFO_FIELDS = (
+    ("timestamp", 253, "uint32", 1, 0),
+    ("local_timestamp", 0, "uint32", 1, 0),
+)
+
+# heart rate samples only carry the low 16 bits of their timestamp
+MONITORING_HR_FIELDS = (
+    ("timestamp_16", 26, "uint16", 1, 0),
+    ("heart_rate", 27, "uint8", 1, 0),
+)
+
+# cycles is read as steps when activity_type is walking or running
+MONITORING_STEPS_FIELDS = (
+    ("timestamp", 253, "uint32", 1, 0),
+    ("activity_type", 5, "enum", 1, 0),
+    ("cycles", 3, "uint32", 1, 0),
+)
+
+STRESS_LEVEL_FIELDS = (
+    ("stress_level_value", 0, "sint16", 1, 0),
+    ("stress_level_time", 1, "uint32", 1, 0),
+)
+
+RUNNING = 1
+WALKING = 6
+
+
+def crc16(data, crc=0):
+    for byte in data:
+        for nibble in (byte & 0xF, (byte >> 4) & 0xF):
+            tmp = CRC_TABLE[crc & 0xF]
+            crc = (crc >> 4) & 0x0FFF
+            crc = crc ^ tmp ^ CRC_TABLE[nibble]
+    return crc
+
+
+def degrees_to_semicircles(degrees):
+    return int(degrees * 2**31 / 180)
+
+
+def definition_message(local_num, global_num, fields):
+    out = struct.pack("<BBBHB", 0x40 | local_num, 0, 0, global_num, len(fields))
+    for _, number, base_type, _, _ in fields:
+        out += struct.pack("<BBB", number, struct.calcsize(BASE_TYPES[base_type][1]), BASE_TYPES[base_type][0])
+    return out
+
+
+def data_message(local_num, fields, values):
+    fmt = "<B" + "".join(BASE_TYPES[base_type][1] for _, _, base_type, _, _ in fields)
+    raw = []
+    for name, _, base_type, scale, offset in fields:
+        # None is written as the type's invalid value, which fitparse reads as missing
+        value = values[name]
+        if value is None:
+            raw.append(BASE_TYPES[base_type][2])
+        elif isinstance(value, datetime.datetime):
+            raw.append(int((value - FIT_EPOCH).total_seconds()))
+        else:
+            raw.append(int(round((value + offset) * scale)))
+    return struct.pack(fmt, local_num, *raw)
+
+
+def fit_file(body):
+    header = struct.pack("<BBHI4s", 14, 0x10, 2093, len(body), b".FIT")
+    header += struct.pack("<H", crc16(header))
+    data = header + body
+    return data + struct.pack("<H", crc16(data))
+
+
+def activity_fit(start, seconds, laps=1, seed=0, lat=51.5, long=-0.1, session=True, bad_records=()):
+    # a run of `seconds` 1Hz records starting at `start` (naive utc), split into `laps`.
+    # session=False leaves out the session message, and the records at the indices in
+    # bad_records have no timestamp
+    rng = random.Random(seed)
+
+    body = bytearray(definition_message(0, RECORD_MESG, RECORD_FIELDS))
+    distance = 0.0
+    position_lat = degrees_to_semicircles(lat)
+    position_long = degrees_to_semicircles(long)
+    heading = rng.uniform(0, 2*math.pi)
+    max_speed = 0.0
+    for i in range(seconds):
+        speed = 2.8 + 0.4*math.sin(i/60) + rng.random()*0.1
+        max_speed = max(max_speed, speed)
+        distance += speed
+        heading += rng.uniform(-0.05, 0.05)
+        # ~1.2e-5 degrees of latitude per metre
+        position_lat += degrees_to_semicircles(speed * 9e-6 * math.cos(heading))
+        position_long += degrees_to_semicircles(speed * 1.4e-5 * math.sin(heading))
+        altitude = 30 + 10*math.sin(i/200)
+
+        body += data_message(0, RECORD_FIELDS, {
+            "timestamp": None if i in bad_records else start + datetime.timedelta(seconds=i),
+            "position_lat": position_lat,
+            "position_long": position_long,
+            "altitude": altitude,
+            "heart_rate": 120 + int(40*i/seconds) + rng.randint(0, 5),
+            "cadence": 85 + rng.randint(0, 3),
+            "distance": distance,
+            "speed": speed,
+            "fractional_cadence": 0.5,
+            "enhanced_speed": speed,
+            "enhanced_altitude": altitude,
+        })
+
+    summary = {
+        "start_position_lat": degrees_to_semicircles(lat),
+        "start_position_long": degrees_to_semicircles(long),
+        "sport": RUNNING,
+        "total_calories": seconds//6,
+        "avg_speed": distance/seconds,
+        "max_speed": max_speed,
+        "enhanced_avg_speed": distance/seconds,
+        "enhanced_max_speed": max_speed,
+        "avg_heart_rate": 140,
+        "max_heart_rate": 165,
+        "avg_cadence": 86,
+        "max_cadence": 88,
+        "total_ascent": 40,
+        "total_descent": 40,
+        "avg_fractional_cadence": 0.5,
+        "max_fractional_cadence": 0.5,
+    }
+
+    body += definition_message(1, LAP_MESG, LAP_FIELDS)
+    for lap in range(laps):
+        lap_start = start + datetime.timedelta(seconds=seconds*lap//laps)
+        lap_end = start + datetime.timedelta(seconds=seconds*(lap+1)//laps)
+        lap_seconds = (lap_end - lap_start).total_seconds()
+        body += data_message(1, LAP_FIELDS, {
+            **summary,
+            "timestamp": lap_end,
+            "start_time": lap_start,
+            "total_elapsed_time": lap_seconds,
+            "total_timer_time": lap_seconds,
+            "total_distance": distance/laps,
+            "total_cycles": int(lap_seconds*86/60),
+        })
+
+    if not session:
+        return fit_file(bytes(body))
+
+    body += definition_message(2, SESSION_MESG, SESSION_FIELDS)
+    body += data_message(2, SESSION_FIELDS, {
+        **summary,
+        "timestamp": start + datetime.timedelta(seconds=seconds),
+        "start_time": start,
+        "total_elapsed_time": seconds,
+        "total_timer_time": seconds,
+        "total_distance": distance,
+        "total_cycles": seconds*86//60,
+        "total_training_effect": 3.1,
+        "total_anaerobic_training_effect": 1.2,
+    })
+
+    return fit_file(bytes(body))
+
+
+def monitoring_fit(day, seed=0, hr_interval=60, steps_interval=900, stress_interval=180):
+    # a day (from midnight utc) of heart rate, cumulative walking steps and stress samples
+    rng = random.Random(seed)
+    day = datetime.datetime(day.year, day.month, day.day)
+
+    body = bytearray(definition_message(0, MONITORING_INFO_MESG, MONITORING_INFO_FIELDS))
+    body += data_message(0, MONITORING_INFO_FIELDS, {"timestamp": day, "local_timestamp": day})
+
+    body += definition_message(1, MONITORING_MESG, MONITORING_HR_FIELDS)
+    body += definition_message(2, MONITORING_MESG, MONITORING_STEPS_FIELDS)
+    body += definition_message(3, STRESS_LEVEL_MESG, STRESS_LEVEL_FIELDS)
+
+    steps = 0
+    for second in range(0, 86400, hr_interval):
+        t = day + datetime.timedelta(seconds=second)
+        # timestamp_16 has to be recovered from the last full timestamp, so one is
+        # written every steps_interval
+        if second % steps_interval == 0:
+            steps += rng.randint(0, 400)
+            body += data_message(2, MONITORING_STEPS_FIELDS, {"timestamp": t, "activity_type": WALKING, "cycles": steps})
+
+        fit_seconds = int((t - FIT_EPOCH).total_seconds())
+        body += data_message(1, MONITORING_HR_FIELDS, {
+            "timestamp_16": fit_seconds & 0xFFFF,
+            "heart_rate": 55 + int(20*math.sin(second/86400*2*math.pi)) + rng.randint(0, 10),
+        })
+
+        if second % stress_interval == 0:
+            body += data_message(3, STRESS_LEVEL_FIELDS, {
+                "stress_level_value": rng.choice((-1, rng.randint(0, 100))),
+                "stress_level_time": t,
+            })
+
+    return fit_file(bytes(body))
+
+
+# kinds of broken activity file, and what ingest should make of each:
+#   truncated    cut off part way through a record      whole file skipped
+#   bad_crc      last two bytes (the crc) wrong          whole file skipped
+#   not_fit      random bytes, no FIT header             whole file skipped
+#   empty        zero bytes                              whole file skipped
+#   no_session   records and laps but no session         whole file skipped
+#   bad_records  a few records without a timestamp       those records skipped
+MALFORMED = ("truncated", "bad_crc", "not_fit", "empty", "no_session", "bad_records")
+
+
+def malformed_fit(kind, start, seconds, seed=0):
+    rng = random.Random(seed)
+
+    if kind == "not_fit":
+        return bytes(rng.randrange(256) for _ in range(rng.randint(16, 4096)))
+    if kind == "empty":
+        return b""
+    if kind == "no_session":
+        return activity_fit(start, seconds, seed=seed, session=False)
+    if kind == "bad_records":
+        return activity_fit(start, seconds, seed=seed, bad_records=set(rng.sample(range(seconds), min(5, seconds))))
+
+    data = activity_fit(start, seconds, seed=seed)
+    if kind == "truncated":
+        return data[:rng.randint(14, len(data) - 3)]
+    if kind == "bad_crc":
+        return data[:-2] + bytes((data[-2] ^ 0xFF, data[-1]))
+
+    raise ValueError(f"unknown kind of malformed file {kind}")
+
+
+def write_archive(dest, activities, seconds=1800, laps=3, first_day=datetime.datetime(2015, 1, 1, 7), monitor_days=0,
+                  malformed=0, vary=False):
+    # src directory in the layout app.py expects, one activity a day so start times
+    # and record timestamps never collide, and a monitoring file for each of the
+    # first monitor_days days. `malformed` broken files (cycling through MALFORMED)
+    # follow the activities, dated after them. vary=True spreads activity lengths
+    # between half and one and a half times `seconds`
+    rng = random.Random(0)
+    dest = Path(dest)
+    (dest/"Activity").mkdir(parents=True, exist_ok=True)
+    (dest/"Monitor").mkdir(parents=True, exist_ok=True)
+
+    for i in range(activities):
+        start = first_day + datetime.timedelta(days=i)
+        length = rng.randint(seconds//2, seconds*3//2) if vary else seconds
+        (dest/"Activity"/f"{start:%Y-%m-%d-%H-%M-%S}.fit").write_bytes(activity_fit(start, length, laps, seed=i))
+
+    for i in range(malformed):
+        start = first_day + datetime.timedelta(days=activities+i)
+        kind = MALFORMED[i % len(MALFORMED)]
+        (dest/"Activity"/f"{start:%Y-%m-%d-%H-%M-%S}-{kind}.fit").write_bytes(malformed_fit(kind, start, seconds, seed=i))
+
+    for i in range(monitor_days):
+        day = first_day + datetime.timedelta(days=i)
+        (dest/"Monitor"/f"{day:%Y-%m-%d}.fit").write_bytes(monitoring_fit(day, seed=i))
+
+    return dest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="write a synthetic archive of fitfiles")
+    parser.add_argument("dest", help="directory to write Activity and Monitor into")
+    parser.add_argument("--activities", default=100, type=int)
+    parser.add_argument("--seconds", default=1800, type=int, help="records (1Hz samples) per activity")
+    parser.add_argument("--laps", default=3, type=int)
+    parser.add_argument("--vary", default=False, action="store_true", help="spread activity lengths around --seconds")
+    parser.add_argument("--monitor-days", default=0, type=int, help="days of monitoring files")
+    parser.add_argument("--malformed", default=0, type=int, help=f"broken activity files, of the kinds {', '.join(MALFORMED)}")
+    args = parser.parse_args()
+
+    dest = write_archive(args.dest, args.activities, args.seconds, args.laps, monitor_days=args.monitor_days,
+        malformed=args.malformed, vary=args.vary)
+    size = sum(f.stat().st_size for f in dest.glob("*/*"))
+    print(f"wrote {args.activities + args.malformed} activity files ({args.malformed} malformed) and "
+          f"{args.monitor_days} monitoring files to {dest}, {size/2**20:.1f} MiB")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
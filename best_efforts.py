@@ -0,0 +1,44 @@
+import numpy as np
+
+# distances (in metres) that every activity's fastest segments are found for at
+# ingest, served as personal records by /api/summary/personalrecords
+DISTANCES = {
+    "1k": 1000.0,
+    "1 mile": 1609.344,
+    "5k": 5000.0,
+    "10k": 10000.0,
+    "half marathon": 21097.5,
+    "marathon": 42195.0,
+}
+
+
+def fastest_segments(seconds: np.ndarray, distance: np.ndarray):
+    # yields (name, metres, elapsed, start, end) for the quickest stretch of each of
+    # DISTANCES the series covers. seconds and distance are the activity's records in
+    # time order, distance being cumulative. for every record taken as the end of a
+    # segment, searchsorted finds the last record at least the target distance before
+    # it, and the start time is interpolated between that record and the next so a
+    # segment is exactly the target distance rather than whatever the samples overshoot
+    if len(distance) < 2:
+        return
+
+    seconds = seconds.astype(np.float64)
+    # a watch can report a slightly smaller distance after a gps correction
+    distance = np.maximum.accumulate(distance.astype(np.float64))
+
+    for name, metres in DISTANCES.items():
+        if distance[-1] - distance[0] < metres:
+            return
+
+        ends = np.flatnonzero(distance - distance[0] >= metres)
+        targets = distance[ends] - metres
+        starts = np.searchsorted(distance, targets, side="right") - 1
+
+        step = distance[starts+1] - distance[starts]
+        fraction = np.divide(targets - distance[starts], step, out=np.zeros_like(step), where=step > 0)
+        start_seconds = seconds[starts] + fraction * (seconds[starts+1] - seconds[starts])
+
+        elapsed = seconds[ends] - start_seconds
+        best = elapsed.argmin()
+
+        yield name, metres, float(elapsed[best]), int(seconds[starts[best]]), int(seconds[ends[best]])
@@ -0,0 +1,105 @@
+from collections import OrderedDict
+from pathlib import Path
+import os
+import threading
+
+# the db only changes when app.py ingests files, so every api response is a pure
+# function of the request and a "generation" that ingest bumps after each commit.
+# the generation lives in a small file next to the db (like sqlite's -wal and
+# -journal files) so the server can check it without touching sqlite
+
+
+def generation_path(db):
+    db = Path(db)
+    return db.with_name(db.name + "-generation")
+
+
+def read_generation(db) -> int:
+    try:
+        return int(generation_path(db).read_text())
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def bump_generation(db) -> int:
+    # written to a temporary file and renamed over the old one so readers never see
+    # a partly written value
+    path = generation_path(db)
+    generation = read_generation(db) + 1
+
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(str(generation))
+    os.replace(tmp, path)
+
+    return generation
+
+
+class GenerationWatcher:
+    # current generation of a db for every request, only re-reading the file when a
+    # stat shows it has been replaced since the last read
+    def __init__(self):
+        self._db = None
+        self._stat = None
+        self._generation = 0
+
+    def current(self, db) -> int:
+        try:
+            stat = os.stat(generation_path(db))
+            stat = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            stat = None
+
+        if (db, stat) != (self._db, self._stat):
+            self._db, self._stat = db, stat
+            self._generation = read_generation(db)
+
+        return self._generation
+
+
+class ResponseCache:
+    # least recently used cache of response bodies for one generation of the db,
+    # evicting once the bodies held add up to more than max_bytes. a new generation
+    # empties it, anything computed from the old one is stale
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.generation = None
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, generation, key):
+        with self._lock:
+            if generation != self.generation:
+                return None
+
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, generation, key, body: bytes, mimetype):
+        if len(body) > self.max_bytes:
+            return
+
+        with self._lock:
+            if generation != self.generation:
+                self._clear(generation)
+
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+
+            self._entries[key] = (body, mimetype)
+            self.size += len(body)
+
+            while self.size > self.max_bytes:
+                evicted, _ = self._entries.popitem(last=False)[1]
+                self.size -= len(evicted)
+
+    def _clear(self, generation):
+        self._entries.clear()
+        self.size = 0
+        self.generation = generation
+
+    def __len__(self):
+        return len(self._entries)
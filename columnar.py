@@ -0,0 +1,76 @@
+import struct
+
+import numpy as np
+
+# binary column-oriented alternative to the json row lists, for clients that want
+# typed arrays they can view directly (eg. Float32Array in the browser):
+#
+#   b"FCOL", uint8 version, uint8 column count, uint32 row count
+#   per column: uint8 name length, ascii name, uint8 dtype length, numpy dtype string
+#   (eg. "<f4", "|u1", "<i8"), then every column's values back to back, each column
+#   starting on an 8 byte boundary from the start of the body
+#
+# everything is little-endian. missing float values are nan
+
+MIMETYPE = "application/octet-stream"
+MAGIC = b"FCOL"
+VERSION = 1
+
+
+def from_rows(rows, dtype: np.dtype) -> np.ndarray:
+    # structured array straight from an iterable of row tuples (eg. a sqlite cursor),
+    # without building a list of them first
+    return np.fromiter(rows, dtype=dtype)
+
+
+def encode(table) -> bytes:
+    # table: a structured array, or {name: array} of columns of the same length (eg.
+    # views of a snapshot's arrays, which are then never copied into a table first)
+    if isinstance(table, np.ndarray):
+        table = {name: table[name] for name in table.dtype.names}
+    rows = len(next(iter(table.values()))) if table else 0
+
+    header = bytearray(MAGIC + struct.pack("<BBI", VERSION, len(table), rows))
+    for name, values in table.items():
+        dtype = values.dtype.newbyteorder("<").str.encode("ascii")
+        header += struct.pack("<B", len(name)) + name.encode("ascii")
+        header += struct.pack("<B", len(dtype)) + dtype
+
+    out = [bytes(header)]
+    offset = len(header)
+    for values in table.values():
+        padding = -offset % 8
+        column = np.ascontiguousarray(values, dtype=values.dtype.newbyteorder("<")).tobytes()
+        out += [b"\0" * padding, column]
+        offset += padding + len(column)
+
+    return b"".join(out)
+
+
+def decode(data: bytes) -> dict:
+    # the inverse of encode, as {name: array}
+    if data[:4] != MAGIC:
+        raise ValueError("not a columnar response")
+
+    version, count, rows = struct.unpack_from("<BBI", data, 4)
+    if version != VERSION:
+        raise ValueError(f"unsupported columnar version {version}")
+
+    offset = 10
+    columns = []
+    for _ in range(count):
+        length = data[offset]
+        name = data[offset+1:offset+1+length].decode("ascii")
+        offset += 1 + length
+        length = data[offset]
+        dtype = np.dtype(data[offset+1:offset+1+length].decode("ascii"))
+        offset += 1 + length
+        columns.append((name, dtype))
+
+    out = {}
+    for name, dtype in columns:
+        offset += -offset % 8
+        out[name] = np.frombuffer(data, dtype=dtype, count=rows, offset=offset)
+        offset += dtype.itemsize * rows
+
+    return out
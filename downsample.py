@@ -0,0 +1,64 @@
+import numpy as np
+
+# point counts precomputed for every activity longer than them at ingest, so the
+# activity view can ask for a chart-sized series without the server touching every
+# record of a long activity
+LEVELS = (250, 1000, 4000)
+
+
+def minmax_indices(series: np.ndarray, max_points: int) -> np.ndarray:
+    # indices of at most max_points rows to keep from `series` (one column per series,
+    # nan where missing) so that none of the series loses its peaks. rows are split into
+    # equal buckets and each bucket keeps the rows holding the min and max of every
+    # column, plus the first and last row overall
+    n, columns = series.shape
+    if n <= max_points:
+        return np.arange(n)
+
+    buckets = (max_points - 2) // (2 * columns)
+    if buckets < 1:
+        return np.unique(np.linspace(0, n-1, max_points).round().astype(np.intp))
+
+    size = -(-n // buckets)
+    padding = ((0, buckets*size - n), (0, 0))
+
+    missing = np.isnan(series)
+    lows = np.pad(np.where(missing, np.inf, series), padding, constant_values=np.inf).reshape(buckets, size, columns)
+    highs = np.pad(np.where(missing, -np.inf, series), padding, constant_values=-np.inf).reshape(buckets, size, columns)
+
+    offsets = (np.arange(buckets) * size)[:, None]
+    keep = np.concatenate((
+        (lows.argmin(axis=1) + offsets).ravel(),
+        (highs.argmax(axis=1) + offsets).ravel(),
+        (0, n-1),
+    ))
+
+    return np.unique(np.minimum(keep, n-1))
+
+
+def downsample_rows(rows: list, max_points: int) -> list:
+    # rows are (timestamp, value, value, ...) tuples in time order, None for missing values
+    if len(rows) <= max_points:
+        return rows
+
+    series = np.array([row[1:] for row in rows], dtype=np.float64)
+    return [rows[i] for i in minmax_indices(series, max_points)]
+
+
+def downsample_table(table: np.ndarray, max_points: int) -> np.ndarray:
+    # same as downsample_rows for a structured array whose first field is the time
+    if len(table) <= max_points:
+        return table
+
+    series = np.column_stack([table[name].astype(np.float64) for name in table.dtype.names[1:]])
+    return table[minmax_indices(series, max_points)]
+
+
+def levels(series: np.ndarray):
+    # yields (max_points, indices of the rows kept) for each of LEVELS the series (as
+    # minmax_indices takes it) is longer than
+    for max_points in LEVELS:
+        if len(series) <= max_points:
+            return
+
+        yield max_points, minmax_indices(series, max_points)
@@ -1,82 +1,115 @@
 from datetime import datetime,timedelta
+from operator import itemgetter
 import fitparse
 
-# stores record fields and throws error if any required fields are missing
-class RecordData:
-    def __init__(self, message: fitparse.DataMessage):
-        # timestamp stored in utc
-        self.timestamp: datetime.DateTime = message.get_value("timestamp")
-        self.distance: float              = message.get_value("distance")
-        self.enhanced_speed: float        = message.get_value("enhanced_speed")
-        self.speed: float                 = message.get_value("speed")
-        self.heart_rate: int              = message.get_value("heart_rate")
-        self.cadence: int                 = message.get_value("cadence")
-        self.fractional_cadence: float    = message.get_value("fractional_cadence")
-
-        # sometimes missing 
-        self.enhanced_altitude: float     = message.get_value("enhanced_altitude")
-        self.altitude: float              = message.get_value("altitude")
-        self.position_long: int           = message.get_value("position_long")
-        self.position_lat: int            = message.get_value("position_lat")
-
-        # check required fields are present
-        if any(v is None for v in [self.timestamp, self.distance, self.enhanced_speed, 
-                                   self.speed, self.heart_rate, self.cadence, self.fractional_cadence]):
-            raise ValueError(f"message is missing required fields: {[i for i in vars(self).keys() if vars(self)[i] is None]}")
-
-        self._message = message
+REQUIRED = True
+OPTIONAL = False
+
+# base for the message types below. subclasses declare their fields once in FIELDS as
+# (name, type, required) in db column order, and the attribute accessors and required
+# field check are built from that when the class is defined rather than per message.
+# an instance is just the tuple of values (ready to insert) and, only if asked for,
+# the message it came from
+class FieldData:
+    __slots__ = ("_values", "_message")
+
+    FIELDS = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        cls._names = tuple(name for name, _, _ in cls.FIELDS)
+        cls._required = tuple(i for i, (_, _, required) in enumerate(cls.FIELDS) if required)
+        # itemgetter only returns a tuple for two or more items
+        required = cls._required
+        cls._get_required = itemgetter(*required) if len(required) > 1 else lambda values: tuple(values[i] for i in required)
+
+        for i, (name, field_type, _) in enumerate(cls.FIELDS):
+            setattr(cls, name, property(lambda self, i=i: self._values[i], doc=field_type.__name__))
+
+    def __init__(self, message: fitparse.DataMessage, keep_message: bool = False):
+        self._values = self.row(message)
+        self._message = message if keep_message else None
+
+    @classmethod
+    def row(cls, message: fitparse.DataMessage) -> tuple:
+        # validated values in FIELDS order straight from a message, without building an
+        # instance. where fitparse repeats a field name (eg. enhanced_speed expanded from
+        # speed) the first one wins, same as message.get_value
+        fields = {field.name: field.value for field in reversed(message.fields)}
+        values = tuple(map(fields.get, cls._names))
+
+        if None in cls._get_required(values):
+            raise ValueError(f"message is missing required fields: {[cls._names[i] for i in cls._required if values[i] is None]}")
+
+        return values
+
+    def as_row(self) -> tuple:
+        return self._values
 
     def __repr__(self):
-        # omit the private message variable
-        data_string = str({k:v for k,v in vars(self).items() if k!="_message"})[1:-1]
-        return f"<RecordData: {data_string}>"
+        data_string = str(dict(zip(self._names, self._values)))[1:-1]
+        return f"<{type(self).__name__}: {data_string}>"
+
+
+# stores record fields and throws error if any required fields are missing
+class RecordData(FieldData):
+    __slots__ = ()
+
+    FIELDS = (
+        # timestamp stored in utc
+        ("timestamp", datetime, REQUIRED),
+        ("distance", float, REQUIRED),
+        ("enhanced_speed", float, REQUIRED),
+        ("speed", float, REQUIRED),
+        ("heart_rate", int, REQUIRED),
+        ("cadence", int, REQUIRED),
+        ("fractional_cadence", float, REQUIRED),
+
+        # sometimes missing
+        ("enhanced_altitude", float, OPTIONAL),
+        ("altitude", float, OPTIONAL),
+        ("position_long", int, OPTIONAL),
+        ("position_lat", int, OPTIONAL),
+    )
 
 
 # lap record data where error thrown if any required fields are missing
-class LapData:
-    def __init__(self, message: fitparse.DataMessage):
+class LapData(FieldData):
+    __slots__ = ()
+
+    FIELDS = (
         # timings - note datetimes stored in utc
-        self.timestamp: datetime.DateTime  = message.get_value("timestamp")
-        self.start_time: datetime.DateTime = message.get_value("start_time")
-        self.total_elapsed_time: float     = message.get_value("total_elapsed_time")
-        self.total_timer_time: float       = message.get_value("total_timer_time")
+        ("start_time", datetime, REQUIRED),
+        ("timestamp", datetime, REQUIRED),
+        ("total_elapsed_time", float, REQUIRED),
+        ("total_timer_time", float, REQUIRED),
 
         # positions and distance
-        self.start_position_lat: int  = message.get_value("start_position_lat") # sometimes missing
-        self.start_position_long: int = message.get_value("start_position_long") # sometimes missing
-        self.total_distance: float    = message.get_value("total_distance")
-        self.total_ascent: int        = message.get_value("total_ascent") # sometimes missing
-        self.total_descent: int       = message.get_value("total_descent") # sometimes missing
+        ("start_position_lat", int, OPTIONAL),
+        ("start_position_long", int, OPTIONAL),
+        ("total_ascent", int, OPTIONAL),
+        ("total_descent", int, OPTIONAL),
+        ("total_distance", float, REQUIRED),
 
         # body metrics
-        self.total_strides: int            = message.get_value("total_strides")
-        self.total_calories: int           = message.get_value("total_calories")
-        self.enhanced_avg_speed: float     = message.get_value("enhanced_avg_speed")
-        self.avg_speed: float              = message.get_value("avg_speed")
-        self.enhanced_max_speed: float     = message.get_value("enhanced_max_speed")
-        self.max_speed: float              = message.get_value("max_speed")
-        self.avg_heart_rate: float         = message.get_value("avg_heart_rate")
-        self.max_heart_rate: int           = message.get_value("max_heart_rate")
-        self.avg_running_cadence: int      = message.get_value("avg_running_cadence") 
-        self.max_running_cadence: int      = message.get_value("max_running_cadence")
-        self.avg_fractional_cadence: float = message.get_value("avg_fractional_cadence")
-        self.max_fractional_cadence: float = message.get_value("max_fractional_cadence")
-
-        # check required fields present
-        required_fields = [vars(self)[i] for i in vars(self).keys() if i not in ["start_position_lat", "start_position_long","total_ascent","total_descent"]]
-        if any(v is None for v in required_fields):
-            raise ValueError(f"message is missing required fields: {[i for i in vars(self).keys() if vars(self)[i] is None]}")
-
-        self._message = message
-
-    def __repr__(self):
-        # omit the private message variable
-        data_string = str({k:v for k,v in vars(self).items() if k!="_message"})[1:-1]
-        return f"<LapData: {data_string}>"
+        ("total_strides", int, REQUIRED),
+        ("total_calories", int, REQUIRED),
+        ("enhanced_avg_speed", float, REQUIRED),
+        ("avg_speed", float, REQUIRED),
+        ("enhanced_max_speed", float, REQUIRED),
+        ("max_speed", float, REQUIRED),
+        ("avg_heart_rate", float, REQUIRED),
+        ("max_heart_rate", int, REQUIRED),
+        ("avg_running_cadence", int, REQUIRED),
+        ("max_running_cadence", int, REQUIRED),
+        ("avg_fractional_cadence", float, REQUIRED),
+        ("max_fractional_cadence", float, REQUIRED),
+    )
 
     def summarise(self) -> str:
         # TODO: here we should deal with units https://github.com/hgrecco/pint
-        
+
         distance = round(self.total_distance/1000,2)
         duration = timedelta(seconds=round(self.total_timer_time))
         pace = timedelta(seconds=round(1000/self.enhanced_avg_speed))
@@ -97,19 +130,12 @@ cadence: {self.avg_running_cadence * 2}spm
 # stores the important fields for a session entry, and
 # throws error if any of the fields are not present
 class SessionData(LapData):
-    def __init__(self, message: fitparse.DataMessage):
-        super().__init__(message)
-
-        self.total_training_effect = message.get_value("total_training_effect")
-        self.total_anaerobic_training_effect = message.get_value("total_anaerobic_training_effect")
+    __slots__ = ()
 
-        if self.total_training_effect is None or self.total_anaerobic_training_effect is None:
-            raise ValueError(f"message is missing required fields: {[i for i in vars(self).keys() if vars(self)[i] is None]}")
-
-    def __repr__(self):
-        # omit the private message variable
-        data_string = str({k:v for k,v in vars(self).items() if k!="_message"})[1:-1]
-        return f"<SessionData: {data_string}>"
+    FIELDS = LapData.FIELDS + (
+        ("total_training_effect", float, REQUIRED),
+        ("total_anaerobic_training_effect", float, REQUIRED),
+    )
 
     def summarise(self) -> str:
         out = f"""aerobic training effect: {self.total_training_effect}/5
@@ -118,7 +144,37 @@ anaerobic training effect: {self.total_anaerobic_training_effect}/5
         return super().summarise() + out
 
 
-# monitoring data
-class MonitoringData():
-    def __init__(self):
-        pass
\ No newline at end of file
+# fitparse keeps every decoded message on the FitFile so get_messages can be called
+# again, which for a long activity holds the whole file in memory. this version hands
+# each message out once and then forgets it, so the file can only be iterated once
+class StreamingFitFile(fitparse.FitFile):
+    def _parse_message(self):
+        message = super()._parse_message()
+        self._messages.clear()
+
+        return message
+
+
+# monitoring data, each message only has some of these. samples between full
+# timestamps just carry the low 16 bits of theirs in timestamp_16, and steps are a
+# running total for the day of the message's activity_type
+class MonitoringData(FieldData):
+    __slots__ = ()
+
+    FIELDS = (
+        ("timestamp", datetime, OPTIONAL),
+        ("timestamp_16", int, OPTIONAL),
+        ("activity_type", str, OPTIONAL),
+        ("steps", int, OPTIONAL),
+        ("heart_rate", int, OPTIONAL),
+    )
+
+
+# stress level samples, negative values mean no reading (eg. too much movement)
+class StressLevelData(FieldData):
+    __slots__ = ()
+
+    FIELDS = (
+        ("stress_level_time", datetime, REQUIRED),
+        ("stress_level_value", int, REQUIRED),
+    )
@@ -0,0 +1,165 @@
+from collections import defaultdict
+import bisect
+import sqlite3
+import threading
+import time
+
+# opt-in instrumentation (`app.py --metrics`): request latency per route, time spent in
+# and rows read by each sql statement, response bytes and ingest phases, kept in memory
+# and rendered in prometheus' text format for /api/_metrics
+
+# upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {}
+        self._types = {}
+        # name: {labels: [count per bucket..., count, sum]} or {labels: value}
+        self._histograms = defaultdict(dict)
+        self._counters = defaultdict(lambda: defaultdict(float))
+
+    def describe(self, name, kind, help):
+        self._types[name] = kind
+        self._help[name] = help
+
+    def observe(self, name, labels, value):
+        # labels: tuple of (label, value) pairs
+        with self._lock:
+            histogram = self._histograms[name].get(labels)
+            if histogram is None:
+                histogram = self._histograms[name][labels] = [0] * (len(BUCKETS) + 2)
+            histogram[bisect.bisect_left(BUCKETS, value)] += 1
+            histogram[-1] += value
+
+    def inc(self, name, labels, amount=1):
+        with self._lock:
+            self._counters[name][labels] += amount
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name in sorted(self._types):
+                lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {self._types[name]}")
+
+                for labels, histogram in sorted(self._histograms.get(name, {}).items()):
+                    cumulative = 0
+                    for bound, count in zip((*BUCKETS, "+Inf"), histogram):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{{{label_text((*labels, ('le', bound)))}}} {cumulative}")
+                    lines.append(f"{name}_sum{{{label_text(labels)}}} {histogram[-1]}")
+                    lines.append(f"{name}_count{{{label_text(labels)}}} {cumulative}")
+
+                for labels, value in sorted(self._counters.get(name, {}).items()):
+                    lines.append(f"{name}{{{label_text(labels)}}} {value:g}")
+
+        return "\n".join(lines) + "\n"
+
+
+def label_text(labels) -> str:
+    return ",".join(f'{label}="{escape(value)}"' for label, value in labels)
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def statement(sql) -> str:
+    # sql with its whitespace collapsed, so each statement is one label value
+    return " ".join(sql.split())
+
+
+registry = Registry()
+registry.describe("fitdata_http_request_duration_seconds", "histogram",
+    "time from a request arriving to its response being ready, by route and status")
+registry.describe("fitdata_http_response_bytes_total", "counter", "response body bytes sent, by route")
+registry.describe("fitdata_sqlite_statements_total", "counter", "times each sql statement was executed")
+registry.describe("fitdata_sqlite_statement_seconds_total", "counter",
+    "time spent executing each sql statement and fetching its rows")
+registry.describe("fitdata_sqlite_rows_total", "counter", "rows fetched from each sql statement")
+registry.describe("fitdata_ingest_phase_seconds", "histogram",
+    "time spent on each fitfile ingested, by phase (parse, validate, insert, derive)")
+
+
+# a cursor counting time spent and rows fetched against the statement it last ran.
+# rows are fetched lazily, so the time taken by iterating or fetching is added up as it
+# happens and only handed to the registry once the cursor moves on to another
+# statement, is closed or goes away, keeping the lock out of the per row path
+class TimedCursor(sqlite3.Cursor):
+    _statement = None
+    _seconds = 0.0
+    _rows = 0
+
+    def _flush(self):
+        if self._statement is None:
+            return
+
+        labels = (("statement", self._statement),)
+        registry.inc("fitdata_sqlite_statement_seconds_total", labels, self._seconds)
+        if self._rows:
+            registry.inc("fitdata_sqlite_rows_total", labels, self._rows)
+        self._statement, self._seconds, self._rows = None, 0.0, 0
+
+    def execute(self, sql, parameters=()):
+        self._flush()
+        started = time.perf_counter()
+        self._statement = statement(sql)
+        registry.inc("fitdata_sqlite_statements_total", (("statement", self._statement),))
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._seconds += time.perf_counter() - started
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        finally:
+            self._seconds += time.perf_counter() - started
+        self._rows += 1
+        return row
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._seconds += time.perf_counter() - started
+        self._rows += row is not None
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._seconds += time.perf_counter() - started
+        self._rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._seconds += time.perf_counter() - started
+        self._rows += len(rows)
+        return rows
+
+    def close(self):
+        self._flush()
+        super().close()
+
+    def __del__(self):
+        self._flush()
+
+
+# connection handing out TimedCursors, including for Connection.execute
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
@@ -0,0 +1,87 @@
+import calendar
+
+# all day series read from the files in Monitor, stored one (series, timestamp, value)
+# row per sample keyed on unix epoch seconds. name: (series id, how /api/monitoring
+# combines the samples falling in one interval). the server only needs this, so
+# fitparse is imported by the functions reading files
+SERIES = {
+    "heart_rate": (1, "avg"),
+    "steps": (2, "sum"),
+    "stress_level": (3, "avg"),
+}
+
+# seconds from the unix epoch to the FIT epoch (1989-12-31 00:00 utc)
+FIT_EPOCH = 631065600
+
+# activity types whose cycles fitparse reads as steps
+STEP_ACTIVITY_TYPES = ("walking", "running")
+
+
+def epoch(timestamp):
+    # fitparse gives naive utc datetimes
+    return calendar.timegm(timestamp.timetuple())
+
+
+def read_monitoring(f):
+    # yields (series id, epoch seconds, value) for every sample in a monitoring file.
+    # steps come as running totals for the day per activity type, they're stored as
+    # the steps taken since the previous sample so any interval can be summed. a
+    # total going down is the count starting again at midnight, and the first total
+    # in a file counts from zero as a watch starts a new file each day
+    from field_types import MonitoringData, StressLevelData, StreamingFitFile
+
+    heart_rate, steps, stress_level = (SERIES[name][0] for name in ("heart_rate", "steps", "stress_level"))
+
+    last_timestamp = None
+    step_totals = {}
+
+    for message in StreamingFitFile(str(f.resolve())).get_messages(("monitoring_info", "monitoring", "stress_level")):
+        if message.name == "stress_level":
+            time, value = StressLevelData.row(message)
+            if value >= 0:
+                yield stress_level, epoch(time), value
+            continue
+
+        timestamp, timestamp_16, activity_type, step_total, bpm = MonitoringData.row(message)
+
+        if timestamp is not None:
+            last_timestamp = epoch(timestamp)
+        elif timestamp_16 is not None and last_timestamp is not None:
+            # the low 16 bits of the FIT timestamp, no more than ~18h after the last full one
+            fit_timestamp = last_timestamp - FIT_EPOCH
+            last_timestamp += (timestamp_16 - fit_timestamp) & 0xFFFF
+        else:
+            continue
+
+        if message.name == "monitoring_info":
+            continue
+
+        if bpm:
+            yield heart_rate, last_timestamp, bpm
+
+        if step_total is not None and activity_type in STEP_ACTIVITY_TYPES:
+            previous = step_totals.get(activity_type, 0)
+            step_totals[activity_type] = step_total
+            yield steps, last_timestamp, step_total - previous if step_total >= previous else step_total
+
+
+def parse_monitoring_file(f):
+    # like app.parse_fitfile, the samples of a monitoring file and any problem reading it.
+    # walking and running steps logged at the same moment become one sample
+    import fitparse
+
+    parsed = {"file": f, "samples": [], "errors": []}
+
+    try:
+        samples = {}
+        for series, timestamp, value in read_monitoring(f):
+            if series == SERIES["steps"][0] and (series, timestamp) in samples:
+                value += samples[series, timestamp]
+            samples[series, timestamp] = value
+
+        parsed["samples"] = [(*key, value) for key, value in samples.items()]
+    except (fitparse.FitParseError, ValueError) as e:
+        parsed["samples"] = []
+        parsed["errors"] = [f"[FILE ERROR] failed to parse monitoring file {f}, skipping it.\n{e}"]
+
+    return parsed
@@ -0,0 +1,202 @@
+from itertools import islice
+import lzma
+import struct
+import zlib
+
+import numpy as np
+
+# an activity's records as one compressed blob in ActivityRecordBlob, the alternative
+# to a row per second in ActivityRecord (`app.py --record-layout blob`). every column
+# is stored as the integer FIT itself stores it in (eg. speed in mm/s, altitude in
+# fifths of a metre above -500m), so decoding gives back exactly the floats fitparse
+# produced and nothing read from a fitfile is lost. timestamps, distances and positions
+# are delta encoded, and each column's bytes are shuffled (every value's first byte,
+# then every second byte...) so the runs of near identical bytes compress well:
+#
+#   b"FREC", uint8 version, uint8 codec, uint32 record count, then compressed: per
+#   column in COLUMNS order, a null bitmap (np.packbits, nullable columns only) and
+#   the shuffled values
+#
+# records come back sorted by timestamp, as reading ActivityRecord in time order does
+
+MAGIC = b"FREC"
+VERSION = 1
+HEADER = struct.Struct("<4sBBI")
+
+# name: (stored dtype, scale, offset, delta encoded, nullable), in RECORD_INSERT order
+COLUMNS = {
+    "timestamp": ("<i8", None, 0, True, False),
+    "distance": ("<i8", 100, 0, True, False),
+    "enhanced_speed": ("<u4", 1000, 0, False, False),
+    "speed": ("<u4", 1000, 0, False, False),
+    "heart_rate": ("<u1", None, 0, False, False),
+    "cadence": ("<u1", None, 0, False, False),
+    "fractional_cadence": ("<u1", 128, 0, False, False),
+    "enhanced_altitude": ("<u4", 5, 500, False, True),
+    "altitude": ("<u4", 5, 500, False, True),
+    "position_long": ("<i4", None, 0, True, True),
+    "position_lat": ("<i4", None, 0, True, True),
+}
+
+# rows from_rows turns into arrays at a time
+CHUNK_ROWS = 5000
+
+# codec name: (id in the header, compress, decompress)
+CODECS = {
+    "zlib": (0, lambda data: zlib.compress(data, 6), zlib.decompress),
+    "lzma": (1, lambda data: lzma.compress(data, preset=6), lzma.decompress),
+}
+
+
+def from_rows(rows) -> dict:
+    # {column: array} sorted by timestamp from record rows as RecordData.row gives them
+    # (timestamp as a naive utc datetime) or as read from ActivityRecord with the
+    # timestamp as epoch seconds. missing values become nan. rows are turned into arrays
+    # CHUNK_ROWS at a time, so a long activity's rows are never all held as tuples
+    chunks = []
+    rows = iter(rows)
+    while chunk := list(islice(rows, CHUNK_ROWS)):
+        chunks.append(chunk_columns(chunk))
+
+    return concatenate(chunks)
+
+
+def chunk_columns(rows: list) -> dict:
+    # from_rows of a list of rows, left in the order given
+    timestamps = np.array([row[0] for row in rows], dtype="datetime64[s]").astype(np.int64)
+    values = np.array([row[1:] for row in rows], dtype=np.float64).reshape(len(rows), len(COLUMNS)-1)
+
+    columns = {"timestamp": timestamps}
+    for i, name in enumerate(list(COLUMNS)[1:]):
+        columns[name] = values[:, i].copy()
+
+    return columns
+
+
+def concatenate(chunks: list) -> dict:
+    # one {column: array} sorted by timestamp from the chunk_columns of consecutive
+    # chunks, emptying them as it goes so a column isn't held twice
+    if not chunks:
+        chunks = [chunk_columns([])]
+
+    columns = {name: np.concatenate([chunk.pop(name) for chunk in chunks]) for name in COLUMNS}
+    timestamps = columns["timestamp"]
+    if np.all(timestamps[1:] >= timestamps[:-1]):
+        return columns
+
+    order = np.argsort(timestamps, kind="stable")
+    return {name: values[order] for name, values in columns.items()}
+
+
+def to_rows(columns: dict, names=COLUMNS) -> list:
+    # rows of the named columns as they're read from ActivityRecord: timestamps as
+    # text, integers as ints and None where a value is missing
+    out = []
+    for name in names:
+        values = columns[name]
+        _, scale, _, _, nullable = COLUMNS[name]
+        if name == "timestamp":
+            out.append(timestamp_text(values))
+        elif nullable and scale is None:
+            out.append([None if value != value else int(value) for value in values.tolist()])
+        elif nullable:
+            out.append(np.where(np.isnan(values), None, values).tolist())
+        else:
+            out.append(values.tolist())
+
+    return list(zip(*out))
+
+
+def shuffle(values: np.ndarray) -> bytes:
+    return values.view(np.uint8).reshape(len(values), values.itemsize).T.tobytes()
+
+
+def unshuffle(data: bytes, dtype: np.dtype, count: int) -> np.ndarray:
+    return np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, count).T.copy().view(dtype).ravel()
+
+
+def encode(columns: dict, codec="zlib") -> bytes:
+    codec_id, compress, _ = CODECS[codec]
+    timestamps = np.asarray(columns["timestamp"], dtype=np.int64)
+    order = np.argsort(timestamps, kind="stable")
+    count = len(timestamps)
+
+    out = []
+    for name, (dtype, scale, offset, delta, nullable) in COLUMNS.items():
+        values = np.asarray(columns[name])[order]
+
+        present = None
+        if nullable:
+            present = ~np.isnan(values)
+            out.append(np.packbits(present).tobytes())
+
+        if scale is not None:
+            values = np.round((values + offset) * scale)
+        if present is not None:
+            # missing values repeat the last one present so they cost nothing as deltas
+            last = np.maximum.accumulate(np.where(present, np.arange(count), 0))
+            values = np.where(present[last], values[last], 0)
+
+        values = values.astype(dtype)
+        if delta:
+            values = np.diff(values, prepend=values.dtype.type(0))
+        out.append(shuffle(values))
+
+    return HEADER.pack(MAGIC, VERSION, codec_id, count) + compress(b"".join(out))
+
+
+def codec(data: bytes) -> str:
+    codec_id = HEADER.unpack_from(data)[2]
+    return next(name for name, (i, _, _) in CODECS.items() if i == codec_id)
+
+
+def decode(data: bytes) -> dict:
+    # {column: array} sorted by timestamp. timestamps are int64 epoch seconds, heart
+    # rate and cadence int64, everything else float64 with nan where missing
+    magic, version, codec_id, count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a record blob")
+    decompress = next(decompress for i, _, decompress in CODECS.values() if i == codec_id)
+    body = memoryview(decompress(data[HEADER.size:]))
+
+    columns = {}
+    position = 0
+    for name, (dtype, scale, offset, delta, nullable) in COLUMNS.items():
+        dtype = np.dtype(dtype)
+
+        present = None
+        if nullable:
+            size = (count + 7) // 8
+            present = np.unpackbits(np.frombuffer(body[position:position+size], dtype=np.uint8), count=count).astype(bool)
+            position += size
+
+        size = count * dtype.itemsize
+        values = unshuffle(body[position:position+size], dtype, count)
+        position += size
+
+        if delta:
+            values = np.cumsum(values, dtype=dtype)
+        if scale is not None or nullable:
+            values = values.astype(np.float64)
+        else:
+            values = values.astype(np.int64)
+        if scale is not None:
+            values = values / scale
+        if offset:
+            values = values - offset
+        if present is not None:
+            values[~present] = np.nan
+
+        columns[name] = values
+
+    return columns
+
+
+def timestamp_text(timestamps: np.ndarray) -> list:
+    # epoch seconds as the "YYYY-MM-DD HH:MM:SS" text ActivityRecord stores
+    return [text.replace("T", " ") for text in np.datetime_as_string(timestamps.astype("datetime64[s]")).tolist()]
+
+
+def epoch_seconds(texts) -> np.ndarray:
+    # the inverse of timestamp_text
+    return np.array(texts, dtype="datetime64[s]").astype(np.int64)
@@ -0,0 +1,234 @@
+from pathlib import Path
+import gzip
+import hashlib
+import mimetypes
+import os
+import signal
+import socket
+import socketserver
+import threading
+import time
+import traceback
+
+from werkzeug.http import parse_accept_header, parse_etags, quote_etag
+from werkzeug.serving import ThreadedWSGIServer, WSGIRequestHandler
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# production serving for `app.py -r --workers N`. the parent binds the port, forks N
+# workers that each accept from the same listening socket with a threaded werkzeug
+# server, and restarts any that die. the workers share the read-only db (and any
+# snapshot) through the page cache, every one with its own connection pool and
+# response cache. SIGTERM or ctrl-c stops accepting, lets requests in flight finish
+# and exits. static/ is read and compressed once before forking, then served from
+# memory with an etag, a max-age and gzip (or brotli, when installed) as accepted
+
+# seconds browsers may reuse a static file before revalidating it, kept short as the
+# file names don't change when their contents do
+STATIC_MAX_AGE = 300
+# seconds requests in flight get to finish once told to stop, before workers are killed
+SHUTDOWN_TIMEOUT = 10
+# seconds a connection may go without sending anything, which also bounds how long a
+# stopping worker waits on a client that connected but never sent its request
+REQUEST_TIMEOUT = 5
+# seconds before restarting a worker that exited, so one failing at startup can't spin
+RESTART_DELAY = 1.0
+
+# content codings static files are precompressed with, in order of preference
+ENCODERS = {}
+if brotli is not None:
+    ENCODERS["br"] = lambda data: brotli.compress(data, quality=11)
+ENCODERS["gzip"] = lambda data: gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def static_file(f):
+    # (content type, etag, {content coding: body}), only keeping the codings that
+    # make the file smaller
+    data = f.read_bytes()
+    bodies = {"identity": data}
+    for coding, encode in ENCODERS.items():
+        body = encode(data)
+        if len(body) < len(data):
+            bodies[coding] = body
+
+    mimetype = mimetypes.guess_type(f.name)[0] or "application/octet-stream"
+    if mimetype.startswith("text/") or mimetype == "application/javascript":
+        mimetype += "; charset=utf-8"
+
+    return mimetype, hashlib.blake2b(data, digest_size=12).hexdigest(), bodies
+
+
+class StaticFiles:
+    # wsgi middleware answering GET and HEAD requests for the files in directory (and
+    # / with index.html) from memory, passing everything else on to app. files are
+    # read when it's created, changes to them need a restart
+    def __init__(self, app, directory, index="index.html", max_age=STATIC_MAX_AGE):
+        self.app = app
+        self.max_age = max_age
+        self.files = {}
+
+        directory = Path(directory)
+        for f in sorted(directory.rglob("*")):
+            if f.is_file():
+                self.files["/" + f.relative_to(directory).as_posix()] = static_file(f)
+        if f"/{index}" in self.files:
+            self.files["/"] = self.files[f"/{index}"]
+
+    def __call__(self, environ, start_response):
+        entry = self.files.get(environ.get("PATH_INFO", ""))
+        if entry is None or environ["REQUEST_METHOD"] not in ("GET", "HEAD"):
+            return self.app(environ, start_response)
+
+        mimetype, digest, bodies = entry
+        accepted = parse_accept_header(environ.get("HTTP_ACCEPT_ENCODING"))
+        coding = next((coding for coding in ENCODERS if coding in bodies and accepted[coding]), "identity")
+
+        # each coding is a different representation, so it has its own etag
+        etag = f"{digest}-{coding}"
+        headers = [
+            ("ETag", quote_etag(etag)),
+            ("Cache-Control", f"public, max-age={self.max_age}"),
+            ("Vary", "Accept-Encoding"),
+        ]
+
+        if parse_etags(environ.get("HTTP_IF_NONE_MATCH")).contains(etag):
+            start_response("304 Not Modified", headers)
+            return []
+
+        body = bodies[coding]
+        headers += [("Content-Type", mimetype), ("Content-Length", str(len(body)))]
+        if coding != "identity":
+            headers.append(("Content-Encoding", coding))
+
+        start_response("200 OK", headers)
+        return [b"" if environ["REQUEST_METHOD"] == "HEAD" else body]
+
+
+class RequestHandler(WSGIRequestHandler):
+    timeout = REQUEST_TIMEOUT
+
+    def log_request(self, code="-", size="-"):
+        # a line per request costs more than answering most of them, errors are
+        # still logged
+        pass
+
+
+class WorkerServer(ThreadedWSGIServer):
+    # request threads are joined when the server closes, so none are cut off
+    daemon_threads = False
+
+    def drain(self):
+        # answers the connections already queued on the shared socket once no more
+        # are being accepted, rather than them being reset when it closes
+        while True:
+            try:
+                request, address = self.get_request()
+            except BlockingIOError:
+                return
+            self.process_request(request, address)
+
+
+def serve_worker(app, listener, host, port):
+    # signals are blocked before any thread starts, so every thread inherits that and
+    # they're only taken by the sigwait below. a handler starting the shutdown could
+    # run while this thread holds one of threading's locks, starting a request thread
+    signals = {signal.SIGTERM, signal.SIGINT}
+    signal.pthread_sigmask(signal.SIG_BLOCK, signals)
+
+    server = WorkerServer(host, port, app, RequestHandler, fd=listener.fileno())
+    # the server has its own copy of the socket, and the kernel keeps queueing
+    # connections until every copy is closed
+    listener.close()
+    # every worker waiting on the shared socket wakes for a new connection, and those
+    # losing the race to accept it would otherwise block in accept rather than going
+    # back to waiting (and noticing they've been told to stop)
+    server.socket.setblocking(False)
+
+    # socketserver's loop rather than werkzeug's, which closes the socket as it returns
+    serving = threading.Thread(target=socketserver.BaseServer.serve_forever, args=(server,))
+    serving.start()
+    signal.sigwait(signals)
+
+    server.shutdown()
+    serving.join()
+    server.drain()
+    server.server_close()
+
+
+def run(app, host="127.0.0.1", port=5000, workers=2, started=None):
+    # serves app from `workers` forked processes until SIGTERM or ctrl-c, blocking
+    # until every worker has exited. started is called in this process once the
+    # workers are running
+    wsgi = StaticFiles(app, app.static_folder)
+    listener = socket.create_server((host, port), backlog=1024)
+
+    children = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                serve_worker(wsgi, listener, host, port)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                # never return into the parent's code
+                os._exit(code)
+        children.add(pid)
+
+    def kill_remaining(signum, frame):
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def stop(signum, frame):
+        nonlocal stopping
+        if stopping:
+            return
+        stopping = True
+        print(f" * stopping, waiting up to {SHUTDOWN_TIMEOUT}s for requests in flight")
+        listener.close()
+
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        signal.alarm(SHUTDOWN_TIMEOUT)
+
+    previous = {signum: signal.signal(signum, stop) for signum in (signal.SIGTERM, signal.SIGINT)}
+    previous[signal.SIGALRM] = signal.signal(signal.SIGALRM, kill_remaining)
+
+    for _ in range(workers):
+        spawn()
+    print(f" * serving on http://{host}:{port} with {workers} worker processes "
+          f"(static files {', '.join(ENCODERS)} precompressed)")
+    if started is not None:
+        started()
+
+    try:
+        while children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            children.discard(pid)
+            if not stopping:
+                print(f" * worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, starting another")
+                time.sleep(RESTART_DELAY)
+                if not stopping:
+                    spawn()
+    finally:
+        listener.close()
+        signal.alarm(0)
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
@@ -1,18 +1,247 @@
-from flask import Flask, request
+from flask import Flask, Response, request, g
 
+from pathlib import Path
+import hashlib
+import math
+import queue
 import sqlite3
 import sys
+import time
+
+import numpy as np
+
+import aggregate
+import best_efforts
+import cache
+import columnar
+import downsample
+import metrics
+import monitoring
+import record_blob
+import snapshot
+import track
 
 app = Flask(__name__, static_url_path="")
 
+# path of the db built by app.py, and how many idle read-only connections to keep
+# around between requests
+app.config.setdefault("DB_PATH", "fitdata.db")
+app.config.setdefault("DB_POOL_SIZE", 8)
+# bytes of api response bodies kept in memory between ingests, 0 turns the cache off
+app.config.setdefault("RESPONSE_CACHE_BYTES", 64 * 1024 * 1024)
+# time requests and sql statements, served at /api/_metrics
+app.config.setdefault("METRICS", False)
+# directory of the memory mapped snapshot exported by `app.py --snapshot`, which the
+# summary, totals and records routes read instead of the db while it's up to date
+app.config.setdefault("SNAPSHOT_PATH", None)
+
+
+# the server never writes, so every request borrows an already open read-only
+# connection instead of connecting (and leaking handles) per request
+class ConnectionPool:
+    def __init__(self):
+        self._idle = queue.LifoQueue()
+        self._path = None
+        self._factory = None
+
+    def _open(self, path, factory):
+        con = sqlite3.connect(Path(path).resolve().as_uri() + "?mode=ro", uri=True, check_same_thread=False, factory=factory)
+        con.execute("PRAGMA query_only = ON")
+        # 64MiB page cache and up to 1GiB of the file memory mapped per connection
+        con.execute("PRAGMA cache_size = -65536")
+        con.execute("PRAGMA mmap_size = 1073741824")
+        return con
+
+    def get(self, path, factory=sqlite3.Connection):
+        if (path, factory) != (self._path, self._factory):
+            self.close()
+            self._path, self._factory = path, factory
+
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._open(path, factory)
+
+    def put(self, con, max_idle):
+        if con.in_transaction:
+            con.rollback()
+
+        if self._idle.qsize() < max_idle:
+            self._idle.put(con)
+        else:
+            con.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+pool = ConnectionPool()
+
+
+def get_db():
+    # connection for the current request, returned to the pool on teardown
+    if "db" not in g:
+        g.db = pool.get(app.config["DB_PATH"], metrics.TimedConnection if app.config["METRICS"] else sqlite3.Connection)
+    return g.db
+
+
+@app.teardown_appcontext
+def release_db(exception):
+    con = g.pop("db", None)
+    if con is not None:
+        pool.put(con, app.config["DB_POOL_SIZE"])
+
+
+generation = cache.GenerationWatcher()
+responses = cache.ResponseCache(app.config["RESPONSE_CACHE_BYTES"])
+snapshots = snapshot.SnapshotWatcher()
+
+
+def get_snapshot():
+    # snapshot of the db's current generation, None without one (eg. while the export
+    # following an ingest is still being written) so the db is read instead
+    if app.config["SNAPSHOT_PATH"] is None:
+        return None
+    if "snapshot" not in g:
+        # the generation the response is cached under, when there is one
+        current = g.generation if "generation" in g else generation.current(app.config["DB_PATH"])
+        g.snapshot = snapshots.current(app.config["SNAPSHOT_PATH"], current)
+    return g.snapshot
+
+
+# api routes whose responses change without the db generation changing
+UNCACHED_ENDPOINTS = {"ingest_status", "metrics_text"}
+
+
+# registered before the response cache so cached and 304 responses are timed too, and
+# after_request functions run in reverse so this sees the finished response
+@app.before_request
+def start_timer():
+    if app.config["METRICS"]:
+        g.started = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    if "started" not in g:
+        return response
+
+    route = (("route", request.url_rule.rule if request.url_rule else "unmatched"),)
+    metrics.registry.observe("fitdata_http_request_duration_seconds", (*route, ("status", response.status_code)),
+        time.perf_counter() - g.started)
+    if not response.is_streamed:
+        metrics.registry.inc("fitdata_http_response_bytes_total", route, response.calculate_content_length() or 0)
+    return response
+
+
+# every api response only depends on the request and the db generation, so clients
+# get an etag to revalidate with and computed bodies are kept until the next ingest.
+# a matching If-None-Match or a cached body is answered before any connection is taken
+@app.before_request
+def cached_response():
+    if request.method != "GET" or not request.path.startswith("/api/") or request.endpoint in UNCACHED_ENDPOINTS:
+        return None
+
+    g.generation = generation.current(app.config["DB_PATH"])
+    # query args keep their order, it decides the column order of /api/summary
+    g.cache_key = (app.config["DB_PATH"], request.path, tuple(request.args.items(multi=True)), wants_columnar())
+    g.etag = hashlib.blake2b(repr((g.generation, g.cache_key)).encode(), digest_size=12).hexdigest()
+
+    if request.if_none_match.contains(g.etag):
+        g.cached = True
+        return Response(status=304)
+
+    entry = responses.get(g.generation, g.cache_key)
+    if entry is not None:
+        g.cached = True
+        body, mimetype = entry
+        return Response(body, mimetype=mimetype)
+
+    return None
+
+
+@app.after_request
+def cache_response(response):
+    if "etag" not in g or response.status_code not in (200, 304):
+        return response
+
+    if not g.get("cached") and app.config["RESPONSE_CACHE_BYTES"] > 0:
+        responses.max_bytes = app.config["RESPONSE_CACHE_BYTES"]
+        responses.put(g.generation, g.cache_key, response.get_data(), response.mimetype)
+
+    # clients may keep the response but have to revalidate it every time
+    response.set_etag(g.etag)
+    response.headers["Cache-Control"] = "no-cache"
+    response.vary.add("Accept")
+    return response
+
+
+def wants_columnar():
+    # json unless asked for with ?format=columnar or an Accept header preferring it
+    if "format" in request.args:
+        return request.args["format"] == "columnar"
+    return request.accept_mimetypes.best_match(["application/json", columnar.MIMETYPE]) == columnar.MIMETYPE
+
+
+def columnar_response(table):
+    return Response(columnar.encode(table), mimetype=columnar.MIMETYPE)
+
+
+# sqlite integers are 64 bit, a larger argument can't be bound into a query
+SQLITE_INT_MAX = 2**63 - 1
+
+
+def positive_int(value):
+    # a query argument as an int from 1 to SQLITE_INT_MAX, None if it isn't one. only
+    # ascii digits, str.isdigit also passes the likes of "²" that int() rejects
+    if not (value.isascii() and value.isdigit()):
+        return None
+    value = int(value)
+    return value if 1 <= value <= SQLITE_INT_MAX else None
+
+
+# sql selecting each column for a columnar response, times as unix epoch seconds
+def epoch_seconds(column):
+    return f"CAST(strftime('%s', {column}) AS INTEGER) AS {column}"
+
+
+# record columns as returned by the records route, and their columnar types
+RECORD_COLUMNS = ("timestamp", "enhanced_speed", "heart_rate", "cadence", "enhanced_altitude")
+RECORD_DTYPE = np.dtype([
+    ("timestamp", "<i8"),
+    ("enhanced_speed", "<f4"),
+    ("heart_rate", "u1"),
+    ("cadence", "u1"),
+    ("enhanced_altitude", "<f4"),
+])
+
+
 @app.route("/")
 def hello_world():
     return app.send_static_file("index.html")
 
+@app.route("/api/ingest")
+def ingest_status():
+    # counters of the background ingest started by `app.py --watch`
+    watcher = app.config.get("INGEST_WATCHER")
+    if watcher is None:
+        return {"watching": False}
+
+    return {"watching": True, **watcher.status()}
+
+@app.route("/api/_metrics")
+def metrics_text():
+    if not app.config["METRICS"]:
+        return "metrics are off, run with --metrics", 404
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
 @app.route("/api/activity/<datetime>/totals")
 def activity_totals(datetime):
-    con = sqlite3.connect("fitdata.db")
-    cur = con.cursor()
+    cur = get_db().cursor()
 
     try:
         q = cur.execute("SELECT * FROM Activity WHERE start_time = ?", (datetime,)).fetchall()
@@ -23,25 +252,336 @@ def activity_totals(datetime):
 
 @app.route("/api/activity/<datetime>/records")
 def activity_records(datetime):
-    con = sqlite3.connect("fitdata.db")
-    cur = con.cursor()
+    # eg. /api/activity/<datetime>/records?max_points=1000&lap=2&format=columnar
+    # max_points gives a downsampled series that keeps the peaks of every column,
+    # lap (counted from 1) only the records from that lap of the activity
+
+    max_points = request.args.get("max_points")
+    if max_points is not None:
+        max_points = positive_int(max_points)
+        if max_points is None:
+            return "invalid max_points argument", 400
+
+    lap = request.args.get("lap")
+    if lap is not None:
+        lap = positive_int(lap)
+        if lap is None:
+            return "invalid lap argument", 400
+
+    snap = get_snapshot()
+
+    try:
+        if snap is not None:
+            records = snap.activity_records(datetime, max_points, lap)
+            if records is None:
+                return "invalid lap argument", 400
+        else:
+            cur = get_db().cursor()
+            if lap is not None:
+                lap = lap_bounds(cur, datetime, lap)
+                if lap is None:
+                    return "invalid lap argument", 400
+
+            # levels cover whole activities so a lap always comes from the full records,
+            # which are in ActivityRecordBlob instead of ActivityRecord for a blob layout db
+            level = record_level(cur, datetime, max_points) if lap is None else None
+            records = blob_records(cur, datetime, lap) if level is None else None
+
+        if wants_columnar():
+            if records is not None:
+                table = np.empty(len(records["timestamp"]), dtype=RECORD_DTYPE)
+                for column in RECORD_COLUMNS:
+                    table[column] = records[column]
+            else:
+                columns = ",".join([epoch_seconds("timestamp"), *RECORD_COLUMNS[1:]])
+                table = columnar.from_rows(select_records(cur, datetime, columns, level, lap), RECORD_DTYPE)
+            if max_points is not None:
+                table = downsample.downsample_table(table, max_points)
+
+            return columnar_response(table)
+
+        if records is not None:
+            q = record_blob.to_rows(records, RECORD_COLUMNS)
+        else:
+            q = select_records(cur, datetime, ",".join(RECORD_COLUMNS), level, lap).fetchall()
+        if max_points is not None:
+            q = downsample.downsample_rows(q, max_points)
+
+    except sqlite3.Error:
+        return "invalid date given", 400
+
+    return q
+
+def lap_bounds(cur, datetime, lap):
+    # [start, stop) timestamps of the activity's lap-th lap, None if it has fewer laps.
+    # a lap runs up to the start of the next one, so a record at the moment one lap
+    # ends and the next begins is only in the later one
+    return cur.execute("""
+        SELECT start_time, coalesce(
+            lead(start_time) OVER (ORDER BY start_time),
+            datetime(end_time, '+1 second')
+        )
+        FROM Lap
+        WHERE activity_id=(
+            SELECT activity_id FROM Activity WHERE start_time = ?
+        )
+        ORDER BY start_time
+        LIMIT 1 OFFSET ?
+    """, (datetime, lap-1)).fetchone()
+
+def record_level(cur, datetime, max_points):
+    # the largest level precomputed at ingest that fits in max_points, so the work done
+    # doesn't depend on the length of the activity. a level is only stored when the
+    # activity has more records than it, otherwise (None) the full series is small
+    # enough to read instead. below the smallest level the caller still has to
+    # downsample what's returned
+    if max_points is None:
+        return None
+
+    fitting = [level for level in downsample.LEVELS if level <= max_points]
+    level = fitting[-1] if fitting else downsample.LEVELS[0]
+
+    stored = cur.execute("""
+        SELECT 1 FROM ActivityRecordLevel
+        WHERE activity_id=(
+            SELECT activity_id FROM Activity WHERE start_time = ?
+        ) AND max_points = ?
+        LIMIT 1
+    """, (datetime, level)).fetchone()
+
+    return level if stored else None
+
+def select_records(cur, datetime, columns, level=None, lap=None):
+    # cursor over an activity's records in time order, from the given record_level or
+    # all of them. lap is a [start, stop) pair of timestamps, which narrows the index
+    # range scanned
+    table = "ActivityRecord"
+    filters = ""
+    params = (datetime,)
+
+    if lap is not None:
+        filters = "AND timestamp >= ? AND timestamp < ?"
+        params = (datetime, *lap)
+
+    elif level is not None:
+        table = "ActivityRecordLevel"
+        filters = "AND max_points = ?"
+        params = (datetime, level)
+
+    return cur.execute(f"""
+        SELECT {columns}
+        FROM {table}
+        WHERE activity_id=(
+            SELECT activity_id FROM Activity WHERE start_time = ?
+        ) {filters}
+        ORDER BY {table}.timestamp
+    """, params)
+
+def blob_records(cur, datetime, lap=None):
+    # {column: array} of the activity's records (or those in the [start, stop) lap) in
+    # time order when they're stored as a blob, None when they're rows of ActivityRecord
+    row = cur.execute("""
+        SELECT data FROM ActivityRecordBlob
+        WHERE activity_id=(
+            SELECT activity_id FROM Activity WHERE start_time = ?
+        )
+    """, (datetime,)).fetchone()
+    if row is None:
+        return None
+
+    records = record_blob.decode(row[0])
+    if lap is not None:
+        start, stop = record_blob.epoch_seconds(lap)
+        inside = (records["timestamp"] >= start) & (records["timestamp"] < stop)
+        records = {column: values[inside] for column, values in records.items()}
+
+    return records
+
+@app.route("/api/activity/<datetime>/laps")
+def activity_laps(datetime):
+    # return [lap, start, end, distance, timer time, pace (s/km), avg speed, avg hr,
+    # max hr, avg cadence, max cadence, ascent, descent] for each lap in order,
+    # splits coming from the lap totals the watch recorded rather than the records
+    cur = get_db().cursor()
+
+    try:
+        q = cur.execute(
+            """
+            select
+                row_number() over (order by start_time) as lap,
+                start_time,
+                end_time,
+                total_distance,
+                total_timer_time,
+                total_timer_time / nullif(total_distance, 0) * 1000 as pace,
+                enhanced_avg_speed,
+                avg_heart_rate,
+                max_heart_rate,
+                avg_running_cadence,
+                max_running_cadence,
+                total_ascent,
+                total_descent
+            from Lap
+            where activity_id=(
+                select activity_id from Activity where start_time = ?
+            )
+            order by start_time
+            """, (datetime,)).fetchall()
+    except sqlite3.Error:
+        return "invalid date given", 400
+
+    return q
+
+@app.route("/api/activity/<datetime>/track")
+def activity_track(datetime):
+    # eg. /api/activity/<datetime>/track?tolerance=10
+    # return [tolerance, points, distance, encoded polyline] for the activity's gps track,
+    # simplified at ingest to the largest of track.TOLERANCES (metres) not above the one
+    # asked for, or the smallest if it's below all of them. empty without gps
+
+    try:
+        tolerance = float(request.args.get("tolerance", default=track.TOLERANCES[1]))
+    except ValueError:
+        return "invalid tolerance argument", 400
+
+    fitting = [level for level in track.TOLERANCES if level <= tolerance]
+    level = fitting[-1] if fitting else track.TOLERANCES[0]
+
+    cur = get_db().cursor()
 
     try:
         q = cur.execute("""
-            SELECT timestamp,enhanced_speed,heart_rate,cadence,enhanced_altitude 
-            FROM ActivityRecord 
+            SELECT tolerance, points, distance, polyline
+            FROM ActivityTrack
+            WHERE activity_id=(
+                SELECT activity_id FROM Activity WHERE start_time = ?
+            ) AND tolerance = ?
+        """, (datetime, level)).fetchone()
+    except sqlite3.Error:
+        return "invalid date given", 400
+
+    return list(q) if q else []
+
+@app.route("/api/activity/<datetime>/load")
+def activity_load(datetime):
+    # return [trimp, seconds below zone 1, seconds in zones 1-5] for the activity, zones
+    # as in training_load.HR_ZONES
+    cur = get_db().cursor()
+
+    try:
+        q = cur.execute("""
+            SELECT trimp, zone_0, zone_1, zone_2, zone_3, zone_4, zone_5
+            FROM ActivityLoad
             WHERE activity_id=(
                 SELECT activity_id FROM Activity WHERE start_time = ?
             )
-        """, (datetime,)).fetchall()
+        """, (datetime,)).fetchone()
+    except sqlite3.Error:
+        return "invalid date given", 400
+
+    return list(q) if q else []
+
+@app.route("/api/activity/<datetime>/similar")
+def similar_activities(datetime):
+    # eg. /api/activity/<datetime>/similar?threshold=50
+    # return [start time, total distance, difference] for other activities along the same
+    # route, closest first. difference is track.route_difference in metres between the
+    # 10m tracks, at most threshold. only activities whose bounding box edges all lie
+    # within threshold of this one's are compared, found from the ActivityBounds r*tree
+
+    try:
+        threshold = float(request.args.get("threshold", default=50))
+    except ValueError:
+        return "invalid threshold argument", 400
+    # float() takes inf and nan, which would compare every stored track
+    if not math.isfinite(threshold):
+        return "invalid threshold argument", 400
+
+    cur = get_db().cursor()
 
+    try:
+        target = cur.execute("""
+            SELECT ActivityBounds.activity_id, min_lat, max_lat, min_long, max_long, polyline
+            FROM Activity
+            JOIN ActivityBounds ON ActivityBounds.activity_id = Activity.activity_id
+            JOIN ActivityTrack ON ActivityTrack.activity_id = Activity.activity_id AND tolerance = ?
+            WHERE start_time = ?
+        """, (track.TOLERANCES[1], datetime)).fetchone()
     except sqlite3.Error:
         return "invalid date given", 400
 
+    if target is None:
+        return []
+
+    activity_id, min_lat, max_lat, min_long, max_long, polyline = target
+    route = track.decode_polyline(polyline)
+    d_lat, d_long = degrees_around(threshold, (min_lat + max_lat) / 2)
+
+    candidates = cur.execute("""
+        SELECT Activity.start_time, Activity.total_distance, ActivityTrack.polyline
+        FROM ActivityBounds
+        JOIN Activity ON Activity.activity_id = ActivityBounds.activity_id
+        JOIN ActivityTrack ON ActivityTrack.activity_id = ActivityBounds.activity_id AND tolerance = ?
+        WHERE ActivityBounds.min_lat BETWEEN ? AND ? AND ActivityBounds.max_lat BETWEEN ? AND ?
+        AND ActivityBounds.min_long BETWEEN ? AND ? AND ActivityBounds.max_long BETWEEN ? AND ?
+        AND ActivityBounds.activity_id != ?
+    """, (track.TOLERANCES[1],
+          min_lat - d_lat, min_lat + d_lat, max_lat - d_lat, max_lat + d_lat,
+          min_long - d_long, min_long + d_long, max_long - d_long, max_long + d_long,
+          activity_id)).fetchall()
+
+    q = []
+    for start_time, total_distance, polyline in candidates:
+        difference = track.route_difference(route, track.decode_polyline(polyline))
+        if difference <= threshold:
+            q.append((start_time, total_distance, difference))
+
+    return sorted(q, key=lambda row: row[2])
+
+@app.route("/api/activities/near")
+def activities_near():
+    # eg. /api/activities/near?lat=51.5&lon=-0.1&radius=200
+    # return [start time, total distance, closest approach] for every activity that
+    # passed within radius metres (default 200) of the point, in date order. the
+    # TrackSegment r*tree finds the activities with a piece of track near the point,
+    # then each of those is measured exactly against its 2m track
+
+    try:
+        lat = float(request.args["lat"])
+        lon = float(request.args["lon"])
+        radius = float(request.args.get("radius", default=200))
+    except (KeyError, ValueError):
+        return "invalid lat, lon or radius argument", 400
+    # float() takes inf and nan, which degrees_around can't place or would cover the world
+    if not all(map(math.isfinite, (lat, lon, radius))):
+        return "invalid lat, lon or radius argument", 400
+
+    d_lat, d_long = degrees_around(radius, lat)
+    cur = get_db().cursor()
+
+    candidates = cur.execute("""
+        SELECT Activity.start_time, Activity.total_distance, ActivityTrack.polyline
+        FROM ActivityTrack
+        JOIN Activity ON Activity.activity_id = ActivityTrack.activity_id
+        WHERE ActivityTrack.activity_id IN (
+            SELECT activity_id FROM TrackSegment
+            WHERE max_lat >= ? AND min_lat <= ? AND max_long >= ? AND min_long <= ?
+        ) AND tolerance = ?
+        ORDER BY Activity.start_time
+    """, (lat - d_lat, lat + d_lat, lon - d_long, lon + d_long, track.TOLERANCES[0])).fetchall()
+
+    q = []
+    for start_time, total_distance, polyline in candidates:
+        closest = float(track.distance_to_line(np.array([lat]), np.array([lon]), *track.decode_polyline(polyline))[0])
+        if closest <= radius:
+            q.append((start_time, total_distance, closest))
+
     return q
 
-def activity_laps():
-    return "unimplemented"
+def degrees_around(metres, lat):
+    # (lat, long) degrees spanning at least `metres` either side of a point at lat
+    d_lat = math.degrees(metres / track.EARTH_RADIUS)
+    return d_lat, d_lat / max(math.cos(math.radians(lat)), 1e-6)
 
 @app.route("/api/summary/totals")
 def totals():
@@ -52,8 +592,14 @@ def totals():
     end = request.args.get("end", default="9999-01-01")
 
     group_by = request.args.get("group_by", default="week")
-    con = sqlite3.connect("fitdata.db")
-    cur = con.cursor()
+    if group_by not in ("all", *SUMMARY_PERIODS):
+        return "invalid group_by argument", 400
+
+    snap = get_snapshot()
+    if snap is not None:
+        return snapshot_totals(snap, group_by, start, end)
+
+    cur = get_db().cursor()
 
     if group_by=="week":
         representative_date = "weekday 1"
@@ -72,13 +618,29 @@ def totals():
             where start_time between ? and ?
             """, (start,end)).fetchall()
 
-        con.close()
         return q
-    else:
-        con.close()
-        return "invalid group_by argument", 400
 
-    q = cur.execute(
+    # buckets lying entirely inside start..end come straight from the rollups kept by
+    # ingest. at most the two buckets straddling start and end are partly covered,
+    # those are grouped from Activity with the range clipped to the bucket
+    buckets = cur.execute(
+                """
+                select
+                    summary_date, num_activities, total_distance, total_time,
+                    first_start_time between ? and ? and last_start_time between ? and ? as covered,
+                    first_start_time, last_start_time
+                from ActivityTotals
+                where group_by = ? and last_start_time >= ? and first_start_time <= ?
+                order by summary_date
+                """, (start,end,start,end,group_by,start,end)).fetchall()
+
+    q = []
+    for summary_date, num_activities, total_distance, total_time, covered, first_start_time, last_start_time in buckets:
+        if covered:
+            q.append((summary_date, num_activities, total_distance, total_time))
+            continue
+
+        q += cur.execute(
                 """
                 select 
                     date(start_time, ?) summary_date,
@@ -86,61 +648,302 @@ def totals():
                     sum(total_distance) as total_distance,
                     sum(total_timer_time) as total_time
                 from Activity
-                where start_time between ? and ?
+                where start_time between ? and ? and start_time between ? and ?
                 group by summary_date;
-                """, (representative_date,start,end)).fetchall()
+                """, (representative_date,start,end,first_start_time,last_start_time)).fetchall()
+
+    return q
+
+def snapshot_totals(snap, group_by, start, end):
+    # the totals route from a snapshot, each bucket summed from its activities
+    found = snap.activity_range(start, end)
+    distance = snap.activity["total_distance"][found]
+    time = snap.activity["total_timer_time"][found]
+
+    # summed as sqlite does in start_time order, which the arrays are in, so the floats
+    # are the ones the db gives
+    if group_by == "all":
+        if len(distance) == 0:
+            return [(0, None, None)]
+        return [(len(distance), aggregate.sqlite_sum(distance), aggregate.sqlite_sum(time))]
+
+    periods = snap.activity[f"period_{group_by}"][found]
+    if len(periods) == 0:
+        return []
+
+    # both columns are NOT NULL, so there are no missing values to leave out
+    starts = aggregate.period_starts(periods)
+    return list(zip(
+        periods[starts].tolist(),
+        np.diff(np.append(starts, len(periods))).tolist(),
+        aggregate.sqlite_sums(starts, distance),
+        aggregate.sqlite_sums(starts, time),
+    ))
+
+@app.route("/api/summary/trainingload")
+def training_load():
+    # eg. /api/summary/trainingload?start=date&end=date
+    # return [day, trimp, fitness (ctl), fatigue (atl), form (tsb)] for every day in range,
+    # kept up to date by ingest
+
+    start = request.args.get("start", default="0001-01-01")
+    end = request.args.get("end", default="9999-01-01")
+
+    cur = get_db().cursor()
+
+    q = cur.execute("""
+        SELECT day, load, ctl, atl, tsb
+        FROM DailyLoad
+        WHERE day BETWEEN date(?) AND date(?)
+        ORDER BY day
+    """, (start, end)).fetchall()
 
-    con.close()
     return q
 
 @app.route("/api/summary/personalrecords")
 def prs():
-    return "unimplemented"
+    # eg. /api/summary/personalrecords?limit=3&start=date&end=date
+    # return [name, metres, elapsed seconds, activity start time, effort start, effort end]
+    # for the `limit` fastest efforts over each of best_efforts.DISTANCES, quickest first.
+    # efforts are found at ingest, so each distance is a walk along the
+    # (distance, elapsed_time) index that stops after `limit` matches
+
+    start = request.args.get("start", default="0001-01-01")
+    end = request.args.get("end", default="9999-01-01")
+
+    limit = positive_int(request.args.get("limit", default="1"))
+    if limit is None:
+        return "invalid limit argument", 400
+
+    cur = get_db().cursor()
+
+    q = []
+    for name, metres in best_efforts.DISTANCES.items():
+        q += cur.execute(
+            """
+            select
+                ? as name,
+                BestEffort.distance,
+                BestEffort.elapsed_time,
+                Activity.start_time,
+                BestEffort.start_time,
+                BestEffort.end_time
+            from BestEffort
+            join Activity on Activity.activity_id = BestEffort.activity_id
+            where BestEffort.distance = ? and Activity.start_time between ? and ?
+            order by BestEffort.elapsed_time
+            limit ?
+            """, (name, metres, start, end, limit)).fetchall()
+
+    return q
+
+# Activity columns the summary routes can return
+SUMMARY_COLUMNS = (
+    "start_time",
+    "end_time",
+    "total_elapsed_time",
+    "total_timer_time",
+    "start_position_lat",
+    "start_position_long",
+    "total_ascent",
+    "total_descent",
+    "total_distance",
+    "total_strides",
+    "total_calories",
+    "enhanced_avg_speed",
+    "avg_speed",
+    "enhanced_max_speed",
+    "max_speed",
+    "avg_heart_rate",
+    "max_heart_rate",
+    "avg_running_cadence",
+    "max_running_cadence",
+    "avg_fractional_cadence",
+    "max_fractional_cadence",
+    "total_training_effect",
+    "total_anaerobic_training_effect",
+)
+
+# periods /api/summary/columns can group by, as date() modifiers giving the day each
+# period is labelled with (the same as /api/summary/totals)
+SUMMARY_PERIODS = {
+    "week": "weekday 1",
+    "month": "start of month",
+    "year": "start of year",
+}
 
 @app.route("/api/summary")
 def summary():
     # eg. /api/summary?avg_speed&avg_heart_rate&start=date&end=date
     # return json of [{time, col1, col2, ...}] for all activities in date range
+    # (or with format=columnar, times as epoch seconds and every other column as float64)
 
     start = request.args.get("start", default="0001-01-01")
     end = request.args.get("end", default="9999-01-01")
 
-    cols = ["start_time",
-            "end_time",
-            "total_elapsed_time",
-            "total_timer_time",
-            "start_position_lat" , 
-            "start_position_long" ,
-            "total_ascent" ,
-            "total_descent",
-            "total_distance" ,
-            "total_strides" ,
-            "total_calories" ,
-            "enhanced_avg_speed",
-            "avg_speed",
-            "enhanced_max_speed",
-            "max_speed",
-            "avg_heart_rate",
-            "max_heart_rate",
-            "avg_running_cadence",
-            "max_running_cadence",
-            "avg_fractional_cadence",
-            "max_fractional_cadence",
-            "total_training_effect",
-            "total_anaerobic_training_effect"
-        ]
-
-    remaining_args = [k for k in request.args.keys() if k != "start" and k != "end"]
+    remaining_args = [k for k in request.args.keys() if k not in ("start", "end", "format")]
 
     # if any of the remaining args are not valid column names return error
-    if not all([k in cols for k in remaining_args]):
+    if not all([k in SUMMARY_COLUMNS for k in remaining_args]):
         return "invalid parameter", 400
 
-    con = sqlite3.connect("fitdata.db")
-    cur = con.cursor()
+    # columnar arrays are named, so start_time asked for as a column is returned once
+    selected = list(dict.fromkeys(['start_time']+remaining_args))
+
+    snap = get_snapshot()
+    if snap is not None:
+        found = snap.activity_range(start, end)
+        if wants_columnar():
+            return columnar_response({k: snap.activity[f"{k}_epoch" if k in ("start_time", "end_time") else k][found]
+                for k in selected})
+        return list(zip(*(snap.values(k, found) for k in ['start_time']+remaining_args)))
+
+    cur = get_db().cursor()
+
+    if wants_columnar():
+        columns = [epoch_seconds(k) if k in ("start_time", "end_time") else k for k in selected]
+        dtype = np.dtype([(k, "<i8" if k in ("start_time", "end_time") else "<f8") for k in selected])
+
+        rows = cur.execute(f"SELECT {','.join(columns)} FROM Activity WHERE start_time BETWEEN ? AND ?", (start, end))
+        return columnar_response(columnar.from_rows(rows, dtype))
 
     q = cur.execute(f"SELECT {','.join(['start_time']+remaining_args)} FROM Activity WHERE start_time BETWEEN ? AND ?", (start, end)).fetchall()
 
-    con.close()
+    return q
+
+
+@app.route("/api/summary/columns")
+def summary_columns():
+    # eg. /api/summary/columns?columns=total_distance,avg_heart_rate&moving_average=7&start=date&end=date
+    #     /api/summary/columns?columns=total_distance,avg_heart_rate&group_by=week&stats=sum,max
+    # every chart column in one request and one scan of the range, returned column
+    # oriented as {name: [values]} (or columnar), missing values as null/nan.
+    # per activity: start_time and each column, plus <column>_ma<n>, the mean of the
+    # last n activities, for each moving_average=n given.
+    # with group_by=week|month|year, per period instead: period (its first day, as in
+    # /api/summary/totals), activities and <column>_<stat> for each of stats (default
+    # sum, mean, min and max)
+    start = request.args.get("start", default="0001-01-01")
+    end = request.args.get("end", default="9999-01-01")
+
+    # a column or window asked for twice is returned once
+    columns = list(dict.fromkeys(request.args.get("columns", default="").split(",")))
+    if not all(k in SUMMARY_COLUMNS[2:] for k in columns):
+        return "invalid columns argument", 400
+
+    windows = list(dict.fromkeys(positive_int(w) for w in request.args.getlist("moving_average")))
+    if None in windows:
+        return "invalid moving_average argument", 400
+
+    group_by = request.args.get("group_by")
+    if group_by is not None and group_by not in SUMMARY_PERIODS:
+        return "invalid group_by argument", 400
+
+    stats = request.args.get("stats", default=",".join(aggregate.STATS)).split(",")
+    if not all(stat in aggregate.STATS for stat in stats):
+        return "invalid stats argument", 400
+
+    if group_by is not None and windows:
+        return "moving_average is per activity, it can't be combined with group_by", 400
+
+    columnar_format = wants_columnar()
+    time = epoch_seconds("start_time") if columnar_format else "start_time"
+    dtype = np.dtype([
+        ("start_time", "<i8" if columnar_format else "U32"),
+        ("period", "U10"),
+        *((k, "<f8") for k in columns),
+    ])
+
+    snap = get_snapshot()
+    if snap is not None:
+        found = snap.activity_range(start, end)
+        rows = {
+            "start_time": snap.activity["start_time_epoch" if columnar_format else "start_time"][found],
+            **({"period": snap.activity[f"period_{group_by}"][found]} if group_by is not None else {}),
+            **{k: snap.activity[k][found] for k in columns},
+        }
+    else:
+        cur = get_db().cursor()
+        rows = columnar.from_rows(cur.execute(f"""
+            SELECT {time}, date(start_time, ?), {','.join(columns)}
+            FROM Activity
+            WHERE start_time BETWEEN ? AND ?
+            ORDER BY Activity.start_time
+            """, (SUMMARY_PERIODS.get(group_by, "start of day"), start, end)), dtype)
+
+    if group_by is None:
+        q = {"start_time": rows["start_time"]}
+        for k in columns:
+            q[k] = rows[k]
+            for window in windows:
+                q[f"{k}_ma{window}"] = aggregate.moving_average(rows[k], window)
+    else:
+        starts = aggregate.period_starts(rows["period"])
+        q = {
+            "period": rows["period"][starts],
+            "activities": np.diff(np.append(starts, len(rows["start_time"]))),
+        }
+        for k in columns:
+            for stat, values in aggregate.period_stats(starts, rows[k], stats).items():
+                q[f"{k}_{stat}"] = values
+
+    if columnar_format:
+        if group_by is not None:
+            q["period"] = q["period"].astype("datetime64[D]").astype("datetime64[s]").astype("<i8")
+        table = np.empty(len(next(iter(q.values()))), dtype=[(k, v.dtype) for k, v in q.items()])
+        for k, v in q.items():
+            table[k] = v
+        return columnar_response(table)
+
+    return {k: [None if isinstance(x, float) and math.isnan(x) else x for x in v.tolist()] for k, v in q.items()}
+
+
+@app.route("/api/monitoring")
+def monitoring_series():
+    # eg. /api/monitoring?heart_rate&steps&start=date&end=date&interval=900
+    # return [time, series1, series2, ...] for every interval of `interval` seconds
+    # (default 300) in the date range holding a sample, each series combined over the
+    # interval as given in monitoring.SERIES (eg. average heart rate, total steps).
+    # with format=columnar times are epoch seconds and values float64
+
+    start = request.args.get("start", default="0001-01-01")
+    end = request.args.get("end", default="9999-01-01")
+
+    interval = positive_int(request.args.get("interval", default="300"))
+    if interval is None:
+        return "invalid interval argument", 400
+
+    series = [k for k in request.args.keys() if k not in ("start", "end", "interval", "format")]
+    if not series or not all([k in monitoring.SERIES for k in series]):
+        return "invalid parameter", 400
+
+    # one range scan of the primary key per series, grouped into intervals by sqlite
+    columns = [f"{monitoring.SERIES[k][1]}(CASE WHEN series = {monitoring.SERIES[k][0]} THEN value END) AS {k}" for k in series]
+    ids = ",".join(str(monitoring.SERIES[k][0]) for k in series)
+
+    cur = get_db().cursor()
+    columnar_format = wants_columnar()
+    time = "interval_start" if columnar_format else "datetime(interval_start, 'unixepoch')"
+
+    try:
+        rows = cur.execute(f"""
+            SELECT {time}, {','.join(columns)}
+            FROM (
+                SELECT timestamp / ? * ? AS interval_start, series, value
+                FROM Monitoring
+                WHERE series IN ({ids})
+                AND timestamp BETWEEN strftime('%s', ?) AND strftime('%s', ?)
+            )
+            GROUP BY interval_start
+            ORDER BY interval_start
+        """, (interval, interval, start, end))
+
+        if columnar_format:
+            dtype = np.dtype([("timestamp", "<i8"), *((k, "<f8") for k in series)])
+            return columnar_response(columnar.from_rows(rows, dtype))
+
+        q = rows.fetchall()
+    except sqlite3.Error:
+        return "invalid date given", 400
 
     return q
@@ -0,0 +1,335 @@
+from pathlib import Path
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+
+import downsample
+import record_blob
+
+# read-only copy of what the summary, totals and records routes read, exported after
+# ingest (`app.py --snapshot DIR`) as flat .npy files the server memory maps. requests
+# are answered from views into the mapped arrays, so the data is read straight from
+# the page cache, one copy of which is shared by every process serving it:
+#
+#   DIR/current           name of the folder holding the latest snapshot
+#   DIR/<name>/manifest.json
+#                         db generation exported, and which Activity columns hold
+#                         integers
+#   DIR/<name>/activity/  one array per Activity column in start_time order, times
+#                         also as <column>_epoch and each activity's
+#                         period_<week|month|year> as /api/summary/totals labels them
+#   DIR/<name>/records/   every activity's records back to back in the same order,
+#                         activity i's in [offset[i], offset[i+1])
+#   DIR/<name>/levels/    the same for ActivityRecordLevel, offset is [i, level] ->
+#                         (start, stop), empty where a level isn't stored
+#   DIR/<name>/laps/      [start, stop) of every lap as epoch seconds, offset as records
+#
+# a snapshot is only used while the db is still at the generation it was exported
+# from, so the server reads the db itself until the export following an ingest is done
+
+VERSION = 1
+
+# Activity columns holding times, kept as their text and as epoch seconds
+TIME_COLUMNS = ("start_time", "end_time")
+
+# records columns kept, as the records route returns them
+RECORD_COLUMNS = {
+    "timestamp": "<i8",
+    "enhanced_speed": "<f8",
+    "heart_rate": "u1",
+    "cadence": "u1",
+    "enhanced_altitude": "<f8",
+}
+
+# date() modifiers labelling each activity's period, as ActivityTotals does
+PERIODS = {
+    "week": "weekday 1",
+    "month": "start of month",
+    "year": "start of year",
+}
+
+
+def export(con, directory, generation) -> Path:
+    # writes a snapshot of the db behind con to a new folder in directory, points
+    # directory/current at it and removes older snapshots (only those, see is_snapshot).
+    # processes still mapping the old files keep reading them until they next check current
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    path = Path(tempfile.mkdtemp(prefix=f"{generation}-", dir=directory))
+
+    # one read transaction, so every table is seen at the same point
+    con.execute("BEGIN")
+    try:
+        activity_ids, manifest = export_activities(con, path/"activity")
+        manifest["records"] = export_records(con, path/"records", activity_ids)
+        manifest["levels"] = export_levels(con, path/"levels", activity_ids)
+        manifest["laps"] = export_laps(con, path/"laps", activity_ids)
+    except BaseException:
+        # without a manifest a later export wouldn't know the folder for one of its own
+        shutil.rmtree(path, ignore_errors=True)
+        raise
+    finally:
+        con.execute("COMMIT")
+
+    manifest.update({"version": VERSION, "generation": generation, "activities": len(activity_ids)})
+    (path/"manifest.json").write_text(json.dumps(manifest))
+
+    current = directory/"current"
+    tmp = directory/"current.tmp"
+    tmp.write_text(path.name)
+    os.replace(tmp, current)
+
+    for old in directory.iterdir():
+        if old != path and is_snapshot(old):
+            shutil.rmtree(old, ignore_errors=True)
+
+    return path
+
+
+def is_snapshot(path) -> bool:
+    # whether path is a folder export made, named for its generation and holding a
+    # manifest of this version. anything else in the directory isn't ours to remove
+    generation, _, _ = path.name.partition("-")
+    if not path.is_dir() or not generation.isdigit():
+        return False
+    try:
+        manifest = json.loads((path/"manifest.json").read_text())
+    except (OSError, ValueError):
+        return False
+    if not isinstance(manifest, dict):
+        return False
+    return manifest.get("version") == VERSION and str(manifest.get("generation")) == generation
+
+
+def export_activities(con, path):
+    path.mkdir()
+    columns = [row[1] for row in con.execute("PRAGMA table_info(Activity)") if row[1] != "activity_id"]
+    # columns whose values are all integers come back from sqlite as ints
+    checks = ",".join(f"max(typeof({k}) = 'real')" for k in columns)
+    real = con.execute(f"SELECT {checks} FROM Activity").fetchone()
+    integer = [k for k, is_real in zip(columns, real) if k not in TIME_COLUMNS and not is_real]
+
+    selected = [
+        "activity_id",
+        *columns,
+        *(f"CAST(strftime('%s', {k}) AS INTEGER)" for k in TIME_COLUMNS),
+        *(f"date(start_time, '{modifier}')" for modifier in PERIODS.values()),
+    ]
+    rows = con.execute(f"SELECT {','.join(selected)} FROM Activity ORDER BY start_time").fetchall()
+    values = list(zip(*rows)) or [()] * len(selected)
+
+    names = [*columns, *(f"{k}_epoch" for k in TIME_COLUMNS), *(f"period_{period}" for period in PERIODS)]
+    for name, column in zip(names, values[1:]):
+        if name in TIME_COLUMNS or name.startswith("period_"):
+            array = np.array(column, dtype=str)
+        elif name.endswith("_epoch"):
+            array = np.array(column, dtype="<i8")
+        else:
+            array = np.array([np.nan if value is None else value for value in column], dtype="<f8")
+        np.save(path/f"{name}.npy", array)
+
+    return list(values[0]), {"integer": integer}
+
+
+def activity_records(con, activity_id):
+    # {column: array} of RECORD_COLUMNS, from whichever layout the activity is in
+    row = con.execute("SELECT data FROM ActivityRecordBlob WHERE activity_id = ?", (activity_id,)).fetchone()
+    if row is not None:
+        return record_blob.decode(row[0])
+
+    return np.fromiter(con.execute("""
+        SELECT CAST(strftime('%s', timestamp) AS INTEGER), enhanced_speed, heart_rate, cadence, enhanced_altitude
+        FROM ActivityRecord
+        WHERE activity_id = ?
+        ORDER BY timestamp
+        """, (activity_id,)), dtype=list(RECORD_COLUMNS.items()))
+
+
+def create_columns(path, count):
+    # a writable memory map per RECORD_COLUMNS column, filled in without holding
+    # every activity's records in memory at once
+    path.mkdir()
+    return {name: np.lib.format.open_memmap(path/f"{name}.npy", mode="w+", dtype=dtype, shape=(count,))
+        for name, dtype in RECORD_COLUMNS.items()}
+
+
+def export_records(con, path, activity_ids) -> int:
+    count = con.execute("""
+        SELECT (SELECT count(*) FROM ActivityRecord) + (SELECT coalesce(sum(record_count), 0) FROM ActivityRecordBlob)
+        """).fetchone()[0]
+    columns = create_columns(path, count)
+
+    offset = np.zeros(len(activity_ids) + 1, dtype="<i8")
+    for i, activity_id in enumerate(activity_ids):
+        records = activity_records(con, activity_id)
+        stop = offset[i] + len(records["timestamp"])
+        for name, array in columns.items():
+            array[offset[i]:stop] = records[name]
+        offset[i+1] = stop
+
+    for array in columns.values():
+        array.flush()
+    np.save(path/"offset.npy", offset)
+
+    return int(offset[-1])
+
+
+def export_levels(con, path, activity_ids) -> int:
+    columns = create_columns(path, con.execute("SELECT count(*) FROM ActivityRecordLevel").fetchone()[0])
+
+    offset = np.zeros((len(activity_ids), len(downsample.LEVELS), 2), dtype="<i8")
+    position = 0
+    for i, activity_id in enumerate(activity_ids):
+        for j, level in enumerate(downsample.LEVELS):
+            rows = np.fromiter(con.execute("""
+                SELECT CAST(strftime('%s', timestamp) AS INTEGER), enhanced_speed, heart_rate, cadence, enhanced_altitude
+                FROM ActivityRecordLevel
+                WHERE activity_id = ? AND max_points = ?
+                ORDER BY timestamp
+                """, (activity_id, level)), dtype=list(RECORD_COLUMNS.items()))
+            for name, array in columns.items():
+                array[position:position+len(rows)] = rows[name]
+            offset[i, j] = (position, position + len(rows))
+            position += len(rows)
+
+    for array in columns.values():
+        array.flush()
+    np.save(path/"offset.npy", offset)
+
+    return position
+
+
+def export_laps(con, path, activity_ids) -> int:
+    # a lap runs up to the start of the next one, as the records route takes them
+    path.mkdir()
+    laps = {}
+    for activity_id, start, stop in con.execute("""
+            SELECT activity_id, CAST(strftime('%s', start_time) AS INTEGER), CAST(strftime('%s', coalesce(
+                lead(start_time) OVER (PARTITION BY activity_id ORDER BY start_time),
+                datetime(end_time, '+1 second')
+            )) AS INTEGER)
+            FROM Lap
+            ORDER BY activity_id, start_time
+            """):
+        laps.setdefault(activity_id, []).append((start, stop))
+
+    bounds = [laps.get(activity_id, []) for activity_id in activity_ids]
+    offset = np.cumsum([0, *map(len, bounds)], dtype="<i8")
+    bounds = np.array([lap for activity in bounds for lap in activity], dtype="<i8").reshape(-1, 2)
+
+    np.save(path/"start.npy", bounds[:, 0].copy())
+    np.save(path/"stop.npy", bounds[:, 1].copy())
+    np.save(path/"offset.npy", offset)
+
+    return len(bounds)
+
+
+def load(path) -> dict:
+    # {name: array} of every .npy file in path, as read-only views of the mapped files
+    return {f.stem: np.load(f, mmap_mode="r").view(np.ndarray) for f in Path(path).glob("*.npy")}
+
+
+class Snapshot:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.manifest = json.loads((self.path/"manifest.json").read_text())
+        if self.manifest["version"] != VERSION:
+            raise ValueError(f"unsupported snapshot version {self.manifest['version']}")
+
+        self.generation = self.manifest["generation"]
+        self.activity = load(self.path/"activity")
+        self.records = load(self.path/"records")
+        self.levels = load(self.path/"levels")
+        self.laps = load(self.path/"laps")
+
+    def activity_range(self, start, end) -> slice:
+        # activities with start_time BETWEEN start AND end, compared as text like sqlite
+        start_time = self.activity["start_time"]
+        return slice(np.searchsorted(start_time, start, "left"), np.searchsorted(start_time, end, "right"))
+
+    def find(self, start_time):
+        # index of the activity starting at start_time, None if there's none
+        i = int(np.searchsorted(self.activity["start_time"], start_time))
+        if i < len(self.activity["start_time"]) and self.activity["start_time"][i] == start_time:
+            return i
+        return None
+
+    def values(self, name, found) -> list:
+        # the activities' values of an Activity column as sqlite returns them
+        values = self.activity[name][found]
+        if name in TIME_COLUMNS:
+            return values.tolist()
+        if name in self.manifest["integer"]:
+            return [None if value != value else int(value) for value in values.tolist()]
+        return [None if value != value else value for value in values.tolist()]
+
+    def activity_records(self, start_time, max_points=None, lap=None):
+        # {column: view} of an activity's records in time order, as the records route
+        # returns them: the largest stored level fitting in max_points if there is one,
+        # or the records of its lap-th lap (None if it has fewer laps)
+        i = self.find(start_time)
+        if i is None:
+            if lap is not None:
+                return None
+            return self.slice(self.records, 0, 0)
+
+        if lap is not None:
+            first, last = self.laps["offset"][i:i+2]
+            if lap > last - first:
+                return None
+            bounds = (self.laps["start"][first+lap-1], self.laps["stop"][first+lap-1])
+            records = self.slice(self.records, *self.records["offset"][i:i+2])
+            start, stop = np.searchsorted(records["timestamp"], bounds)
+            return {name: array[start:stop] for name, array in records.items()}
+
+        if max_points is not None:
+            fitting = [j for j, level in enumerate(downsample.LEVELS) if level <= max_points]
+            start, stop = self.levels["offset"][i, fitting[-1] if fitting else 0]
+            if stop > start:
+                return self.slice(self.levels, start, stop)
+
+        return self.slice(self.records, *self.records["offset"][i:i+2])
+
+    @staticmethod
+    def slice(columns, start, stop):
+        return {name: columns[name][start:stop] for name in RECORD_COLUMNS}
+
+
+class SnapshotWatcher:
+    # the snapshot in a directory for every request, like cache.GenerationWatcher only
+    # loading it again when a stat shows current has been replaced
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._directory = None
+        self._stat = None
+        self._snapshot = None
+
+    def current(self, directory, generation):
+        # the snapshot exported from the given db generation, None without one
+        current = Path(directory, "current")
+        try:
+            stat = os.stat(current)
+            stat = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            stat = None
+
+        with self._lock:
+            if (directory, stat) != (self._directory, self._stat):
+                self._snapshot = None
+                try:
+                    if stat is not None:
+                        self._snapshot = Snapshot(Path(directory, current.read_text()))
+                    self._directory, self._stat = directory, stat
+                except (FileNotFoundError, ValueError, KeyError):
+                    # replaced again mid load, the next request retries
+                    self._directory, self._stat = None, None
+
+            snapshot = self._snapshot
+
+        if snapshot is None or snapshot.generation != generation:
+            return None
+        return snapshot
@@ -35,7 +35,7 @@ async function hashlistener() {
                 canv.id = "activity_canvas"
                 document.getElementById("div1").appendChild(canv)
 
-                const records =  await fetch("/api/activity/"+decodeURIComponent(window.location.hash.split("#")[2])+"/records").then(response => response.json())
+                const records =  await fetch("/api/activity/"+decodeURIComponent(window.location.hash.split("#")[2])+"/records?max_points=2000").then(response => response.json())
 
                 // TODO: get these from api
                 const hr_zones = [101,121,141,162,182]
@@ -114,19 +114,26 @@ async function hashlistener() {
 }
 
 
+// every column the scatter chart can show, fetched together in one request
+const summary_columns = fetch("/api/summary/columns?columns="+
+    Array.from(document.getElementsByName("scatter")).map(n => n.id).join(",")).then(response => response.json())
+
+async function summary_points(column) {
+    const columns = await summary_columns
+    return columns.start_time.map((x, i) => ({x: x, y: columns[column][i]}))
+}
+
 async function test() {
     var canv = document.createElement("canvas")
     canv.id = "canvas"
 
     document.getElementById("graph").appendChild(canv)
 
-    var raw_data = await fetch("/api/summary?total_distance").then(response => response.json())
-
     const data = {
         datasets: [
             {
                 label: "total distance",
-                data: raw_data.map(i => ({x: i[0], y: i[1]}))
+                data: await summary_points("total_distance")
             }
         ]
     }
@@ -154,9 +161,8 @@ async function update_chart(label, column) {
     chart_graph = await chart_graph
 
     if (this.checked) {
-        var raw_data = await fetch("/api/summary?"+column).then(response => response.json())
         chart_graph.data.datasets = [
-            {label: label, data: raw_data.map(i => ({x: i[0], y: i[1]}))}
+            {label: label, data: await summary_points(column)}
         ]
         chart_graph.update()
     }
@@ -171,13 +177,11 @@ async function update_chart_grouping() {
             document.querySelector("label[for="+n.id+"]").style.display = "inline"
         })
 
-        var raw_data = await fetch("/api/summary?total_distance").then(response => response.json())
-
         chart_graph.config.type = 'scatter'
         chart_graph.data.datasets = [
             {
                 label: "total distance",
-                data: raw_data.map(i => ({x: i[0], y: i[1]}))
+                data: await summary_points("total_distance")
             }
         ]
         chart_graph.type = 'scatter'
@@ -0,0 +1,163 @@
+import numpy as np
+
+# gps tracks for maps. records hold positions as FIT semicircles, tracks are
+# simplified at ingest to each of these tolerances (metres) and stored as encoded
+# polylines, so a map never needs the 1Hz points
+TOLERANCES = (2.0, 10.0, 50.0)
+
+# length (metres) of the pieces of track whose bounding boxes go in the spatial index
+SEGMENT_LENGTH = 500.0
+
+SEMICIRCLES_TO_DEGREES = 180 / 2**31
+EARTH_RADIUS = 6371008.8
+
+
+def to_degrees(semicircles: np.ndarray) -> np.ndarray:
+    return semicircles * SEMICIRCLES_TO_DEGREES
+
+
+def positions(lat: np.ndarray, long: np.ndarray):
+    # degrees from the semicircle columns of an activity's records (nan where missing),
+    # dropping records without a fix
+    lat, long = to_degrees(np.asarray(lat, dtype=np.float64)), to_degrees(np.asarray(long, dtype=np.float64))
+    fixed = ~(np.isnan(lat) | np.isnan(long))
+    return lat[fixed], long[fixed]
+
+
+def cumulative_distance(lat: np.ndarray, long: np.ndarray) -> np.ndarray:
+    # haversine distance in metres from the first point to each point along the track
+    lat, long = np.radians(lat), np.radians(long)
+    a = np.sin(np.diff(lat)/2)**2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(long)/2)**2
+    steps = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1)))
+    return np.concatenate(([0.0], np.cumsum(steps)))
+
+
+def project(lat: np.ndarray, long: np.ndarray):
+    # metres on a plane tangent at the track's mean latitude, close enough over the
+    # few km of an activity to measure how far points lie from a line
+    scale = np.cos(np.radians(lat.mean()))
+    return np.radians(long) * EARTH_RADIUS * scale, np.radians(lat) * EARTH_RADIUS
+
+
+def simplify(x: np.ndarray, y: np.ndarray, tolerance: float) -> np.ndarray:
+    # indices of the points kept by ramer-douglas-peucker, so that no point dropped
+    # is more than `tolerance` from the simplified line. distances to each segment are
+    # measured for all of its points at once, and measured to the segment rather than
+    # its line so a loop ending where it started isn't collapsed
+    n = len(x)
+    keep = np.zeros(n, dtype=bool)
+    keep[[0, n-1]] = True
+
+    stack = [(0, n-1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+
+        px, py = x[first+1:last] - x[first], y[first+1:last] - y[first]
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        length = dx*dx + dy*dy
+
+        along = np.clip((px*dx + py*dy) / length, 0, 1) if length > 0 else np.zeros_like(px)
+        distance = np.hypot(px - along*dx, py - along*dy)
+
+        i = distance.argmax()
+        if distance[i] > tolerance:
+            keep[first+1+i] = True
+            stack += [(first, first+1+i), (first+1+i, last)]
+
+    return np.flatnonzero(keep)
+
+
+def encode_polyline(lat: np.ndarray, long: np.ndarray) -> str:
+    # google's encoded polyline format (5 decimal places), as read by leaflet and
+    # most map libraries
+    coords = np.round(np.column_stack((lat, long)) * 1e5).astype(np.int64)
+    deltas = np.diff(coords, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    values = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+
+    out = []
+    for value in values.tolist():
+        while value >= 0x20:
+            out.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        out.append(chr(value + 63))
+
+    return "".join(out)
+
+
+def decode_polyline(polyline: str):
+    # (lat, long) in degrees from an encoded polyline
+    values = []
+    value = shift = 0
+    for byte in polyline.encode("ascii"):
+        byte -= 63
+        value |= (byte & 0x1f) << shift
+        shift += 5
+        if byte < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+
+    coords = np.cumsum(np.array(values, dtype=np.int64).reshape(-1, 2), axis=0) / 1e5
+    return coords[:, 0], coords[:, 1]
+
+
+def distance_to_line(lat: np.ndarray, long: np.ndarray, line_lat: np.ndarray, line_long: np.ndarray) -> np.ndarray:
+    # metres from each point to the nearest part of a line through the given vertices,
+    # every point against every segment at once
+    scale = np.cos(np.radians(line_lat.mean()))
+    x, y = np.radians(long)[:, None] * EARTH_RADIUS * scale, np.radians(lat)[:, None] * EARTH_RADIUS
+    lx, ly = np.radians(line_long) * EARTH_RADIUS * scale, np.radians(line_lat) * EARTH_RADIUS
+
+    if len(lx) < 2:
+        return np.hypot(x - lx[0], y - ly[0])[:, 0]
+
+    dx, dy = np.diff(lx), np.diff(ly)
+    length = dx*dx + dy*dy
+    px, py = x - lx[:-1], y - ly[:-1]
+    along = np.clip(np.divide(px*dx + py*dy, length, out=np.zeros_like(px), where=length > 0), 0, 1)
+
+    return np.hypot(px - along*dx, py - along*dy).min(axis=1)
+
+
+def route_difference(a, b) -> float:
+    # how far apart two tracks ((lat, long) vertex arrays) run: the larger of the 90th
+    # percentile distances from each one's vertices to the other line, in metres.
+    # a route run the other way round still matches
+    return max(
+        float(np.percentile(distance_to_line(*a, *b), 90)),
+        float(np.percentile(distance_to_line(*b, *a), 90)),
+    )
+
+
+def bounds(lat: np.ndarray, long: np.ndarray):
+    # (min lat, max lat, min long, max long) of the whole track
+    return float(lat.min()), float(lat.max()), float(long.min()), float(long.max())
+
+
+def segment_bounds(lat: np.ndarray, long: np.ndarray) -> np.ndarray:
+    # rows of (min lat, max lat, min long, max long) for consecutive SEGMENT_LENGTH
+    # pieces of the track, each including the first point of the next so the boxes
+    # leave no gaps along the line
+    segment = (cumulative_distance(lat, long) // SEGMENT_LENGTH).astype(np.intp)
+    starts = np.flatnonzero(np.diff(segment, prepend=-1))
+    joins = np.append(starts[1:], len(lat)-1)
+
+    return np.column_stack((
+        np.minimum(np.minimum.reduceat(lat, starts), lat[joins]),
+        np.maximum(np.maximum.reduceat(lat, starts), lat[joins]),
+        np.minimum(np.minimum.reduceat(long, starts), long[joins]),
+        np.maximum(np.maximum.reduceat(long, starts), long[joins]),
+    ))
+
+
+def levels(lat: np.ndarray, long: np.ndarray):
+    # yields (tolerance, points, distance, polyline) for each of TOLERANCES, from
+    # positions in degrees
+    if len(lat) < 2:
+        return
+
+    x, y = project(lat, long)
+    for tolerance in TOLERANCES:
+        kept = simplify(x, y, tolerance)
+        yield tolerance, len(kept), float(cumulative_distance(lat[kept], long[kept])[-1]), encode_polyline(lat[kept], long[kept])
@@ -0,0 +1,59 @@
+import datetime
+import math
+
+import numpy as np
+
+# heart rate zones (lower bounds in bpm of zones 1-5, as coloured in the activity
+# view) and the resting and maximum heart rates TRIMP is scaled by. set these to
+# your own
+HR_ZONES = (101, 121, 141, 162, 182)
+REST_HEART_RATE = 60
+MAX_HEART_RATE = 190
+
+# longest gap between records counted towards time in a zone, anything longer is
+# the watch being paused
+MAX_GAP = 10
+
+# days over which fitness (chronic training load) and fatigue (acute training load)
+# are averaged
+CTL_DAYS = 42
+ATL_DAYS = 7
+
+
+def record_seconds(seconds: np.ndarray) -> np.ndarray:
+    # how long each record stands for, up to the next one
+    return np.minimum(np.diff(seconds, append=seconds[-1:]), MAX_GAP).astype(np.float64)
+
+
+def zone_seconds(seconds: np.ndarray, heart_rate: np.ndarray) -> np.ndarray:
+    # seconds spent below zone 1 and in each of zones 1-5
+    return np.bincount(np.searchsorted(HR_ZONES, heart_rate, side="right"),
+        weights=record_seconds(seconds), minlength=len(HR_ZONES)+1)
+
+
+def trimp(seconds: np.ndarray, heart_rate: np.ndarray) -> float:
+    # banister's training impulse, minutes weighted by heart rate reserve
+    reserve = np.clip((heart_rate - REST_HEART_RATE) / (MAX_HEART_RATE - REST_HEART_RATE), 0, 1)
+    return float(np.sum(record_seconds(seconds) / 60 * reserve * 0.64 * np.exp(1.92 * reserve)))
+
+
+def daily_series(first_day: str, loads: dict, ctl=0.0, atl=0.0):
+    # yields (day, load, ctl, atl, tsb) for every day from first_day to the last day in
+    # loads ({day: training load}, days as "YYYY-MM-DD"), carrying on from the ctl and
+    # atl of the day before first_day. tsb (form) is the day before's fitness less its
+    # fatigue
+    if not loads:
+        return
+
+    ctl_decay, atl_decay = math.exp(-1/CTL_DAYS), math.exp(-1/ATL_DAYS)
+
+    day = datetime.date.fromisoformat(first_day)
+    last_day = datetime.date.fromisoformat(max(loads))
+    while day <= last_day:
+        load = loads.get(day.isoformat(), 0.0)
+        tsb = ctl - atl
+        ctl = ctl*ctl_decay + load*(1 - ctl_decay)
+        atl = atl*atl_decay + load*(1 - atl_decay)
+
+        yield day.isoformat(), load, ctl, atl, tsb
+        day += datetime.timedelta(days=1)
@@ -0,0 +1,134 @@
+from pathlib import Path
+import queue
+import threading
+import time
+import traceback
+
+# ingest alongside the server: one thread polls the fitfile folders for new or changed
+# files and puts them on a bounded queue, another takes whatever has queued up and
+# hands it to `ingest` as one batch. request threads never wait on either, the server
+# picks new data up from the db generation that ingest bumps when it commits
+
+# files waiting to be ingested before the poller stops adding more
+QUEUE_SIZE = 1000
+
+
+class IngestWatcher:
+    def __init__(self, folders, ingest, interval=5.0, queue_size=QUEUE_SIZE):
+        # ingest(files) is called from the worker thread with a list of paths and
+        # returns {"activity_count": ..., "sample_count": ...} for what it added
+        self.folders = [Path(folder) for folder in folders]
+        self.ingest = ingest
+        self.interval = interval
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._seen = {}
+        self._pending = {}
+        self._threads = []
+
+        self.counters = {
+            "files_queued": 0,
+            "files_ingested": 0,
+            "batches": 0,
+            "activities_added": 0,
+            "samples_added": 0,
+            "errors": 0,
+        }
+        self.ingesting = False
+        self.last_ingest = None
+        self.last_error = None
+
+    def scan(self):
+        # {path: (size, mtime)} of every file in the folders
+        state = {}
+        for folder in self.folders:
+            for f in folder.iterdir():
+                stat = f.stat()
+                state[f] = (stat.st_size, stat.st_mtime_ns)
+        return state
+
+    def prime(self):
+        # treat everything there now as already seen, eg. when it's about to be ingested
+        # by update_db anyway
+        self._seen = self.scan()
+
+    def poll(self):
+        # queue files that are new or changed since the last poll and have stayed the
+        # same size and mtime for a whole interval, so half copied files are left
+        # until the copy finishes
+        state = self.scan()
+        for f, file_state in state.items():
+            if self._seen.get(f) == file_state:
+                self._pending.pop(f, None)
+                continue
+
+            if self._pending.get(f) != file_state:
+                self._pending[f] = file_state
+                continue
+
+            self.queue.put(f)
+            self.counters["files_queued"] += 1
+            self._seen[f] = file_state
+            del self._pending[f]
+
+    def _poll_loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll()
+            except OSError:
+                self.counters["errors"] += 1
+                self.last_error = traceback.format_exc()
+
+    def _ingest_loop(self):
+        while not self._stop.is_set():
+            try:
+                files = [self.queue.get(timeout=self.interval)]
+            except queue.Empty:
+                continue
+
+            while True:
+                try:
+                    files.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            self.ingesting = True
+            try:
+                counts = self.ingest(files)
+                self.counters["activities_added"] += counts["activity_count"]
+                self.counters["samples_added"] += counts["sample_count"]
+            except Exception:
+                self.counters["errors"] += 1
+                self.last_error = traceback.format_exc()
+            finally:
+                self.ingesting = False
+                self.counters["files_ingested"] += len(files)
+                self.counters["batches"] += 1
+                self.last_ingest = time.time()
+
+    def start(self):
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._poll_loop, name="ingest-poller", daemon=True),
+            threading.Thread(target=self._ingest_loop, name="ingest-worker", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=None):
+        # lets a batch being ingested finish, anything still queued is picked up by
+        # the next update as it's not in the manifest yet
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def status(self):
+        return {
+            **self.counters,
+            "queue_depth": self.queue.qsize(),
+            "pending_files": len(self._pending),
+            "ingesting": self.ingesting,
+            "last_ingest": self.last_ingest,
+            "last_error": self.last_error,
+        }